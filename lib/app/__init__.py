@@ -4,15 +4,18 @@ import logging
 import sys
 import time
 
-from flask import Flask, g, jsonify, make_response, request
+from flask import Flask, g, has_app_context, jsonify, make_response, request
 from flask.ext.assets import Environment, Bundle
 from flask_failsafe import failsafe
 from itsdangerous import Signer
+from redis import RedisError
 from werkzeug.exceptions import HTTPException
 
 import app.config
 import app.database
+import app.metrics
 from app.queue import init_queues, remove_unused_queues
+from app.trace import TraceLogFilter
 
 
 flask_app = None
@@ -110,16 +113,23 @@ def init_errors(flask_app, config):
             description = str(error)
 
         if mimetype.startswith('application/json'):
-            response = jsonify(message=description)
+            response = jsonify(message=description,
+                               **getattr(error, 'data', {}))
         else:
             response = make_response(description + '\n\n')
             response.headers['Content-type'] = 'text/plain'
 
         response.status_code = error.code
 
+        # Keep headers such as Retry-After (see app.admission).
+        for name, value in error.get_headers():
+            if name.lower() != 'content-type':
+                response.headers[name] = value
+
         return response
 
-    http_status_codes = list(range(400, 418)) + list(range(500, 506))
+    http_status_codes = list(range(400, 418)) + [429] + \
+        list(range(500, 506))
 
     for http_status_code in http_status_codes:
         flask_app.errorhandler(http_status_code)(http_error_handler)
@@ -155,12 +165,33 @@ def init_flask(flask_app, config):
 
     @flask_app.after_request
     def after_request(response):
-        ''' Clean up request context. '''
+        ''' Clean up request context and record request metrics. '''
 
         g.db.close()
+        record_request_metrics(response)
 
         return response
 
+    def record_request_metrics(response):
+        ''' Count the request and write this process's metrics to Redis. '''
+
+        endpoint = request.endpoint or 'none'
+        app.metrics.count('hgprofiler_http_requests_total',
+                          method=request.method,
+                          endpoint=endpoint,
+                          status=response.status_code)
+        app.metrics.observe('hgprofiler_http_request_duration_seconds',
+                            time.perf_counter() - g.request_started,
+                            method=request.method,
+                            endpoint=endpoint)
+        app.metrics.set_pool_gauges(db_engine)
+
+        try:
+            app.metrics.flush(redis)
+        except RedisError:
+            # Metrics must not break requests. Unflushed updates are lost.
+            flask_app.logger.exception('Cannot write metrics to Redis.')
+
     if flask_app.latency is not None:
         @flask_app.before_request
         def api_latency():
@@ -171,6 +202,7 @@ def init_flask(flask_app, config):
     def before_request():
         ''' Initialize request context. '''
 
+        g.request_started = time.perf_counter()
         g.config = config
         g.debug = flask_app.debug
         g.db = app.database.get_session(db_engine)
@@ -199,9 +231,11 @@ def init_logging(flask_app, config):
     the Flask log in production mode.
     """
 
-    log_string_format = '%(asctime)s [%(name)s] %(levelname)s: %(message)s'
+    log_string_format = '%(asctime)s [%(name)s] %(levelname)s ' \
+                        '[%(trace_id)s]: %(message)s'
     log_date_format = '%Y-%m-%d %H:%M:%S'
     log_formatter = logging.Formatter(log_string_format, log_date_format)
+    trace_filter = TraceLogFilter(_request_trace_id)
 
     try:
         log_level = getattr(logging, config.get('logging', 'log_level').upper())
@@ -213,6 +247,7 @@ def init_logging(flask_app, config):
         log_handler = logging.FileHandler(log_file)
         log_handler.setLevel(log_level)
         log_handler.setFormatter(log_formatter)
+        log_handler.addFilter(trace_filter)
 
         flask_app.logger.addHandler(log_handler)
 
@@ -221,6 +256,7 @@ def init_logging(flask_app, config):
         # explicitly asked for.
         db_log_handler = logging.StreamHandler(sys.stderr)
         db_log_handler.setFormatter(log_formatter)
+        db_log_handler.addFilter(trace_filter)
 
         db_logger = logging.getLogger('sqlalchemy.engine')
         db_logger.setLevel(logging.INFO)
@@ -236,12 +272,18 @@ def init_views(flask_app, config):
     from app.views.authenticate import AuthenticationView
     AuthenticationView.register(flask_app, route_base='/api/authentication/')
 
+    from app.views.batch import BatchView
+    BatchView.register(flask_app, route_base='/api/batch/')
+
     from app.views.configuration import ConfigurationView
     ConfigurationView.register(flask_app, route_base='/api/configuration/')
 
     from app.views.file import FileView
     FileView.register(flask_app, route_base='/api/file/')
 
+    from app.views.metrics import MetricsView
+    MetricsView.register(flask_app, route_base='/api/metrics/')
+
     from app.views.notification import NotificationView
     NotificationView.register(flask_app, route_base='/api/notification/')
     flask_app.atexit(NotificationView.quit_notifications)
@@ -252,6 +294,9 @@ def init_views(flask_app, config):
     from app.views.tasks import TasksView
     TasksView.register(flask_app, route_base='/api/tasks/')
 
+    from app.views.tracker import TrackerView
+    TrackerView.register(flask_app, route_base='/api/tracker/')
+
     from app.views.user import UserView
     UserView.register(flask_app, route_base='/api/user/')
 
@@ -299,3 +344,12 @@ def init_webassets(flask_app, config):
         dart_root + '/packages/browser/dart.js',
         output='combined/combined.js'
     ))
+
+
+def _request_trace_id():
+    ''' Return the trace ID of the current request, if it has one. '''
+
+    if has_app_context():
+        return getattr(g, 'trace_id', None)
+
+    return None
@@ -0,0 +1,296 @@
+'''
+Admission control for username searches.
+
+Each search queues one scrape job per username and site, so a single request
+can add many thousands of jobs. Searches are stored as batches, whose jobs
+are queued a chunk at a time by a planner (see worker.batch). Each chunk is
+admitted before its jobs are queued, so a large batch is never charged in
+full.
+
+A search is refused with 429 Too Many Requests if the scrape queue is deeper
+than ``[admission] max_queue_depth`` (see check_batch()). A chunk is not
+admitted if it would give its user more than ``max_outstanding_per_user``
+jobs that are queued or running, or while the scrape queue is full (see
+admit()); the planner waits and tries again. Refusals have a ``Retry-After``
+and estimates of the queue position and wait, based on the recent scrape
+throughput (see app.metrics). A search that needs more than
+``max_outstanding_per_user`` jobs for a single username could never be
+admitted, so it is refused with 413 Request Entity Too Large instead.
+
+Outstanding jobs are counted per user in ``admission.outstanding.<user
+id>``. The count is incremented when a chunk is admitted, and decremented
+by each scrape job when it finishes or fails (see release()). The IDs of
+the user's queued scrape jobs are kept in ``admission.jobs.<user id>`` (see
+track_job()). Before a chunk is refused, the count is reconciled with those
+jobs (see reconcile()), so that jobs that were lost without being released
+(e.g. if a worker was killed) don't count against the user.
+'''
+
+import math
+
+from rq import Queue
+from rq.job import Job, JobStatus
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+
+import app.config
+from app.metrics import get_metrics
+
+
+_config = app.config.get_config()
+_max_queue_depth = int(_config.get('admission', 'max_queue_depth'))
+_max_outstanding = int(_config.get('admission', 'max_outstanding_per_user'))
+_min_retry_after = int(_config.get('admission', 'min_retry_after'))
+_max_retry_after = int(_config.get('admission', 'max_retry_after'))
+
+OUTSTANDING_KEY_PREFIX = 'admission.outstanding.'
+JOBS_KEY_PREFIX = 'admission.jobs.'
+RECONCILED_KEY_PREFIX = 'admission.reconciled.'
+
+# A user's count is reconciled at most once in this many seconds.
+RECONCILE_INTERVAL = 60
+
+# Jobs in these states are still outstanding.
+LIVE_STATUSES = {JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.STARTED}
+
+# Throughput is measured over this many minutes of scrape job timings.
+THROUGHPUT_MINUTES = 5
+
+
+class TooManyRequests(HTTPException):
+    '''
+    The system is saturated. Clients should wait ``retry_after`` seconds
+    before trying again.
+    '''
+
+    code = 429
+    description = 'Too many searches are queued. Try again later.'
+
+    def __init__(self, description=None, retry_after=None, **data):
+        ''' Constructor. `data` is added to the JSON response body. '''
+
+        super().__init__(description)
+        self.retry_after = retry_after
+        self.data = data
+        self.data['retry_after'] = retry_after
+
+    def get_headers(self, environ=None):
+        ''' Add a ``Retry-After`` header. '''
+
+        headers = super().get_headers(environ)
+
+        if self.retry_after is not None:
+            headers.append(('Retry-After', str(self.retry_after)))
+
+        return headers
+
+
+def admit(redis, user_id, jobs):
+    '''
+    Admit `jobs` scrape jobs for `user_id`, or raise TooManyRequests (or
+    RequestEntityTooLarge, if they could never be admitted).
+
+    On success, the jobs are counted as outstanding for the user, and a
+    dictionary with the estimated ``queue_position`` of the last job and the
+    ``estimated_wait`` (in seconds, or None if unknown) is returned. The
+    caller must release() the jobs if it fails to queue them.
+    '''
+
+    if jobs > _max_outstanding:
+        raise RequestEntityTooLarge(
+            '{} jobs are required, but at most {} can be queued at once.'
+            .format(jobs, _max_outstanding)
+        )
+
+    estimate = check_queue(redis, jobs)
+    key = OUTSTANDING_KEY_PREFIX + str(user_id)
+    outstanding = redis.incrby(key, jobs)
+
+    if outstanding > _max_outstanding:
+        outstanding -= reconcile(redis, user_id)
+
+    if outstanding > _max_outstanding:
+        redis.decrby(key, jobs)
+        already = outstanding - jobs
+
+        raise TooManyRequests(
+            'You have {} jobs queued. Try again when they have finished.'
+            .format(already),
+            retry_after=_retry_after(outstanding - _max_outstanding,
+                                     scrape_throughput(redis)),
+            outstanding=already,
+            **estimate
+        )
+
+    return estimate
+
+
+def check_batch(redis, usernames, sites):
+    '''
+    Check that a batch searching `usernames` usernames on `sites` sites can
+    be accepted, and return estimates as for admit().
+
+    Raises RequestEntityTooLarge if a single username needs more jobs than a
+    user may have outstanding, since the batch could never be planned, or
+    TooManyRequests if the scrape queue is full. Nothing is admitted: the
+    planner admits each chunk of the batch.
+    '''
+
+    if sites > _max_outstanding:
+        raise RequestEntityTooLarge(
+            'Each username requires {} jobs, but at most {} can be queued '
+            'at once. Search fewer sites.'.format(sites, _max_outstanding)
+        )
+
+    return check_queue(redis, usernames * sites)
+
+
+def check_queue(redis, jobs):
+    '''
+    Raise TooManyRequests if the scrape queue is full. Otherwise, return the
+    estimated ``queue_position`` and ``estimated_wait`` of the last of `jobs`
+    more jobs.
+    '''
+
+    depth = Queue('scrape', connection=redis).count
+    throughput = scrape_throughput(redis)
+    estimate = {
+        'queue_position': depth + jobs,
+        'estimated_wait': _wait(depth + jobs, throughput),
+    }
+
+    if depth >= _max_queue_depth:
+        raise TooManyRequests(
+            'The scrape queue is full ({} jobs). Try again later.'
+            .format(depth),
+            retry_after=_retry_after(depth - _max_queue_depth + jobs,
+                                     throughput),
+            queue_depth=depth,
+            **estimate
+        )
+
+    return estimate
+
+
+def max_chunk_usernames(sites):
+    '''
+    Return the largest number of usernames whose jobs on `sites` sites can be
+    admitted at once.
+    '''
+
+    return max(1, _max_outstanding // max(1, sites))
+
+
+def track_job(pipeline, user_id, job_id):
+    '''
+    Queue a command on `pipeline` to record that job `job_id` is one of
+    `user_id`'s outstanding jobs. Call this in the same transaction that
+    queues the job.
+    '''
+
+    pipeline.sadd(JOBS_KEY_PREFIX + str(user_id), job_id)
+
+
+def release(redis, user_id, jobs=1, job_id=None):
+    '''
+    Mark `jobs` of `user_id`'s jobs as no longer outstanding.
+
+    If `job_id` is given, the job is no longer tracked, and nothing is
+    released if reconcile() has already released it.
+    '''
+
+    key = OUTSTANDING_KEY_PREFIX + str(user_id)
+
+    if job_id is not None and \
+            not redis.srem(JOBS_KEY_PREFIX + str(user_id), job_id):
+        return
+
+    if redis.decrby(key, jobs) <= 0:
+        redis.delete(key)
+
+
+def reconcile(redis, user_id):
+    '''
+    Release `user_id`'s tracked jobs that are no longer queued or running,
+    i.e. that finished, failed or were lost without being released.
+
+    This checks the status of each tracked job, so it runs at most once every
+    RECONCILE_INTERVAL seconds for each user. Returns the number of jobs
+    released.
+    '''
+
+    reconciled_key = RECONCILED_KEY_PREFIX + str(user_id)
+
+    if not redis.set(reconciled_key, 1, ex=RECONCILE_INTERVAL, nx=True):
+        return 0
+
+    jobs_key = JOBS_KEY_PREFIX + str(user_id)
+    job_ids = [job_id.decode('utf8') for job_id in redis.smembers(jobs_key)]
+    pipe = redis.pipeline(transaction=False)
+
+    for job_id in job_ids:
+        pipe.hget(Job.key_for(job_id), 'status')
+
+    statuses = pipe.execute()
+    lost = [job_id for job_id, status in zip(job_ids, statuses)
+            if status is None or status.decode('utf8') not in LIVE_STATUSES]
+
+    if len(lost) == 0:
+        return 0
+
+    # A job that is released concurrently is only removed once.
+    pipe = redis.pipeline(transaction=False)
+
+    for job_id in lost:
+        pipe.srem(jobs_key, job_id)
+
+    released = sum(pipe.execute())
+
+    if released > 0:
+        release(redis, user_id, released)
+
+    return released
+
+
+def get_outstanding(redis, user_id):
+    ''' Return the number of outstanding jobs for `user_id`. '''
+
+    return int(redis.get(OUTSTANDING_KEY_PREFIX + str(user_id)) or 0)
+
+
+def scrape_throughput(redis):
+    '''
+    Return the number of scrape jobs finished per second, on average, over
+    the last few minutes, or None if none have finished.
+    '''
+
+    metrics = get_metrics(redis, minutes=THROUGHPUT_MINUTES)
+    total = metrics.get('check_username', {}).get('total')
+
+    if total is None or total['count'] == 0:
+        return None
+
+    return total['count'] / (THROUGHPUT_MINUTES * 60)
+
+
+def _retry_after(jobs, throughput):
+    '''
+    Return the number of seconds a client should wait before trying again:
+    the time to finish `jobs` jobs at `throughput`, within configured
+    bounds.
+    '''
+
+    wait = _wait(jobs, throughput)
+
+    if wait is None:
+        wait = _max_retry_after
+
+    return max(_min_retry_after, min(wait, _max_retry_after))
+
+
+def _wait(jobs, throughput):
+    ''' Return the seconds to finish `jobs` jobs at `throughput`. '''
+
+    if throughput is None:
+        return None
+
+    return int(math.ceil(jobs / throughput))
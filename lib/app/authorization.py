@@ -1,13 +1,48 @@
-from datetime import datetime
+from collections import OrderedDict
 from functools import wraps
+import threading
+import time
 import urllib.parse
 
 import dateutil.parser
 from flask import g, request
 from werkzeug.exceptions import BadRequest, Forbidden, Unauthorized
 
+import app.config
+from app.metrics import count as count_metric
 from model import User
 
+
+_config = app.config.get_config()
+_token_cache_size = int(_config.get('auth', 'token_cache_size'))
+_token_cache_ttl = int(_config.get('auth', 'token_cache_ttl'))
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+
+class CachedUser:
+    '''
+    A stand-in for a ``User`` whose auth token was verified from the token
+    cache.
+
+    ``id`` and ``is_admin`` are available without a database query. Any other
+    attribute loads the full ``User`` from the database on first access.
+    '''
+
+    def __init__(self, id_, is_admin):
+        ''' Constructor. '''
+
+        self.id = id_
+        self.is_admin = is_admin
+        self._user = None
+
+    def __getattr__(self, name):
+        if self._user is None:
+            self._user = g.db.query(User).filter(User.id == self.id).one()
+
+        return getattr(self._user, name)
+
+
 def login_optional(original_function):
     '''
     A decorator that checks if a user is logged in.
@@ -86,15 +121,26 @@ def _get_user_from_request(required=True):
     else:
         xauth = None
 
+    user = _get_cached_user(xauth)
+
+    if xauth is not None:
+        count_metric('hgprofiler_cache_requests_total',
+                     cache='auth_token',
+                     result='miss' if user is None else 'hit')
+
+    if user is not None:
+        return user
+
     try:
         token = g.unsign(xauth).decode('ascii').split('|')
         user_id = int(token[0])
-        expires = dateutil.parser.parse(token[1])
+        expires = parse_token_expiry(token[1])
 
-        if expires < datetime.now():
+        if expires < time.time():
             raise ValueError()
 
         user = g.db.query(User).filter(User.id==user_id).one()
+        _cache_user(xauth, user, expires)
 
     except:
         if required:
@@ -103,3 +149,71 @@ def _get_user_from_request(required=True):
             user = None
 
     return user
+
+
+def parse_token_expiry(expires):
+    '''
+    Convert the expiry field of an auth token to a UNIX timestamp.
+
+    Tokens store their expiry as an integer UNIX timestamp. Tokens issued
+    before that change stored an ISO-8601 date, which is still accepted.
+    '''
+
+    if expires.isdigit():
+        return int(expires)
+    else:
+        return dateutil.parser.parse(expires).timestamp()
+
+
+def invalidate_user(user_id):
+    ''' Remove all cached auth tokens belonging to `user_id`. '''
+
+    with _token_cache_lock:
+        stale = [k for k, v in _token_cache.items() if v[0] == user_id]
+
+        for xauth in stale:
+            del _token_cache[xauth]
+
+
+def _cache_user(xauth, user, expires):
+    '''
+    Remember that `xauth` is a valid token for `user`.
+
+    The entry is kept until the token expires or for ``auth.token_cache_ttl``
+    seconds, whichever comes first. The TTL bounds how long other processes
+    can serve a stale role after a user is modified, since invalidate_user()
+    only clears the cache of the current process.
+    '''
+
+    if _token_cache_size <= 0:
+        return
+
+    cache_expires = min(expires, time.time() + _token_cache_ttl)
+
+    with _token_cache_lock:
+        _token_cache[xauth] = (user.id, user.is_admin, cache_expires)
+        _token_cache.move_to_end(xauth)
+
+        while len(_token_cache) > _token_cache_size:
+            _token_cache.popitem(last=False)
+
+
+def _get_cached_user(xauth):
+    ''' Return a CachedUser for `xauth`, or None if it is not cached. '''
+
+    if xauth is None:
+        return None
+
+    with _token_cache_lock:
+        try:
+            user_id, is_admin, cache_expires = _token_cache[xauth]
+        except KeyError:
+            return None
+
+        if cache_expires < time.time():
+            del _token_cache[xauth]
+            return None
+
+        _token_cache.move_to_end(xauth)
+
+    return CachedUser(user_id, is_admin)
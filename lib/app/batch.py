@@ -0,0 +1,216 @@
+'''
+Batches of username searches.
+
+A search request is stored as a batch and expanded into scrape jobs by a
+background planner (see worker.batch), so that the request returns as soon
+as the batch is stored. A batch is kept in two Redis keys:
+
+    batch.<id>            a hash with the fields below
+    batch.<id>.usernames  a list of "<tracker id> <username>" entries, in the
+                          order they are planned
+
+Each username also has its own progress tracker (see app.tracker). The hash
+has the following fields:
+
+    user_id     the user who submitted the batch
+    group_id    the site group to search, or empty
+    site_ids    comma separated IDs of the sites to search
+    test        1 if this is a test search
+    trace_id    the trace of the search request (see app.trace)
+    parent_id   the span of the search request
+    status      queued, planning, waiting (for admission, see app.admission),
+                planned or failed
+    planner     the ID of the batch's current planner job
+    usernames   number of usernames
+    planned     number of usernames that have been expanded into jobs
+    jobs        number of jobs queued so far
+    found       number of checks where the username was found
+    not_found   number of checks where the username was not found
+    error       number of checks that raised an error
+    created     UNIX timestamp when the batch was submitted
+    updated     UNIX timestamp of the most recent change
+
+All keys expire ``[redis_worker] tracker_ttl`` seconds after the batch was
+last updated.
+'''
+
+import time
+
+import app.config
+from app.tracker import STATUS_FIELDS
+
+
+_config = app.config.get_config()
+_batch_ttl = int(_config.get('redis_worker', 'tracker_ttl'))
+
+INT_FIELDS = ('user_id', 'usernames', 'planned', 'jobs', 'found',
+              'not_found', 'error', 'created', 'updated')
+
+
+def create_batch(redis, batch_id, user_id, entries, site_ids, group_id=None,
+                 test=False, trace=None, pipeline=None):
+    '''
+    Store a batch. `entries` is a list of ``(tracker_id, username)`` pairs.
+
+    If `pipeline` is given, the commands are queued on it and the caller is
+    responsible for executing it.
+    '''
+
+    now = int(time.time())
+    key = _key(batch_id)
+    usernames_key = key + '.usernames'
+    pipe = pipeline if pipeline is not None else redis.pipeline()
+
+    pipe.hmset(key, {
+        'user_id': user_id,
+        'group_id': '' if group_id is None else group_id,
+        'site_ids': ','.join(str(site_id) for site_id in site_ids),
+        'test': int(test),
+        'trace_id': trace['trace_id'] if trace else '',
+        'parent_id': trace['parent_id'] if trace else '',
+        'status': 'queued',
+        'planner': '',
+        'usernames': len(entries),
+        'planned': 0,
+        'jobs': 0,
+        'found': 0,
+        'not_found': 0,
+        'error': 0,
+        'created': now,
+        'updated': now,
+    })
+    pipe.rpush(usernames_key, *['{} {}'.format(tracker_id, username)
+                                for tracker_id, username in entries])
+    pipe.expire(key, _batch_ttl)
+    pipe.expire(usernames_key, _batch_ttl)
+
+    if pipeline is None:
+        pipe.execute()
+
+
+def get_batch(redis, batch_id):
+    '''
+    Return the batch as a dictionary, or None if it does not exist (or has
+    expired).
+
+    ``total`` is the number of jobs in the batch: those queued so far, plus
+    one per site for each username that hasn't been planned yet. ``current``
+    is the number of checks finished so far.
+    '''
+
+    batch = redis.hgetall(_key(batch_id))
+
+    if not batch:
+        return None
+
+    batch = {k.decode('utf8'): v.decode('utf8') for k, v in batch.items()}
+
+    for field in INT_FIELDS:
+        batch[field] = int(batch[field])
+
+    site_ids = batch['site_ids']
+    batch['site_ids'] = [int(i) for i in site_ids.split(',')] \
+        if site_ids else []
+    batch['group_id'] = int(batch['group_id']) if batch['group_id'] else None
+    batch['test'] = batch['test'] == '1'
+    unplanned = batch['usernames'] - batch['planned']
+    total = batch['jobs'] + unplanned * len(batch['site_ids'])
+    current = batch['found'] + batch['not_found'] + batch['error']
+
+    if batch['trace_id']:
+        trace = {'trace_id': batch['trace_id'],
+                 'parent_id': batch['parent_id']}
+    else:
+        trace = None
+
+    del batch['trace_id']
+    del batch['parent_id']
+
+    batch.update({
+        'id': batch_id,
+        'trace': trace,
+        'total': total,
+        'current': current,
+        'progress': current / total if total else None,
+    })
+
+    return batch
+
+
+def get_entries(redis, batch_id, start, count):
+    '''
+    Return up to `count` ``(tracker_id, username)`` pairs from the batch,
+    starting at index `start`.
+    '''
+
+    entries = redis.lrange(_key(batch_id) + '.usernames',
+                           start,
+                           start + count - 1)
+
+    return [tuple(entry.decode('utf8').split(' ', 1)) for entry in entries]
+
+
+def set_batch_status(redis, batch_id, status):
+    ''' Set the status of a batch. '''
+
+    key = _key(batch_id)
+    pipe = redis.pipeline(transaction=True)
+    pipe.hmset(key, {'status': status, 'updated': int(time.time())})
+    _expire(pipe, key)
+    pipe.execute()
+
+
+def add_planned(pipeline, batch_id, usernames, jobs):
+    '''
+    Queue commands on `pipeline` to record that `usernames` more usernames
+    have been expanded into `jobs` jobs.
+    '''
+
+    key = _key(batch_id)
+    pipeline.hincrby(key, 'planned', usernames)
+    pipeline.hincrby(key, 'jobs', jobs)
+    pipeline.hset(key, 'updated', int(time.time()))
+    _expire(pipeline, key)
+
+
+def set_planner(pipeline, batch_id, job_id):
+    '''
+    Queue a command on `pipeline` to make `job_id` the batch's planner job.
+    Only that job may plan the batch (see worker.batch), so a planner that
+    is run again after another one was queued does nothing.
+    '''
+
+    pipeline.hset(_key(batch_id), 'planner', job_id)
+
+
+def update_batch(redis, batch_id, status):
+    '''
+    Record a result with `status` ('f', 'n' or 'e') against the batch.
+
+    The update is executed in a single round trip.
+    '''
+
+    try:
+        field = STATUS_FIELDS[status]
+    except KeyError:
+        raise ValueError('Invalid result status: {}'.format(status))
+
+    key = _key(batch_id)
+    pipe = redis.pipeline(transaction=True)
+    pipe.hincrby(key, field, 1)
+    pipe.hset(key, 'updated', int(time.time()))
+    _expire(pipe, key)
+    pipe.execute()
+
+
+def _expire(pipeline, key):
+    ''' Queue commands to extend the lifetime of the batch at `key`. '''
+
+    pipeline.expire(key, _batch_ttl)
+    pipeline.expire(key + '.usernames', _batch_ttl)
+
+
+def _key(batch_id):
+    ''' Return the Redis key of the batch hash. '''
+
+    return 'batch.{}'.format(batch_id)
@@ -0,0 +1,43 @@
+'''
+The state of the worker fleet, as reported by the autoscaler.
+
+bin/autoscale.py starts and stops worker processes. After each adjustment it
+stores the fleet in the ``fleet`` Redis key as JSON, for example:
+
+    {
+        "updated": 1476867012,
+        "pools": {
+            "scrape": {
+                "min": 2, "max": 20, "target": 6, "running": 6,
+                "draining": 1, "backlog": 340, "reason": "backlog"
+            },
+            "archive": {...}
+        }
+    }
+
+The key expires if the autoscaler stops updating it.
+'''
+
+import json
+import time
+
+
+FLEET_KEY = 'fleet'
+
+
+def get_fleet(redis):
+    ''' Return the fleet as a dictionary, or None if there is no autoscaler. '''
+
+    fleet = redis.get(FLEET_KEY)
+
+    if fleet is None:
+        return None
+
+    return json.loads(fleet.decode('utf8'))
+
+
+def set_fleet(redis, pools, ttl):
+    ''' Store the state of the worker `pools` for `ttl` seconds. '''
+
+    fleet = {'updated': int(time.time()), 'pools': pools}
+    redis.set(FLEET_KEY, json.dumps(fleet), ex=ttl)
@@ -0,0 +1,411 @@
+'''
+Application metrics.
+
+Rolling histograms
+------------------
+
+Workers time the phases of each job (see worker.phase()) and add them to a
+histogram in Redis when the job finishes. Each job type has one Redis hash
+per minute, named ``metrics.<job type>.<minute>``, with these fields for
+each phase:
+
+    <phase>:count   number of timings
+    <phase>:sum     total seconds
+    <phase>:<i>     number of timings in bucket i of BUCKETS
+
+Hashes expire after ``[metrics] window_minutes``, so summing the hashes for
+the last N minutes gives a rolling histogram. The set ``metrics.jobs`` lists
+the job types that have been recorded.
+
+Exported metrics
+----------------
+
+API processes and workers also count events and observe durations for the
+metrics declared in METRICS, which are served in the Prometheus text format
+by MetricsView. Each process buffers its updates with count(), observe() and
+set_gauge(), and writes them to Redis with flush(): API processes flush
+after each request and workers after each job. Redis is the aggregation
+point, so no other service is needed.
+
+Counters and histograms are kept in the ``metrics.counters`` hash, which
+never expires. Gauges describe a single process, so each process writes its
+gauges to ``metrics.gauges.<host>:<pid>``, which expires if the process
+stops updating it.
+'''
+
+import bisect
+from collections import Counter
+import os
+import re
+import socket
+import threading
+import time
+
+import app.config
+
+
+_config = app.config.get_config()
+_window_minutes = int(_config.get('metrics', 'window_minutes'))
+
+JOBS_KEY = 'metrics.jobs'
+COUNTERS_KEY = 'metrics.counters'
+GAUGES_KEY_PREFIX = 'metrics.gauges.'
+GAUGES_TTL = 300
+
+# Exported metrics: name -> (type, help).
+METRICS = {
+    'hgprofiler_http_requests_total': (
+        'counter', 'API requests by endpoint and status.'),
+    'hgprofiler_http_request_duration_seconds': (
+        'histogram', 'API request latency by endpoint.'),
+    'hgprofiler_checks_total': (
+        'counter', 'Username checks by site and result status.'),
+    'hgprofiler_jobs_total': (
+        'counter', 'Background jobs by type and outcome.'),
+    'hgprofiler_job_phase_seconds': (
+        'histogram', 'Time spent in each phase of background jobs.'),
+    'hgprofiler_cache_requests_total': (
+        'counter', 'Cache lookups by cache and result (hit or miss).'),
+    'hgprofiler_db_pool_connections': (
+        'gauge', 'Database connections by process and state.'),
+    'hgprofiler_queue_length': (
+        'gauge', 'Jobs waiting in each queue.'),
+    'hgprofiler_workers': (
+        'gauge', 'Workers by state.'),
+}
+
+_pending = Counter()
+_gauges = dict()
+_pending_lock = threading.Lock()
+_process = '{}:{}'.format(socket.gethostname(), os.getpid())
+_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+# Upper bounds (in seconds) of the histogram buckets. Timings above the last
+# bound are counted in an extra overflow bucket.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60)
+
+
+def record_timings(redis, job_type, timings):
+    '''
+    Add `timings`, a dictionary of phase names to seconds, to the histograms
+    for `job_type`.
+
+    The update is executed in a single round trip.
+    '''
+
+    minute = int(time.time() // 60)
+    key = 'metrics.{}.{}'.format(job_type, minute)
+    pipe = redis.pipeline(transaction=False)
+
+    for phase, seconds in timings.items():
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        pipe.hincrby(key, '{}:count'.format(phase), 1)
+        pipe.hincrbyfloat(key, '{}:sum'.format(phase), seconds)
+        pipe.hincrby(key, '{}:{}'.format(phase, bucket), 1)
+
+    pipe.expire(key, (_window_minutes + 1) * 60)
+    pipe.sadd(JOBS_KEY, job_type)
+    pipe.execute()
+
+
+def get_metrics(redis, minutes=None):
+    '''
+    Return the histograms for the last `minutes` (by default, the whole
+    window) as a dictionary of job types to phase names to summaries. Each
+    summary has ``count``, ``mean``, ``p50``, ``p95`` and ``p99`` in
+    seconds, and ``buckets``, a list of ``[upper bound, count]`` pairs where
+    the overflow bucket's upper bound is None.
+
+    Percentiles are estimated as the upper bound of the bucket that contains
+    them, or the last bound if they fall in the overflow bucket.
+    '''
+
+    minutes = window(minutes)
+    now = int(time.time() // 60)
+    job_types = sorted(job.decode('utf8') for job in redis.smembers(JOBS_KEY))
+    pipe = redis.pipeline(transaction=False)
+
+    for job_type in job_types:
+        for minute in range(now - minutes + 1, now + 1):
+            pipe.hgetall('metrics.{}.{}'.format(job_type, minute))
+
+    hashes = iter(pipe.execute())
+    metrics = dict()
+
+    for job_type in job_types:
+        totals = dict()
+
+        for _ in range(minutes):
+            for field, value in next(hashes).items():
+                phase, _, name = field.decode('utf8').rpartition(':')
+                phase_totals = totals.setdefault(phase, {
+                    'count': 0,
+                    'sum': 0.0,
+                    'buckets': [0] * (len(BUCKETS) + 1),
+                })
+
+                if name == 'count':
+                    phase_totals['count'] += int(value)
+                elif name == 'sum':
+                    phase_totals['sum'] += float(value)
+                else:
+                    phase_totals['buckets'][int(name)] += int(value)
+
+        if len(totals) > 0:
+            metrics[job_type] = {
+                phase: _summarize(phase_totals)
+                for phase, phase_totals in totals.items()
+            }
+
+    return metrics
+
+
+def window(minutes=None):
+    '''
+    Return the number of minutes that get_metrics() reports for `minutes`:
+    the whole window if `minutes` is None, and at least 1.
+    '''
+
+    if minutes is None:
+        return _window_minutes
+
+    return max(1, min(minutes, _window_minutes))
+
+
+def _summarize(totals):
+    ''' Summarize the counts for one phase. '''
+
+    count = totals['count']
+    buckets = totals['buckets']
+    bounds = list(BUCKETS) + [None]
+
+    def percentile(p):
+        if count == 0:
+            return None
+
+        rank = count * p / 100
+        seen = 0
+
+        for bound, bucket_count in zip(BUCKETS, buckets):
+            seen += bucket_count
+
+            if seen >= rank:
+                return bound
+
+        return BUCKETS[-1]
+
+    return {
+        'count': count,
+        'mean': totals['sum'] / count if count else None,
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'p99': percentile(99),
+        'buckets': [[bound, bucket_count]
+                    for bound, bucket_count in zip(bounds, buckets)],
+    }
+
+
+def count(name, value=1, **labels):
+    '''
+    Add `value` to counter `name`. The update is buffered until flush().
+    '''
+
+    field = _field(name, labels)
+
+    with _pending_lock:
+        _pending[field] += value
+
+
+def observe(name, seconds, **labels):
+    '''
+    Add an observation of `seconds` to histogram `name`. The update is
+    buffered until flush().
+    '''
+
+    bucket = bisect.bisect_left(BUCKETS, seconds)
+
+    with _pending_lock:
+        _pending[_field(name, labels, 'count')] += 1
+        _pending[_field(name, labels, 'sum')] += seconds
+        _pending[_field(name, labels, str(bucket))] += 1
+
+
+def set_gauge(name, value, **labels):
+    '''
+    Set gauge `name` for this process. The update is buffered until flush().
+    '''
+
+    labels['process'] = _process
+
+    with _pending_lock:
+        _gauges[_field(name, labels)] = value
+
+
+def set_pool_gauges(engine):
+    ''' Set the database connection pool gauges for this process. '''
+
+    pool = engine.pool
+
+    if not hasattr(pool, 'checkedout'):
+        return
+
+    name = 'hgprofiler_db_pool_connections'
+    set_gauge(name, pool.size(), state='size')
+    set_gauge(name, pool.checkedout(), state='checked_out')
+    set_gauge(name, pool.checkedin(), state='idle')
+    set_gauge(name, max(0, pool.overflow()), state='overflow')
+
+
+def counter_totals(redis, name, label):
+    '''
+    Return the totals of counter `name` (as written by all processes),
+    grouped by the value of `label`.
+    '''
+
+    totals = dict()
+
+    for field, value in redis.hgetall(COUNTERS_KEY).items():
+        field_name, labels, _ = _parse_field(field.decode('utf8'))
+
+        if field_name != name:
+            continue
+
+        key = dict(_LABEL_RE.findall(labels)).get(label)
+        totals[key] = totals.get(key, 0) + float(value)
+
+    return totals
+
+
+def flush(redis):
+    ''' Write buffered metric updates to Redis in a single round trip. '''
+
+    global _pending
+
+    with _pending_lock:
+        pending = _pending
+        gauges = dict(_gauges)
+        _pending = Counter()
+
+    pipe = redis.pipeline(transaction=False)
+
+    for field, value in pending.items():
+        pipe.hincrbyfloat(COUNTERS_KEY, field, value)
+
+    if len(gauges) > 0:
+        gauges_key = GAUGES_KEY_PREFIX + _process
+        pipe.hmset(gauges_key, gauges)
+        pipe.expire(gauges_key, GAUGES_TTL)
+
+    pipe.execute()
+
+
+def prometheus_text(redis, gauges=None):
+    '''
+    Return all exported metrics in the Prometheus text exposition format.
+
+    `gauges` is an optional list of ``(name, value, labels)`` tuples for
+    gauges that are computed at scrape time, such as queue lengths.
+    '''
+
+    samples = dict()
+
+    def add(name, labels, suffix, value):
+        samples.setdefault(name, dict()) \
+               .setdefault(labels, dict())[suffix] = value
+
+    for field, value in redis.hgetall(COUNTERS_KEY).items():
+        name, labels, suffix = _parse_field(field.decode('utf8'))
+        add(name, labels, suffix, float(value))
+
+    for key in redis.scan_iter(GAUGES_KEY_PREFIX + '*'):
+        for field, value in redis.hgetall(key).items():
+            name, labels, suffix = _parse_field(field.decode('utf8'))
+            add(name, labels, suffix, float(value))
+
+    for name, value, labels in gauges or []:
+        add(name, _labels(labels), '', value)
+
+    lines = []
+
+    for name in sorted(samples):
+        type_, help_ = METRICS[name]
+        lines.append('# HELP {} {}'.format(name, help_))
+        lines.append('# TYPE {} {}'.format(name, type_))
+
+        for labels, values in sorted(samples[name].items()):
+            if type_ == 'histogram':
+                lines.extend(_histogram_lines(name, labels, values))
+            else:
+                lines.append(_sample(name, labels, values['']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _field(name, labels, suffix=''):
+    '''
+    Return the Redis hash field for a sample of metric `name` with `labels`.
+    `suffix` distinguishes the parts of a histogram.
+    '''
+
+    if name not in METRICS:
+        raise ValueError('Unknown metric: {}'.format(name))
+
+    return '{}|{}|{}'.format(name, _labels(labels), suffix)
+
+
+def _histogram_lines(name, labels, values):
+    ''' Return the sample lines for one histogram. '''
+
+    lines = []
+    cumulative = 0
+    bounds = [str(bound) for bound in BUCKETS] + ['+Inf']
+
+    for index, bound in enumerate(bounds):
+        cumulative += values.get(str(index), 0)
+        bucket_labels = ','.join(filter(None, [labels,
+                                               'le="{}"'.format(bound)]))
+        lines.append(_sample(name + '_bucket', bucket_labels, cumulative))
+
+    lines.append(_sample(name + '_sum', labels, values.get('sum', 0)))
+    lines.append(_sample(name + '_count', labels, values.get('count', 0)))
+
+    return lines
+
+
+def _labels(labels):
+    ''' Format a dictionary of labels, e.g. ``a="1",b="2"``. '''
+
+    return ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                                         .replace('"', '\\"')
+                                         .replace('\n', '\\n'))
+        for key, value in sorted(labels.items())
+    )
+
+
+def _parse_field(field):
+    ''' Split a Redis hash field into ``(name, labels, suffix)``. '''
+
+    name, _, rest = field.partition('|')
+    labels, _, suffix = rest.rpartition('|')
+
+    return name, labels, suffix
+
+
+def _sample(name, labels, value):
+    ''' Format a sample line. '''
+
+    if labels:
+        name = '{}{{{}}}'.format(name, labels)
+
+    return '{} {}'.format(name, _number(value))
+
+
+def _number(value):
+    ''' Format a sample value, dropping a redundant ".0". '''
+
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
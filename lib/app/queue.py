@@ -1,17 +1,24 @@
 ''' Message queues. '''
 
 from rq import Connection, Queue
+from rq.job import Job
 
+from app.admission import track_job
+from app.batch import set_planner
 import app.config
 import worker
+import worker.batch
 import worker.scrape
 import worker.archive
+import worker.retention
 
 _config = app.config.get_config()
 _redis = app.database.get_redis(dict(_config.items('redis')))
 _redis_worker = dict(_config.items('redis_worker'))
 _scrape_queue = Queue('scrape', connection=_redis)
 _archive_queue = Queue('archive', connection=_redis)
+_batch_queue = Queue('batch', connection=_redis)
+_retention_queue = Queue('retention', connection=_redis)
 
 
 def dummy_job():
@@ -51,14 +58,22 @@ def remove_unused_queues(redis):
                 redis.srem('rq:queues', 'rq:queue:{}'.format(queue.name))
 
 
-def schedule_username(username, site, group_id,
-                      total, tracker_id, test=False):
+def schedule_username(username, site, group_id, total, tracker_id,
+                      test=False, trace=None, user_id=None, batch_id=None,
+                      pipeline=None):
     '''
     Queue a job to fetch results for the specified username from the specified
     site.
 
     Keyword arguments:
     test -- don't archive, update site with result (default: False)
+    trace -- a dictionary with the search's ``trace_id`` and the ``parent_id``
+             of the span that queued this job (see app.trace)
+    user_id -- the user whose outstanding jobs include this one (see
+               app.admission.track_job())
+    batch_id -- the batch that this job belongs to (see app.batch)
+    pipeline -- if given, the job is queued with commands on this Redis
+                pipeline, and the caller is responsible for executing it
     '''
 
     kwargs = {
@@ -67,36 +82,122 @@ def schedule_username(username, site, group_id,
         'group_id': group_id,
         'total': total,
         'tracker_id': tracker_id,
-        'test': test
+        'test': test,
+        'trace': trace,
+        'user_id': user_id,
+        'batch_id': batch_id,
     }
 
-    job = _scrape_queue.enqueue_call(
-        func=worker.scrape.check_username,
-        kwargs=kwargs,
-        timeout=_redis_worker['username_timeout']
+    description = 'Checking {} for user "{}"'.format(site.name, username)
+
+    if pipeline is None:
+        job = _scrape_queue.enqueue_call(
+            func=worker.scrape.check_username,
+            kwargs=kwargs,
+            timeout=_redis_worker['username_timeout']
+        )
+    else:
+        job = Job.create(
+            worker.scrape.check_username,
+            kwargs=kwargs,
+            connection=_redis,
+            timeout=_redis_worker['username_timeout']
+        )
+        _scrape_queue.enqueue_job(job, pipeline=pipeline)
+
+    if user_id is not None:
+        track_job(pipeline or _redis, user_id, job.id)
+
+    worker.init_job(job=job, description=description, trace=trace,
+                    pipeline=pipeline)
+
+    return job.id
+
+
+def schedule_batch(batch_id, trace=None, pipeline=None):
+    '''
+    Queue a job to expand the next usernames of a batch into scrape jobs, and
+    make it the batch's planner.
+
+    Planners have their own queue, so that searches are not held up behind
+    archive jobs. `trace` and `pipeline` are as for schedule_username().
+    '''
+
+    job = Job.create(
+        worker.batch.plan_batch,
+        args=[batch_id],
+        kwargs={'trace': trace},
+        connection=_redis,
+        timeout=_redis_worker['batch_timeout']
     )
+    pipe = pipeline if pipeline is not None else _redis.pipeline()
+    _batch_queue.enqueue_job(job, pipeline=pipe)
+    set_planner(pipe, batch_id, job.id)
 
-    description = 'Checking {} for user "{}"'.format(site.name, username)
+    description = 'Planning search batch {}'.format(batch_id)
 
-    worker.init_job(job=job, description=description)
+    worker.init_job(job=job, description=description, trace=trace,
+                    pipeline=pipe)
+
+    if pipeline is None:
+        pipe.execute()
 
     return job.id
 
 
-def schedule_archive(username, group_id, tracker_id):
-    ''' Queue a job to archive results for the job id. '''
+def schedule_archive(username, group_id, tracker_id, trace=None):
+    '''
+    Queue a job to archive results for the job id.
+
+    `trace` is as for schedule_username().
+    '''
 
     job = _archive_queue.enqueue_call(
         func=worker.archive.create_archive,
         args=[username, group_id, tracker_id],
+        kwargs={'trace': trace},
         timeout=_redis_worker['archive_timeout']
     )
 
     description = 'Archiving results for username "{}"'.format(username)
 
+    worker.init_job(job=job, description=description, trace=trace)
+
+
+def schedule_zip(archive):
+    ''' Queue a job to store the zip file for an archive. '''
+
+    job = _archive_queue.enqueue_call(
+        func=worker.archive.create_zip,
+        args=[archive.id],
+        timeout=_redis_worker['archive_timeout']
+    )
+
+    description = 'Storing zip file for username "{}"'.format(
+        archive.username
+    )
+
     worker.init_job(job=job, description=description)
 
 
+def schedule_retention():
+    '''
+    Queue a job to delete old searches and unused files.
+
+    Retention can run for up to an hour, so it has its own queue and worker
+    rather than holding up archive jobs.
+    '''
+
+    job = _retention_queue.enqueue_call(
+        func=worker.retention.run_retention,
+        timeout=_redis_worker['retention_timeout']
+    )
+
+    worker.init_job(job=job, description='Applying retention policies')
+
+    return job.id
+
+
 def schedule_site_test(site, tracker_id):
     '''
     Queue a job to test a site.
@@ -1,7 +1,47 @@
 ''' Utility functions for the REST API. '''
-from flask import url_for as flask_url_for
+import os
+
+from flask import request, Response, url_for as flask_url_for
 from sqlalchemy import case, extract, func
-from werkzeug.exceptions import BadRequest
+import ujson
+from werkzeug.exceptions import (BadRequest,
+                                 NotFound,
+                                 RequestedRangeNotSatisfiable)
+
+import app.config
+from helper.blob import get_store
+from helper.functions import get_path
+
+
+# Blobs never change, so clients may cache them for a year.
+BLOB_MAX_AGE = 31536000
+
+_config = app.config.get_config()
+_offload = _config.get('file_serving', 'offload')
+_accel_prefix = _config.get('file_serving', 'accel_redirect_prefix')
+
+
+class RangeNotSatisfiable(RequestedRangeNotSatisfiable):
+    '''
+    416 Requested Range Not Satisfiable, with a ``Content-Range`` header
+    giving the entity's length. Older Werkzeug versions can't add the header
+    themselves.
+    '''
+
+    def __init__(self, entity_length):
+        ''' Constructor. '''
+
+        super().__init__()
+        self.entity_length = entity_length
+
+    def get_headers(self, environ=None):
+        ''' Add a ``Content-Range`` header. '''
+
+        headers = super().get_headers(environ)
+        headers.append(('Content-Range',
+                        'bytes */{}'.format(self.entity_length)))
+
+        return headers
 
 
 def get_int_arg(name, arg, optional=False):
@@ -18,6 +58,30 @@ def get_int_arg(name, arg, optional=False):
     return arg
 
 
+def get_expand_arguments(args, allowed_fields):
+    '''
+    Get the set of fields to expand from the ``expand`` URL argument.
+
+    ``expand`` is a comma-separated list of names, each of which must be in
+    ``allowed_fields``.
+    '''
+
+    expand = args.get('expand', '').strip()
+
+    if expand == '':
+        return set()
+
+    fields = {field.strip() for field in expand.split(',')}
+    invalid = fields - set(allowed_fields)
+
+    if len(invalid) > 0:
+        raise BadRequest('Invalid expand field(s): {}. Allowed: {}.'.format(
+            ','.join(sorted(invalid)), ','.join(sorted(allowed_fields))
+        ))
+
+    return fields
+
+
 def get_paging_arguments(args):
     ''' Get a standard pair of paging arguments from a request.args object. '''
 
@@ -75,6 +139,160 @@ def get_sort_arguments(args, default, allowed_fields):
     return sort_columns
 
 
+def json_list_response(list_name, items, chunk_size=100, **fields):
+    '''
+    Return a streamed JSON response containing the list `items` under the key
+    `list_name`, plus any additional top-level `fields`.
+
+    This is a faster alternative to ``jsonify()`` for large lists: items are
+    encoded with ujson and sent in chunks of `chunk_size` items, so the full
+    response body is never built in memory.
+
+    `items` should already be materialized (e.g. a list of dicts), since the
+    response body is generated after the request's database session closes.
+    '''
+
+    def generate():
+        head = ujson.dumps(fields)[:-1]
+
+        if len(fields) > 0:
+            head += ','
+
+        yield '{}"{}":['.format(head, list_name)
+
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+            separator = ',' if start > 0 else ''
+            yield separator + ','.join(ujson.dumps(item) for item in chunk)
+
+        yield ']}'
+
+    return Response(generate(), mimetype='application/json')
+
+
+def send_blob(key, mimetype, as_attachment=False, attachment_filename=None,
+              immutable=True):
+    '''
+    Return a response containing the blob with `key` (see helper.blob).
+
+    Blobs are immutable, so the key is used as a strong ETag and, if
+    `immutable` is True, clients may cache the response forever. Single byte
+    ranges are supported, so that large downloads can be resumed.
+
+    If ``[file_serving] offload`` is set, blobs stored in a file of their own
+    are sent by the web server (using ``X-Sendfile`` or
+    ``X-Accel-Redirect``), which then also handles ranges.
+    '''
+
+    if immutable:
+        cache_control = 'private, max-age={}, immutable'.format(BLOB_MAX_AGE)
+    else:
+        cache_control = 'private, no-cache'
+
+    if request.if_none_match.contains(key):
+        response = Response(status=304)
+        response.set_etag(key)
+        response.headers['Cache-Control'] = cache_control
+        return response
+
+    store = get_store()
+    path = store.path(key)
+    response = None
+
+    if path is not None and _offload == 'x-sendfile':
+        response = Response(mimetype=mimetype)
+        response.headers['X-Sendfile'] = path
+    elif path is not None and _offload == 'x-accel-redirect':
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = _accel_prefix + \
+            os.path.relpath(path, get_path('data'))
+    else:
+        try:
+            if path is not None:
+                length = os.path.getsize(path)
+            else:
+                content = store.read(key)
+                length = len(content)
+        except FileNotFoundError:
+            raise NotFound('File content is missing.')
+
+        byte_range = _get_byte_range(key, length)
+
+        if byte_range is None:
+            start, stop = 0, length
+            status = 200
+        else:
+            start, stop = byte_range
+            status = 206
+
+        if path is not None:
+            body = _iter_file(path, start, stop)
+        else:
+            body = content[start:stop]
+
+        response = Response(body, status=status, mimetype=mimetype)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['Content-Length'] = str(stop - start)
+
+        if status == 206:
+            response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, stop - 1, length
+            )
+
+    if as_attachment:
+        response.headers['Content-Disposition'] = \
+            'attachment; filename="{}"'.format(attachment_filename)
+
+    response.set_etag(key)
+    response.headers['Cache-Control'] = cache_control
+
+    return response
+
+
+def _get_byte_range(etag, length):
+    '''
+    Return the ``(start, stop)`` of the byte range requested for an entity
+    with `etag` and `length`, or None to send the whole entity.
+
+    Raises RangeNotSatisfiable if the range is invalid.
+    '''
+
+    byte_range = request.range
+
+    if byte_range is None or len(byte_range.ranges) != 1:
+        return None
+
+    # If-Range: only send part of the entity if the client has the rest.
+    if_range = request.headers.get('If-Range')
+
+    if if_range is not None and if_range != '"{}"'.format(etag):
+        return None
+
+    range_ = byte_range.range_for_length(length)
+
+    if range_ is None:
+        raise RangeNotSatisfiable(length)
+
+    return range_
+
+
+def _iter_file(path, start, stop, chunk_size=65536):
+    ''' Generate the bytes of the file at `path` from `start` to `stop`. '''
+
+    with open(path, 'rb') as file_:
+        file_.seek(start)
+        remaining = stop - start
+
+        while remaining > 0:
+            chunk = file_.read(min(chunk_size, remaining))
+
+            if not chunk:
+                break
+
+            remaining -= len(chunk)
+            yield chunk
+
+
 def isodate(datetime_):
     ''' Convert datetime to ISO-8601 without microseconds. '''
     return datetime_.replace(microsecond=0).isoformat()
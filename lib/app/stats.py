@@ -0,0 +1,57 @@
+'''
+Cached aggregate statistics.
+
+Aggregates are computed with a single query and cached in Redis until the
+underlying data changes. Anything that modifies the data must call the
+matching invalidate_*() function.
+'''
+
+from sqlalchemy import case, func
+
+from app.metrics import count as count_metric
+from model import Site
+
+
+SITE_STATS_KEY = 'stats.site'
+SITE_STATS_TTL = 3600
+
+
+def get_site_stats(db, redis):
+    '''
+    Return site counts as a dictionary with keys ``total_count``,
+    ``total_valid_count``, ``total_invalid_count`` and ``total_tested_count``.
+    '''
+
+    cached = redis.hgetall(SITE_STATS_KEY)
+    count_metric('hgprofiler_cache_requests_total',
+                 cache='site_stats',
+                 result='hit' if cached else 'miss')
+
+    if cached:
+        return {k.decode('ascii'): int(v) for k, v in cached.items()}
+
+    total, valid, tested = db.query(
+        func.count(Site.id),
+        func.sum(case([(Site.valid == True, 1)], else_=0)), # noqa
+        func.sum(case([(Site.tested_at != None, 1)], else_=0)), # noqa
+    ).one()
+
+    stats = {
+        'total_count': total,
+        'total_valid_count': valid or 0,
+        'total_invalid_count': total - (valid or 0),
+        'total_tested_count': tested or 0,
+    }
+
+    pipe = redis.pipeline()
+    pipe.hmset(SITE_STATS_KEY, stats)
+    pipe.expire(SITE_STATS_KEY, SITE_STATS_TTL)
+    pipe.execute()
+
+    return stats
+
+
+def invalidate_site_stats(redis):
+    ''' Discard cached site statistics. '''
+
+    redis.delete(SITE_STATS_KEY)
@@ -0,0 +1,143 @@
+'''
+Tracing for username searches.
+
+Each search gets a trace ID when it is submitted (see UsernameView.post). The
+ID is carried in the metadata of every job that the search causes, along
+with the ID of the span that queued the job, so the spans form a tree:
+
+    search                      (the API request)
+      check_username            (one per site, span ID = job ID)
+        queue_wait, splash_render, html_parse, ...
+        create_archive          (queued by check_username)
+          queue_wait, counts, lock, ...
+
+Spans are appended as JSON lines to ``[trace] span_file``, with keys
+``trace_id``, ``span_id``, ``parent_id``, ``name``, ``start`` and ``end``
+(UNIX timestamps) and ``attributes``. Use bin/trace.py to print a trace and
+its critical path. The span file is opened for each write, so it can be
+rotated by renaming it.
+
+Log records get a ``trace_id`` attribute from TraceLogFilter, so that the
+log lines of a search can be found by its trace ID.
+'''
+
+import fcntl
+import gzip
+import json
+import logging
+import uuid
+
+import app.config
+
+
+_config = app.config.get_config()
+_span_file = _config.get('trace', 'span_file')
+
+if _span_file != '':
+    _span_file = app.config.get_path(_span_file)
+
+
+class TraceLogFilter(logging.Filter):
+    '''
+    Adds the current trace ID (or ``-`` if there is none) to log records as
+    ``trace_id``. `get_trace_id` is a function that returns the current trace
+    ID, or None.
+    '''
+
+    def __init__(self, get_trace_id):
+        ''' Constructor. '''
+
+        super().__init__()
+        self._get_trace_id = get_trace_id
+
+    def filter(self, record):
+        record.trace_id = self._get_trace_id() or '-'
+        return True
+
+
+def new_trace_id():
+    ''' Return a new trace ID. '''
+
+    return uuid.uuid4().hex
+
+
+def new_span_id():
+    ''' Return a new span ID. '''
+
+    return uuid.uuid4().hex[:16]
+
+
+def span(trace_id, span_id, parent_id, name, start, end, **attributes):
+    ''' Return a span as a dictionary. '''
+
+    return {
+        'trace_id': trace_id,
+        'span_id': span_id,
+        'parent_id': parent_id,
+        'name': name,
+        'start': start,
+        'end': end,
+        'attributes': attributes,
+    }
+
+
+def tracing_enabled():
+    ''' Return True if spans are written anywhere. '''
+
+    return _span_file != ''
+
+
+def write_spans(spans):
+    '''
+    Append `spans` to the span file, if there is one.
+
+    The spans are written with a single write under an exclusive lock, so
+    that spans from concurrent processes are not interleaved.
+    '''
+
+    if _span_file == '' or len(spans) == 0:
+        return
+
+    data = ''.join(json.dumps(s) + '\n' for s in spans)
+
+    with open(_span_file, 'a') as span_file:
+        fcntl.flock(span_file, fcntl.LOCK_EX)
+
+        try:
+            span_file.write(data)
+            span_file.flush()
+        finally:
+            fcntl.flock(span_file, fcntl.LOCK_UN)
+
+
+def read_trace(trace_id, paths=None):
+    '''
+    Return the spans for `trace_id` from the span file, or from the files in
+    `paths` (which may be gzipped, e.g. by logrotate).
+
+    Each file is read in full, so keep the span file small by rotating it.
+    Only lines that contain the trace ID are parsed.
+    '''
+
+    spans = []
+
+    for path in paths or [_span_file]:
+        if path.endswith('.gz'):
+            span_file = gzip.open(path, 'rt')
+        else:
+            span_file = open(path)
+
+        with span_file:
+            for line in span_file:
+                if trace_id not in line:
+                    continue
+
+                try:
+                    span_ = json.loads(line)
+                except ValueError:
+                    continue
+
+                if span_['trace_id'] == trace_id:
+                    spans.append(span_)
+
+    return spans
@@ -0,0 +1,135 @@
+'''
+Progress trackers for username searches.
+
+Each search is identified by a tracker ID. Progress for that search is kept in
+a single Redis hash so that it can be read in O(1) without scanning RQ jobs or
+result rows. The hash has the following fields:
+
+    total      number of sites that will be checked
+    found      number of sites where the username was found
+    not_found  number of sites where the username was not found
+    error      number of sites that raised an error
+    started    UNIX timestamp when the search was submitted
+    updated    UNIX timestamp of the most recent result
+
+Tracker IDs are ``tracker.`` followed by 10 random letters and digits (see
+helper.functions.random_string()), optionally with a ``-1`` or ``-2``
+suffix for the two halves of a site test.
+'''
+
+import re
+import time
+
+import app.config
+
+
+_config = app.config.get_config()
+_tracker_ttl = int(_config.get('redis_worker', 'tracker_ttl'))
+
+TRACKER_ID_RE = re.compile(r'tracker\.[A-Za-z0-9]{10}(-[12])?')
+
+STATUS_FIELDS = {
+    'f': 'found',
+    'n': 'not_found',
+    'e': 'error',
+}
+
+
+def init_tracker(redis, tracker_id, total, pipeline=None):
+    '''
+    Create the progress hash for `tracker_id`.
+
+    If `pipeline` is given, the commands are queued on it and the caller is
+    responsible for executing it.
+    '''
+
+    now = int(time.time())
+    pipe = pipeline if pipeline is not None else redis.pipeline()
+
+    pipe.hmset(tracker_id, {
+        'total': total,
+        'found': 0,
+        'not_found': 0,
+        'error': 0,
+        'started': now,
+        'updated': now,
+    })
+    pipe.expire(tracker_id, _tracker_ttl)
+
+    if pipeline is None:
+        pipe.execute()
+
+
+def update_tracker(redis, tracker_id, status):
+    '''
+    Record a result with `status` ('f', 'n' or 'e') against `tracker_id`.
+
+    The update is executed atomically in a single round trip. Returns the
+    tracker as a dictionary (see get_tracker()).
+    '''
+
+    try:
+        field = STATUS_FIELDS[status]
+    except KeyError:
+        raise ValueError('Invalid result status: {}'.format(status))
+
+    pipe = redis.pipeline(transaction=True)
+    pipe.hincrby(tracker_id, field, 1)
+    pipe.hset(tracker_id, 'updated', int(time.time()))
+    pipe.expire(tracker_id, _tracker_ttl)
+    pipe.hgetall(tracker_id)
+    tracker = pipe.execute()[-1]
+
+    return _tracker_dict(tracker_id, tracker)
+
+
+def get_tracker(redis, tracker_id):
+    '''
+    Return the progress for `tracker_id` as a dictionary, or None if the
+    tracker does not exist (or has expired), or if `tracker_id` is not a
+    tracker ID at all.
+    '''
+
+    if not is_tracker_id(tracker_id):
+        return None
+
+    tracker = redis.hgetall(tracker_id)
+
+    if not tracker:
+        return None
+
+    return _tracker_dict(tracker_id, tracker)
+
+
+def is_tracker_id(tracker_id):
+    '''
+    Return True if `tracker_id` is a well-formed tracker ID.
+
+    Tracker IDs are used as Redis keys, so IDs supplied by clients must be
+    checked before they are used, or clients could read arbitrary keys.
+    '''
+
+    return TRACKER_ID_RE.fullmatch(tracker_id) is not None
+
+
+def _tracker_dict(tracker_id, tracker):
+    ''' Convert a raw Redis hash into a tracker dictionary. '''
+
+    tracker = {k.decode('ascii'): int(v) for k, v in tracker.items()}
+    total = tracker.get('total', 0)
+    found = tracker.get('found', 0)
+    not_found = tracker.get('not_found', 0)
+    error = tracker.get('error', 0)
+    current = found + not_found + error
+
+    return {
+        'id': tracker_id,
+        'total': total,
+        'current': current,
+        'found': found,
+        'not_found': not_found,
+        'error': error,
+        'progress': current / total if total else None,
+        'started': tracker.get('started'),
+        'updated': tracker.get('updated'),
+    }
@@ -1,18 +1,25 @@
-import json
-from flask import g, jsonify, request
-from flask.ext.classy import FlaskView
+from flask import g, jsonify, request, Response
+from flask.ext.classy import FlaskView, route
 from werkzeug.exceptions import BadRequest, NotFound
 from sqlalchemy.exc import IntegrityError
 
 import app.config
+import app.queue
 from app.authorization import login_required
 from app.notify import notify_mask_client
 from app.rest import (get_int_arg,
                       get_paging_arguments,
+                      json_list_response,
+                      send_blob,
                       validate_request_json,
                       validate_json_attr)
 from model import Archive
-import worker
+from model.archive import archive_row_dict, archive_row_query
+from model.file import iter_zip, release_file
+import worker.archive
+
+_config = app.config.get_config()
+_cache_zip_downloads = int(_config.get('archive', 'cache_zip_downloads'))
 
 
 class ArchiveView(FlaskView):
@@ -41,7 +48,10 @@ class ArchiveView(FlaskView):
                         "found_count": 65,
                         "not_found_count": 101,
                         "error_count": 9,
-                        "zip_file": "bob-2298d96a-653d-42f2-b6d3-73ff337d51ce.zip"
+                        "zip_file_id": null,
+                        "zip_file_url": "/api/archive/1/download",
+                        "contact_sheet_url": "/api/file/12",
+                        "contact_sheet_map_url": "/api/file/13"
                     },
                     ...
                 ],
@@ -66,7 +76,15 @@ class ArchiveView(FlaskView):
         match
         :>json str archives[n].error_count: the number sites in this archive that raised an error
         while searching for username
-        :>json str archives[n].zip_file: the zip file location for this archive
+        :>json int archives[n].zip_file_id: the id of the stored zip file for
+            this archive, or null if it is generated on download
+        :>json str archives[n].zip_file_url: the URL to download the zip file
+            for this archive
+        :>json str archives[n].contact_sheet_url: the URL of a single image
+            with all of this archive's screenshots, or null (see ``[archive]
+            contact_sheet``)
+        :>json str archives[n].contact_sheet_map_url: the URL of a JSON file
+            that maps contact sheet tiles to results, or null
 
         :status 200: ok
         :status 400: invalid argument[s]
@@ -76,7 +94,7 @@ class ArchiveView(FlaskView):
         page, results_per_page = get_paging_arguments(request.args)
         username = request.args.get('username', '')
 
-        query = g.db.query(Archive)
+        query = archive_row_query(g.db)
 
         if username:
             query = query.filter(Archive.username==username)
@@ -87,13 +105,11 @@ class ArchiveView(FlaskView):
                      .limit(results_per_page) \
                      .offset((page - 1) * results_per_page)
 
-        archives = list()
-
-        for archive in query:
-            archives.append(archive.as_dict())
+        archives = [archive_row_dict(row) for row in query]
 
-        return jsonify(
-            archives=archives,
+        return json_list_response(
+            'archives',
+            archives,
             total_count=total_count
         )
 
@@ -103,6 +119,64 @@ class ArchiveView(FlaskView):
         '''
         raise BadRequest('Endpoint not configured')
 
+    @route('/<id_>/download')
+    def download(self, id_):
+        '''
+        Download the zip file for the archive identified by `id_`.
+
+        The zip file is generated while it is sent, so the response is
+        chunked and has no ``Content-Length``. Archives that are downloaded
+        frequently have their zip file stored (see ``[archive]
+        cache_zip_downloads``), which is then served directly.
+
+        :<header X-Auth: the client's auth token
+
+        :>header Content-Type: application/zip
+
+        :status 200: ok
+        :status 401: authentication required
+        :status 404: archive does not exist
+        '''
+
+        id_ = get_int_arg('id_', id_)
+        archive = g.db.query(Archive).filter(Archive.id == id_).first()
+
+        if archive is None:
+            raise NotFound("Archive '%s' does not exist." % id_)
+
+        filename = '{}.zip'.format(
+            worker.archive.archive_filename(archive.username)
+        )
+
+        if archive.zip_file is not None:
+            return send_blob(
+                archive.zip_file.blob_key(),
+                mimetype='application/zip',
+                as_attachment=True,
+                attachment_filename=filename,
+                immutable=False
+            )
+
+        if _cache_zip_downloads > 0:
+            downloads_key = 'archive.downloads.{}'.format(archive.id)
+            pipe = g.redis.pipeline()
+            pipe.incr(downloads_key)
+            pipe.expire(downloads_key, 86400)
+            downloads = pipe.execute()[0]
+
+            if downloads == _cache_zip_downloads:
+                app.queue.schedule_zip(archive)
+
+        # Select the members now: the body is generated after the request's
+        # database session is closed.
+        files, str_files = worker.archive.zip_members(g.db, archive)
+        response = Response(iter_zip(files, str_files),
+                            mimetype='application/zip')
+        response.headers['Content-Disposition'] = \
+            'attachment; filename="{}"'.format(filename)
+
+        return response
+
     def delete(self, id_):
         '''
         Delete archive identified by `id_`.
@@ -116,7 +190,17 @@ class ArchiveView(FlaskView):
 
         # Delete site
         try:
+            files = [file_ for file_ in (archive.zip_file,
+                                         archive.contact_sheet_file,
+                                         archive.contact_sheet_map_file)
+                     if file_ is not None]
             g.db.delete(archive)
+            g.db.flush()
+
+            # Release in hash order, like model.file.release_files().
+            for file_ in sorted(files, key=lambda f: bytes(f.hash)):
+                release_file(g.db, file_)
+
             g.db.commit()
         except IntegrityError:
             g.db.rollback()
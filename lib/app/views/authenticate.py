@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta
+import time
 
 from flask import g, json, jsonify, render_template, request
 from flask.ext.classy import FlaskView, route
@@ -101,11 +101,11 @@ class AuthenticationView(FlaskView):
             if not check_password(request_json['password'], user.password_hash):
                 raise AuthenticationFailure()
 
-            expires = (datetime.now() + timedelta(hours=24)).isoformat()
+            expires = int(time.time()) + 24 * 60 * 60
 
             return jsonify(
                 message='Authentication is successful.',
-                token=g.sign('%d|%s' % (user.id, expires))
+                token=g.sign('%d|%d' % (user.id, expires))
             )
 
         except KeyError as ke:
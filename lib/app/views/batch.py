@@ -0,0 +1,78 @@
+from flask import g, jsonify
+from flask.ext.classy import FlaskView
+from werkzeug.exceptions import NotFound
+
+from app.authorization import login_required
+from app.batch import get_batch
+
+
+class BatchView(FlaskView):
+    '''
+    Progress of batches of username searches.
+    '''
+
+    decorators = [login_required]
+
+    def get(self, id_):
+        '''
+        Get progress for the batch identified by `id_`.
+
+        **Example Response**
+
+        .. sourcecode:: json
+
+            {
+                "id": "a8Bc7dE0fG",
+                "status": "planning",
+                "usernames": 5000,
+                "planned": 1250,
+                "jobs": 150000,
+                "total": 600000,
+                "current": 43210,
+                "found": 2103,
+                "not_found": 40977,
+                "error": 130,
+                "progress": 0.07201666666666667,
+                "group_id": 3,
+                "created": 1453219200,
+                "updated": 1453219262
+            }
+
+        :<header Content-Type: application/json
+        :<header X-Auth: the client's auth token
+
+        :>header Content-Type: application/json
+        :>json str id: the batch ID
+        :>json str status: ``queued``, ``planning``, ``waiting`` (until
+            the user's outstanding jobs or the scrape queue leave room for
+            more, see app.admission), ``planned`` (all jobs have been queued)
+            or ``failed``
+        :>json int usernames: the number of usernames in the batch
+        :>json int planned: the number of usernames whose jobs have been
+            queued
+        :>json int jobs: the number of jobs queued so far
+        :>json int total: the number of checks in the batch
+        :>json int current: the number of checks finished so far
+        :>json int found: the number of checks where the username was found
+        :>json int not_found: the number of checks where the username was
+            not found
+        :>json int error: the number of checks that raised an error
+        :>json float progress: `current` / `total`, expressed as a decimal
+        :>json int group_id: the site group searched, or null
+        :>json int created: UNIX timestamp when the batch was submitted
+        :>json int updated: UNIX timestamp of the most recent change
+
+        :status 200: ok
+        :status 401: authentication required
+        :status 404: no batch with that ID (or it has expired)
+        '''
+
+        batch = get_batch(g.redis, id_)
+
+        if batch is None:
+            raise NotFound("Batch '%s' does not exist." % id_)
+
+        for field in ('planner', 'site_ids', 'test', 'trace', 'user_id'):
+            del batch[field]
+
+        return jsonify(**batch)
@@ -1,13 +1,11 @@
-import os
-from flask import g, send_from_directory, jsonify
-from flask.ext.classy import FlaskView
+from flask import g, jsonify
+from flask.ext.classy import FlaskView, route
 from werkzeug.exceptions import NotFound, BadRequest
 
-import app.config
 from app.authorization import login_required, admin_required
-from app.config import get_path
-from app.rest import get_int_arg
+from app.rest import get_int_arg, send_blob
 from model import File
+from model.file import get_variant, IMAGE_VARIANTS, release_file
 
 
 class FileView(FlaskView):
@@ -19,35 +17,70 @@ class FileView(FlaskView):
         '''
         Get a file identified by ``id_``.
 
+        Responses have a strong ``ETag`` and may be cached forever, since
+        file contents never change. Single byte ranges are supported.
+
         :status 200: ok
+        :status 206: partial content
+        :status 304: not modified
         :status 401: authentication required
         :status 404: no file with that ID
+        :status 416: requested range not satisfiable
         '''
 
         file_ = g.db.query(File).filter(File.id == id_).first()
-        data_dir = get_path('data')
-        cache_timeout = 0 if g.debug else None
 
         if file_ is None:
             raise NotFound('No file exists with id={}'.format(id_))
 
         if file_.mime == 'application/zip':
-            return send_from_directory(
-                data_dir,
-                file_.relpath(),
+            return send_blob(
+                file_.blob_key(),
                 mimetype=file_.mime,
                 as_attachment=True,
                 attachment_filename=file_.name,
-                cache_timeout=cache_timeout
+                immutable=not g.debug
             )
         else:
-            return send_from_directory(
-                data_dir,
-                file_.relpath(),
+            return send_blob(
+                file_.blob_key(),
                 mimetype=file_.mime,
-                cache_timeout=cache_timeout
+                immutable=not g.debug
             )
 
+    @route('/<id_>/<variant>')
+    def get_variant(self, id_, variant):
+        '''
+        Get the `variant` of an image file identified by ``id_``, e.g.
+        ``/api/file/1/thumb``. See ``model.file.IMAGE_VARIANTS`` for the
+        available variants.
+
+        The variant is generated the first time it is requested.
+
+        :status 200: ok
+        :status 400: invalid ID or unknown variant, or the file is not an
+            image
+        :status 401: authentication required
+        :status 404: no file with that ID
+        '''
+
+        id_ = get_int_arg('id_', id_)
+        file_ = g.db.query(File).filter(File.id == id_).first()
+
+        if file_ is None:
+            raise NotFound('No file exists with id={}'.format(id_))
+
+        try:
+            key = get_variant(file_, variant)
+        except ValueError as e:
+            raise BadRequest(str(e))
+
+        return send_blob(
+            key,
+            mimetype=IMAGE_VARIANTS[variant]['mime'],
+            immutable=not g.debug
+        )
+
     @admin_required
     def delete(self, id_):
         '''
@@ -56,29 +89,24 @@ class FileView(FlaskView):
         # Get site.
         id_ = get_int_arg('id_', id_)
         file_ = g.db.query(File).filter(File.id == id_).first()
-        data_dir = app.config.get_path("data")
 
         if file_ is None:
             raise NotFound("File '%s' does not exist." % id_)
 
-
-        # Get filesystem path
-        relpath = file_.relpath()
-        file_object_path = os.path.join(data_dir, relpath)
-
-        # Delete db file record
+        # Delete db file record. The content (and variants) are removed from
+        # the blob store after the commit.
         try:
-            g.db.delete(file_)
-            g.db.commit()
+            deleted = release_file(g.db, file_)
         except Exception as e:
             g.db.rollback()
             raise BadRequest(e)
 
-        # Delete file from filesystem
-        if os.path.isfile(file_object_path):
-            os.unlink(file_object_path)
-
+        if not deleted:
+            g.db.rollback()
+            raise BadRequest('File id "{}" is shared with other results and '
+                             'cannot be deleted.'.format(id_))
 
+        g.db.commit()
 
         message = 'File id "{}" deleted'.format(id_)
         response = jsonify(message=message)
@@ -2,6 +2,7 @@ import json
 from flask import g, jsonify, request
 from flask.ext.classy import FlaskView
 from sqlalchemy.exc import IntegrityError, DBAPIError
+from sqlalchemy.orm import subqueryload
 from werkzeug.exceptions import BadRequest, NotFound
 
 import worker
@@ -9,12 +10,14 @@ import app.config
 import app.queue
 from app.authorization import login_required
 from app.notify import notify_mask_client
-from app.rest import (get_int_arg,
+from app.rest import (get_expand_arguments,
+                      get_int_arg,
                       url_for,
                       get_paging_arguments,
+                      json_list_response,
                       validate_request_json,
                       validate_json_attr)
-from model.group import Group
+from model.group import Group, group_site_query
 from model.site import Site
 
 # Dictionary of group attributes used for validation of json POST/PUT requests
@@ -57,6 +60,8 @@ class GroupView(FlaskView):
 
         :<header Content-Type: application/json
         :<header X-Auth: the client's auth token
+        :query expand: set to ``sites`` to include full site objects; by
+            default each site has only ``id`` and ``name``
 
         :>header Content-Type: application/json
         :>json int id: unique identifier for group
@@ -71,12 +76,15 @@ class GroupView(FlaskView):
 
         # Get group.
         id_ = get_int_arg('id_', id_)
-        group = g.db.query(Group).filter(Group.id == id_).first()
+        expand_sites = 'sites' in get_expand_arguments(request.args, ['sites'])
+        group = self._query_groups(expand_sites) \
+                    .filter(Group.id == id_) \
+                    .first()
 
         if group is None:
             raise NotFound("Group '%s' does not exist." % id_)
 
-        response = group.as_dict()
+        response = group.as_dict(expand_sites=expand_sites)
         response['url-for'] = url_for('GroupView:get', id_=group.id)
 
         # Send response.
@@ -207,12 +215,8 @@ class GroupView(FlaskView):
                         "name": "gender",
                         "sites": [
                             {
-                                "category": "books",
                                 "id": 2,
-                                "name": "aNobil",
-                                "search_text": "- aNobii</title>",
-                                "status_code": 200,
-                                "url": "http://www.anobii.com/%s/books"
+                                "name": "aNobil"
                             },
                             ...
                         ]
@@ -226,19 +230,18 @@ class GroupView(FlaskView):
         :<header X-Auth: the client's auth token
         :query page: the page number to display (default: 1)
         :query rpp: the number of results per page (default: 10)
+        :query expand: set to ``sites`` to include full site objects; by
+            default each site has only ``id`` and ``name``
 
         :>header Content-Type: application/json
         :>json list groups: a list of group objects
         :>json str groups[n].category: the group category
         :>json int groups[n].id: unique identifier for group
         :>json str groups[n].name: the group name
-        :>json list groups[n].sites: list of sites associated with this group
-        :>json str groups[n].sites[n].category: the site category
+        :>json list groups[n].sites: list of sites associated with this group,
+            ordered by name
         :>json str groups[n].sites[n].id: the unique id for site
         :>json str groups[n].sites[n].name: the site name
-        :>json str groups[n].sites[n].search_text: string search pattern
-        :>json str groups[n].sites[n].status_code: server response code for site
-        :>json str groups[n].sites[n].url: the site url
 
         :status 200: ok
         :status 400: invalid argument[s]
@@ -246,21 +249,38 @@ class GroupView(FlaskView):
         '''
 
         page, results_per_page = get_paging_arguments(request.args)
-        query = g.db.query(Group)
-        total_count = query.count()
+        expand_sites = 'sites' in get_expand_arguments(request.args, ['sites'])
+        total_count = g.db.query(Group).count()
+
+        if expand_sites:
+            query = self._query_groups(expand_sites=True)
+        else:
+            query = g.db.query(Group.id, Group.name)
+
         query = query.order_by(Group.name.asc()) \
                      .limit(results_per_page) \
                      .offset((page - 1) * results_per_page)
 
-        groups = list()
+        if expand_sites:
+            groups = [group.as_dict(expand_sites=True) for group in query]
+        else:
+            groups = [{'id': row.id, 'name': row.name, 'sites': []}
+                      for row in query]
+            groups_by_id = {group['id']: group for group in groups}
+
+            if len(groups) > 0:
+                for row in group_site_query(g.db, list(groups_by_id.keys())):
+                    groups_by_id[row.group_id]['sites'].append({
+                        'id': row.id,
+                        'name': row.name,
+                    })
 
-        for group in query:
-            data = group.as_dict()
-            data['url-for'] = url_for('GroupView:get', id_=group.id)
-            groups.append(data)
+        for group in groups:
+            group['url-for'] = url_for('GroupView:get', id_=group['id'])
 
-        return jsonify(
-            groups=groups,
+        return json_list_response(
+            'groups',
+            groups,
             total_count=total_count
         )
 
@@ -288,20 +308,12 @@ class GroupView(FlaskView):
                 "name": "priority sites",
                 "sites": [
                     {
-                        "category": "books",
                         "id": 1,
-                        "name": "aNobil",
-                        "search_text": "- aNobii</title>",
-                        "status_code": 200,
-                        "url": "http://www.anobii.com/%s/books"
+                        "name": "aNobil"
                     },
                     {
-                        "category": "coding",
                         "id": 5,
-                        "name": "bitbucket",
-                        "search_text": "\"username\":",
-                        "status_code": 200,
-                        "url": "https://bitbucket.org/api/2.0/users/%s"
+                        "name": "bitbucket"
                     },
                     ...
                 ]
@@ -315,12 +327,8 @@ class GroupView(FlaskView):
         :>json int id: unique identifier for group
         :>json str name: the group name
         :>json list sites: list of sites associated with this group
-        :>json str sites[n].category: the site category
         :>json str sites[n].id: the unique id for site
         :>json str sites[n].name: the site name
-        :>json str sites[n].search_text: string search pattern
-        :>json str sites[n].status_code: server response code for site
-        :>json str sites[n].url: the site url
 
         :status 200: updated
         :status 400: invalid request body
@@ -455,3 +463,20 @@ class GroupView(FlaskView):
         response.status_code = 200
 
         return response
+
+    def _query_groups(self, expand_sites):
+        '''
+        Return a group query that loads each group's sites in one batched
+        query.
+
+        Unless `expand_sites` is True, only the site ID and name are loaded.
+        '''
+
+        if expand_sites:
+            sites_option = subqueryload(Group.sites)
+        else:
+            sites_option = subqueryload(Group.sites) \
+                           .load_only(Site.id, Site.name) \
+                           .lazyload('*')
+
+        return g.db.query(Group).options(sites_option)
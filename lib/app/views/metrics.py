@@ -0,0 +1,73 @@
+from flask import g, make_response, request
+from flask.ext.classy import FlaskView
+import rq
+from werkzeug.exceptions import Forbidden
+
+import app.config
+from app.metrics import prometheus_text
+
+
+_config = app.config.get_config()
+_allowed_ips = _config.get('metrics', 'allowed_ips').split()
+
+
+class MetricsView(FlaskView):
+    '''
+    Application metrics for monitoring systems.
+
+    This view does not require an auth token, so that Prometheus can scrape
+    it. Instead, it is only served to the addresses in [metrics] allowed_ips.
+    '''
+
+    def index(self):
+        '''
+        Get application metrics in the Prometheus text exposition format.
+
+        **Example Response**
+
+        .. sourcecode:: text
+
+            # HELP hgprofiler_checks_total Username checks by site and ...
+            # TYPE hgprofiler_checks_total counter
+            hgprofiler_checks_total{site="About.me",status="n"} 118
+            ...
+            # HELP hgprofiler_queue_length Jobs waiting in each queue.
+            # TYPE hgprofiler_queue_length gauge
+            hgprofiler_queue_length{queue="scrape"} 1204
+
+        Queue lengths and worker states are read when this endpoint is
+        requested. Everything else is written to Redis by API processes and
+        workers as they run (see app.metrics).
+
+        :>header Content-Type: text/plain; version=0.0.4
+
+        :status 200: ok
+        :status 403: this address may not read metrics
+        '''
+
+        if request.remote_addr not in _allowed_ips:
+            raise Forbidden('This address may not read metrics.')
+
+        gauges = []
+        worker_states = dict()
+
+        with rq.Connection(g.redis):
+            for queue in rq.Queue.all():
+                if queue.name == 'failed':
+                    continue
+
+                gauges.append(('hgprofiler_queue_length',
+                               queue.count,
+                               {'queue': queue.name}))
+
+            for worker in rq.Worker.all():
+                state = worker.get_state()
+                worker_states[state] = worker_states.get(state, 0) + 1
+
+        for state, count in worker_states.items():
+            gauges.append(('hgprofiler_workers', count, {'state': state}))
+
+        response = make_response(prometheus_text(g.redis, gauges))
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+
+        return response
@@ -1,5 +1,5 @@
 import json
-from flask import g, jsonify, request
+from flask import g, request
 from flask.ext.classy import FlaskView, route
 from werkzeug.exceptions import BadRequest, NotFound
 from sqlalchemy.exc import IntegrityError
@@ -9,11 +9,17 @@ from app.authorization import login_required
 from app.notify import notify_mask_client
 from app.rest import (get_int_arg,
                       get_paging_arguments,
+                      json_list_response,
                       validate_request_json,
                       validate_json_attr)
 from model import Result
+from model.result import result_row_dict, result_row_query
 import worker
 
+# The most results that can be selected by ID in one request: the test
+# results for a page of sites.
+MAX_RESULT_IDS = 200
+
 
 class ResultView(FlaskView):
     '''
@@ -52,6 +58,8 @@ class ResultView(FlaskView):
         :<header X-Auth: the client's auth token
         :query page: the page number to display (default: 1)
         :query rpp: the number of results per page (default: 10)
+        :query ids: a comma separated list of up to 200 result IDs; if given,
+            only those results are returned, without paging
 
         :>header Content-Type: application/json
         :>json list results: a list of result objects
@@ -68,29 +76,47 @@ class ResultView(FlaskView):
         :status 401: authentication required
         '''
 
-        page, results_per_page = get_paging_arguments(request.args)
+        if 'ids' in request.args:
+            result_ids = [get_int_arg('ids', id_)
+                          for id_ in request.args['ids'].split(',')
+                          if id_ != '']
 
-        query = g.db.query(Result)
+            if len(result_ids) > MAX_RESULT_IDS:
+                raise BadRequest('At most {} `ids` are allowed.'
+                                 .format(MAX_RESULT_IDS))
 
-        total_count = query.count()
+            query = result_row_query(g.db) \
+                .filter(Result.id.in_(result_ids)) \
+                .order_by(Result.id)
+            results = [result_row_dict(row) for row in query]
 
-        query = query.limit(results_per_page) \
-                     .offset((page - 1) * results_per_page)
+            return json_list_response(
+                'results',
+                results,
+                total_count=len(results)
+            )
+
+        page, results_per_page = get_paging_arguments(request.args)
 
-        results = list()
+        total_count = g.db.query(Result).count()
 
-        for result in query:
-            results.append(result.as_dict())
+        query = result_row_query(g.db) \
+                    .order_by(Result.id) \
+                    .limit(results_per_page) \
+                    .offset((page - 1) * results_per_page)
 
-        return jsonify(
-            results=results,
+        results = [result_row_dict(row) for row in query]
+
+        return json_list_response(
+            'results',
+            results,
             total_count=total_count
         )
 
     @route('/job/<string:job_id>')
     def get_by_job_id(self, job_id):
         '''
-        Return results identified by `job_id`.
+        Return results identified by `job_id` (the search's tracker ID).
 
         **Example Response**
 
@@ -136,19 +162,20 @@ class ResultView(FlaskView):
 
         page, results_per_page = get_paging_arguments(request.args)
 
-        query = g.db.query(Result).filter(Result.job_id==job_id)
-
-        total_count = query.count()
-
-        query = query.limit(results_per_page) \
-                     .offset((page - 1) * results_per_page)
+        total_count = g.db.query(Result) \
+                          .filter(Result.tracker_id == job_id) \
+                          .count()
 
-        results = list()
+        query = result_row_query(g.db) \
+                    .filter(Result.tracker_id == job_id) \
+                    .order_by(Result.id) \
+                    .limit(results_per_page) \
+                    .offset((page - 1) * results_per_page)
 
-        for result in query:
-            results.append(result.as_dict())
+        results = [result_row_dict(row) for row in query]
 
-        return jsonify(
-            results=results,
+        return json_list_response(
+            'results',
+            results,
             total_count=total_count
         )
@@ -6,12 +6,16 @@ from sqlalchemy.exc import IntegrityError, DBAPIError
 import app.queue
 from app.authorization import login_required
 from app.notify import notify_mask_client
-from app.rest import (get_int_arg,
+from app.rest import (get_expand_arguments,
+                      get_int_arg,
                       get_paging_arguments,
+                      json_list_response,
                       validate_request_json,
                       validate_json_attr)
+from app.stats import get_site_stats, invalidate_site_stats
 from helper.functions import random_string
 from model import Site
+from model.site import site_row_dict, site_row_query
 
 # Dictionary of site attributes used for validation of json POST/PUT requests
 SITE_ATTRS = {
@@ -67,6 +71,9 @@ class SiteView(FlaskView):
         :<header X-Auth: the client's auth token
         :query page: the page number to display (default: 1)
         :query rpp: the number of results per page (default: 10)
+        :query expand: set to ``test_results`` to include the full positive
+            and negative test results for each site; by default only their
+            IDs (``test_result_pos_id``, ``test_result_neg_id``) are included
 
         :>header Content-Type: application/json
         :>json list sites: a list of site objects
@@ -92,30 +99,27 @@ class SiteView(FlaskView):
         '''
 
         page, results_per_page = get_paging_arguments(request.args)
+        expand = get_expand_arguments(request.args, ['test_results'])
+        test_results = 'test_results' in expand
 
-        query = g.db.query(Site)
-
-        total_count = query.count()
-        total_valid_count = query.filter(Site.valid == True).count() # noqa
-        total_invalid_count = query.filter(Site.valid == False).count() # noqa
-        total_tested_count = query.filter(Site.tested_at != None).count() # noqa
+        if test_results:
+            query = g.db.query(Site)
+        else:
+            query = site_row_query(g.db)
 
         query = query.order_by(Site.name.asc()) \
                      .limit(results_per_page) \
                      .offset((page - 1) * results_per_page)
 
-        sites = list()
-
-        for site in query:
-            data = site.as_dict()
-            sites.append(data)
+        if test_results:
+            sites = [site.as_dict() for site in query]
+        else:
+            sites = [site_row_dict(row) for row in query]
 
-        return jsonify(
-            sites=sites,
-            total_count=total_count,
-            total_valid_count=total_valid_count,
-            total_invalid_count=total_invalid_count,
-            total_tested_count=total_tested_count,
+        return json_list_response(
+            'sites',
+            sites,
+            **get_site_stats(g.db, g.redis)
         )
 
     def get(self, id_):
@@ -215,6 +219,7 @@ class SiteView(FlaskView):
                 )
 
         g.db.commit()
+        invalidate_site_stats(g.redis)
 
         # Send redis notifications
         for site in sites:
@@ -368,6 +373,8 @@ class SiteView(FlaskView):
             g.db.rollback()
             raise BadRequest('Database error: {}'.format(e))
 
+        invalidate_site_stats(g.redis)
+
         # Send redis notifications
         notify_mask_client(
             channel='site',
@@ -405,6 +412,8 @@ class SiteView(FlaskView):
                              'before deleting.'
                              .format(site.name))
 
+        invalidate_site_stats(g.redis)
+
         # Send redis notifications
         notify_mask_client(
             channel='site',
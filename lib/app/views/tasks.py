@@ -1,10 +1,12 @@
-from flask import g, jsonify
+from flask import g, jsonify, request
 from flask.ext.classy import FlaskView, route
 import rq
 from rq.exceptions import NoSuchJobError, UnpickleError
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import BadRequest, NotFound
 
 from app.authorization import login_required
+from app.fleet import get_fleet
+from app.metrics import get_metrics, window as metrics_window
 from app.rest import url_for
 
 class TasksView(FlaskView):
@@ -189,6 +191,72 @@ class TasksView(FlaskView):
 
         raise NotFound('No job exists with that ID.')
 
+    @route('metrics')
+    def metrics(self):
+        '''
+        Get phase timing histograms for background jobs.
+
+        Each job records how long it spent in each phase, e.g. waiting in the
+        queue, waiting for Splash, parsing HTML or storing the screenshot.
+
+        **Example Response**
+
+        .. sourcecode:: json
+
+            {
+                "minutes": 15,
+                "jobs": {
+                    "check_username": {
+                        "queue_wait": {
+                            "buckets": [[0.001, 0], ..., [60, 3], [null, 0]],
+                            "count": 1203,
+                            "mean": 4.21,
+                            "p50": 2.5,
+                            "p95": 10,
+                            "p99": 30
+                        },
+                        "splash_render": {...},
+                        ...
+                    },
+                    "create_archive": {...}
+                }
+            }
+
+        :<header Content-Type: application/json
+        :<header X-Auth: the client's auth token
+        :query minutes: the number of minutes to report (optional, defaults
+            to the whole window configured in [metrics])
+
+        :>header Content-Type: application/json
+        :>json int minutes: the number of minutes reported
+        :>json object jobs: a dictionary of job types to phases to timings
+        :>json int jobs[job][phase]["count"]: number of timings
+        :>json float jobs[job][phase]["mean"]: mean time in seconds
+        :>json float jobs[job][phase]["p50"]: estimated median in seconds
+        :>json float jobs[job][phase]["p95"]: estimated 95th percentile
+        :>json float jobs[job][phase]["p99"]: estimated 99th percentile
+        :>json list jobs[job][phase]["buckets"]: histogram as pairs of
+            bucket upper bound (seconds, or null for the overflow bucket) and
+            count
+
+        :status 200: ok
+        :status 400: invalid argument[s]
+        :status 401: authentication required
+        '''
+
+        minutes = request.args.get('minutes')
+
+        if minutes is not None:
+            try:
+                minutes = int(minutes)
+            except ValueError:
+                raise BadRequest('`minutes` must be an integer.')
+
+        minutes = metrics_window(minutes)
+        jobs = get_metrics(g.redis, minutes)
+
+        return jsonify(minutes=minutes, jobs=jobs)
+
     @route('queues')
     def queues(self):
         '''
@@ -268,13 +336,30 @@ class TasksView(FlaskView):
                         "state": "busy"
                     },
                     ...
-                ]
+                ],
+                "fleet": {
+                    "updated": 1476867012,
+                    "pools": {
+                        "scrape": {
+                            "backlog": 340,
+                            "draining": 1,
+                            "max": 20,
+                            "min": 2,
+                            "reason": "backlog",
+                            "running": 6,
+                            "target": 6
+                        },
+                        "archive": {...}
+                    }
+                }
             }
 
         :<header Content-Type: application/json
         :<header X-Auth: the client's auth token
 
         :>header Content-Type: application/json
+        :>json object fleet: the worker pools managed by bin/autoscale.py,
+            or null if the autoscaler is not running (see app.fleet)
         :>json list workers: list of workers
         :>json object workers[n]["current_job"]: the job currently executing on
             this worker, or null if it's not executing any jobs
@@ -348,4 +433,4 @@ class TasksView(FlaskView):
                     'queues': worker.queue_names(),
                 })
 
-        return jsonify(workers=workers)
+        return jsonify(workers=workers, fleet=get_fleet(g.redis))
@@ -0,0 +1,61 @@
+from flask import g, jsonify
+from flask.ext.classy import FlaskView
+from werkzeug.exceptions import NotFound
+
+from app.authorization import login_required
+from app.tracker import get_tracker
+
+
+class TrackerView(FlaskView):
+    '''
+    Progress of username searches.
+    '''
+
+    decorators = [login_required]
+
+    def get(self, id_):
+        '''
+        Get progress for the search identified by tracker `id_`.
+
+        **Example Response**
+
+        .. sourcecode:: json
+
+            {
+                "id": "tracker.a8Bc7dE0fG",
+                "total": 120,
+                "current": 43,
+                "found": 12,
+                "not_found": 29,
+                "error": 2,
+                "progress": 0.3583333333333333,
+                "started": 1453219200,
+                "updated": 1453219262
+            }
+
+        :<header Content-Type: application/json
+        :<header X-Auth: the client's auth token
+
+        :>header Content-Type: application/json
+        :>json str id: the tracker ID
+        :>json int total: the number of sites being checked
+        :>json int current: the number of sites checked so far
+        :>json int found: the number of sites where the username was found
+        :>json int not_found: the number of sites where the username was not
+            found
+        :>json int error: the number of sites that raised an error
+        :>json float progress: `current` / `total`, expressed as a decimal
+        :>json int started: UNIX timestamp when the search was submitted
+        :>json int updated: UNIX timestamp of the most recent result
+
+        :status 200: ok
+        :status 401: authentication required
+        :status 404: no tracker with that ID (or it has expired)
+        '''
+
+        tracker = get_tracker(g.redis, id_)
+
+        if tracker is None:
+            raise NotFound("Tracker '%s' does not exist." % id_)
+
+        return jsonify(**tracker)
@@ -9,7 +9,7 @@ from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest, Conflict, Forbidden, NotFound
 
-from app.authorization import admin_required, login_required
+from app.authorization import admin_required, invalidate_user, login_required
 from app.rest import get_int_arg, get_paging_arguments, url_for
 from model import User
 from model.user import hash_password, valid_password
@@ -384,6 +384,7 @@ class UserView(FlaskView):
 
         g.db.commit()
         g.db.expire(user)
+        invalidate_user(user.id)
 
         return jsonify(**self._user_dict(user))
 
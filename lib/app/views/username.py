@@ -1,11 +1,20 @@
+from collections import OrderedDict
+import csv
+import io
+import time
+
 from flask import g, jsonify, request
 from flask.ext.classy import FlaskView
 from werkzeug.exceptions import BadRequest, NotFound
 
 import app.config
 import app.queue
+from app.admission import check_batch
+from app.batch import create_batch
+from app.trace import new_span_id, new_trace_id, span, write_spans
+from app.tracker import init_tracker
 from app.authorization import login_required
-from app.rest import validate_request_json
+from app.rest import get_int_arg, validate_request_json
 from helper.functions import random_string
 from model import Group, Site
 
@@ -29,6 +38,15 @@ class UsernameView(FlaskView):
         '''
         Request search of usernames.
 
+        The search is stored as a batch and the response is returned right
+        away: background jobs then queue a job for each username and site
+        (see app.batch). Get the batch's progress from /api/batch/<id>, or
+        each username's progress from its tracker.
+
+        Instead of JSON, the request may be a form that uploads a CSV file
+        of usernames as ``file``, with ``group``, ``site`` and ``test`` as
+        form fields.
+
         **Example Request**
 
         .. sourcecode:: json
@@ -48,6 +66,10 @@ class UsernameView(FlaskView):
         .. sourcecode:: json
 
             {
+                "batch_id": "a8Bc7dE0fG",
+                "estimated_wait": 240,
+                "queue_position": 1260,
+                "trace_id": "9f2c4b0e7d1a4c2f8e3b5a6d7c8e9f01",
                 "tracker_ids": {
                         "johndoe": "tracker.12344565",
                 }
@@ -61,21 +83,32 @@ class UsernameView(FlaskView):
         :>json bool test: test results (optional, default: false)
 
         :>header Content-Type: application/json
-        :>json list jobs: list of worker jobs
-        :>json list jobs[n].id: unique id of this job
-        :>json list jobs[n].usename: username target of this job
+        :>header X-Trace-Id: the trace ID of this search (see app.trace)
+        :>json str batch_id: the ID of this search's batch
+        :>json str trace_id: the trace ID of this search
+        :>json dict tracker_ids: the tracker ID of each username
+        :>json int queue_position: the estimated position of this search's
+            last job in the scrape queue
+        :>json int estimated_wait: estimated seconds until that job runs, or
+            null if unknown
 
         :status 202: accepted for background processing
         :status 400: invalid request body
         :status 401: authentication required
+        :status 404: group or site not found, or no valid sites
+        :status 413: each username needs more jobs than a user may have
+            queued at once (see app.admission)
+        :status 429: the system is saturated (see app.admission); the
+            ``Retry-After`` header gives the number of seconds to wait
         '''
+        started = time.time()
+        trace = {'trace_id': new_trace_id(), 'parent_id': new_span_id()}
+        g.trace_id = trace['trace_id']
         test = False
         group = None
         group_id = None
-        jobs = []
-        tracker_ids = dict()
         redis = g.redis
-        request_json = request.get_json()
+        request_json = _get_request_data()
         site = None
 
         if 'usernames' not in request_json:
@@ -83,7 +116,10 @@ class UsernameView(FlaskView):
 
         validate_request_json(request_json, USERNAME_ATTRS)
 
-        if len(request_json['usernames']) == 0:
+        # Each username is searched once.
+        usernames = list(OrderedDict.fromkeys(request_json['usernames']))
+
+        if len(usernames) == 0:
             raise BadRequest('At least one username is required')
 
         if 'group' in request_json and 'site' in request_json:
@@ -108,45 +144,103 @@ class UsernameView(FlaskView):
         if 'test' in request_json:
             test = request_json['test']
 
+        # Only check valid sites.
         if group:
-            sites = group.sites
-        elif site:
-            sites = g.db.query(Site).filter(Site.id == site.id)
+            site_ids = [site.id for site in group.sites if site.valid]
         else:
-            sites = g.db.query(Site)
+            sites = g.db.query(Site.id).filter(Site.valid == True) # noqa
 
-        # Only check valid sites.
-        sites = sites.filter(Site.valid == True).all() # noqa
+            if site:
+                sites = sites.filter(Site.id == site.id)
+
+            site_ids = [row.id for row in sites]
 
-        if len(sites) == 0:
+        if len(site_ids) == 0:
             raise NotFound('No valid sites to check')
 
-        for username in request_json['usernames']:
-            # Create an object in redis to track the number of sites completed
-            # in this search.
+        admission = check_batch(redis, len(usernames), len(site_ids))
+
+        # Store the batch and let a background job queue the jobs for each
+        # username and site, a chunk at a time as they are admitted (see
+        # app.admission). Trackers are created now, so that clients can
+        # follow each username's progress right away.
+        batch_id = random_string(10)
+        tracker_ids = OrderedDict()
+        pipe = redis.pipeline()
+
+        for username in usernames:
             tracker_id = 'tracker.{}'.format(random_string(10))
             tracker_ids[username] = tracker_id
-            redis.set(tracker_id, 0)
-            redis.expire(tracker_id, 600)
-            total = len(sites)
-
-            # Queue a job for each site.
-            for site in sites:
-                job_id = app.queue.schedule_username(
-                    username=username,
-                    site=site,
-                    group_id=group_id,
-                    total=total,
-                    tracker_id=tracker_id,
-                    test=test
-                )
-                jobs.append({
-                    'id': job_id,
-                    'username': username,
-                    'group': group_id,
-                })
-
-        response = jsonify(tracker_ids=tracker_ids)
+            init_tracker(redis, tracker_id, len(site_ids), pipeline=pipe)
+
+        create_batch(redis,
+                     batch_id,
+                     g.user.id,
+                     [(tracker_id, username)
+                      for username, tracker_id in tracker_ids.items()],
+                     site_ids,
+                     group_id=group_id,
+                     test=test,
+                     trace=trace,
+                     pipeline=pipe)
+        app.queue.schedule_batch(batch_id, trace=trace, pipeline=pipe)
+        pipe.execute()
+
+        write_spans([span(trace['trace_id'],
+                          trace['parent_id'],
+                          None,
+                          'search',
+                          started,
+                          time.time(),
+                          batch_id=batch_id,
+                          usernames=len(usernames),
+                          sites=len(site_ids),
+                          user_id=g.user.id)])
+
+        response = jsonify(batch_id=batch_id,
+                           trace_id=trace['trace_id'],
+                           tracker_ids=tracker_ids,
+                           **admission)
         response.status_code = 202
+        response.headers['X-Trace-Id'] = trace['trace_id']
 
         return response
+
+
+def _get_request_data():
+    '''
+    Return the search request as a dictionary.
+
+    The request is either JSON, or a form with the usernames in an uploaded
+    CSV file (``file``, one username in the first column of each row) and
+    the other attributes as form fields.
+    '''
+
+    if 'file' not in request.files:
+        request_json = request.get_json()
+
+        if request_json is None:
+            raise BadRequest('Request must be JSON or include a `file`.')
+
+        return request_json
+
+    try:
+        text = request.files['file'].read().decode('utf8')
+    except UnicodeDecodeError:
+        raise BadRequest('`file` must be UTF-8 encoded.')
+
+    request_data = {
+        'usernames': [row[0].strip()
+                      for row in csv.reader(io.StringIO(text))
+                      if len(row) > 0 and row[0].strip() != ''],
+    }
+
+    for name in ('group', 'site'):
+        if name in request.form:
+            request_data[name] = get_int_arg(name, request.form[name])
+
+    if 'test' in request.form:
+        request_data['test'] = request.form['test'].lower() in \
+            ('1', 'true', 'yes')
+
+    return request_data
@@ -0,0 +1,5 @@
+'''
+Tools for benchmarking the application.
+
+See bin/benchmark.py for the end-to-end throughput benchmark.
+'''
@@ -0,0 +1,177 @@
+'''
+Micro-benchmark for the page matchers in worker.scrape.
+
+The corpus in ``bench/corpus`` pairs rendered pages with site match criteria.
+``manifest.json`` lists each page's file, the upstream HTTP status that
+Splash would report, and the sites to match against it along with the
+expected result. A page may also name a ``fragment`` that is inserted
+``repeat`` times at the page's ``<!-- repeat -->`` marker, so that large
+pages don't need to be checked in verbatim.
+'''
+
+import json
+import os
+import time
+import tracemalloc
+
+from bench.report import summarize
+from model import Site
+from worker.scrape import match_page, parse_page
+
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'corpus')
+REPEAT_MARKER = '<!-- repeat -->'
+
+
+def load_corpus(corpus_dir=CORPUS_DIR):
+    '''
+    Return a list of pages from `corpus_dir`. Each page is a dictionary with
+    keys ``name``, ``html``, ``status`` and ``sites``, where ``sites`` is a
+    list of ``(Site, expected)`` tuples.
+    '''
+
+    with open(os.path.join(corpus_dir, 'manifest.json')) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    pages = []
+
+    for page in manifest['pages']:
+        with open(os.path.join(corpus_dir, page['file'])) as page_file:
+            html = page_file.read()
+
+        if 'fragment' in page:
+            fragment_path = os.path.join(corpus_dir, page['fragment'])
+
+            with open(fragment_path) as fragment_file:
+                fragment = fragment_file.read()
+
+            html = html.replace(REPEAT_MARKER, fragment * page['repeat'])
+
+        sites = []
+
+        for index, site in enumerate(page['sites']):
+            sites.append((
+                Site(name='{} {}'.format(page['name'], index),
+                     url='http://benchmark.example/%s',
+                     category='benchmark',
+                     test_username_pos='benchmark',
+                     status_code=site.get('status_code'),
+                     match_type=site['match_type'],
+                     match_expr=site['match_expr']),
+                site['expected']
+            ))
+
+        pages.append({
+            'name': page['name'],
+            'html': html,
+            'status': page['status'],
+            'sites': sites,
+        })
+
+    return pages
+
+
+def run(pages, iterations=20):
+    '''
+    Time parsing and matching for each of `pages` over `iterations` runs.
+
+    Returns a report with an entry per page: its size, parse time, match
+    time per match type (all in milliseconds), peak memory in bytes, and
+    any sites whose match result differs from the expected one.
+    '''
+
+    report = dict()
+
+    for page in pages:
+        parse_times = []
+        match_times = {}
+        mismatches = []
+
+        for iteration in range(iterations):
+            start = time.perf_counter()
+            sel = parse_page(page['html'])
+            parse_times.append((time.perf_counter() - start) * 1000)
+
+            for site, expected in page['sites']:
+                start = time.perf_counter()
+                matched = match_page(site, sel, page['status'])
+                elapsed = (time.perf_counter() - start) * 1000
+                match_times.setdefault(site.match_type, []).append(elapsed)
+
+                if iteration == 0 and matched != expected:
+                    mismatches.append(site.name)
+
+        report[page['name']] = {
+            'bytes': len(page['html'].encode('utf8')),
+            'parse_ms': summarize(parse_times),
+            'match_ms': {match_type: summarize(times)
+                         for match_type, times in match_times.items()},
+            'peak_memory': _peak_memory(page),
+            'mismatches': mismatches,
+        }
+
+    return report
+
+
+def compare(report, baseline, tolerance):
+    '''
+    Return a list of descriptions of regressions in `report` compared to
+    `baseline`, a report from an earlier run.
+
+    A median time or peak memory counts as a regression if it exceeds the
+    baseline by more than `tolerance` (e.g. 0.25 for 25%).
+    '''
+
+    regressions = []
+
+    def check(label, value, baseline_value):
+        if baseline_value and value > baseline_value * (1 + tolerance):
+            regressions.append('{}: {:.3f} (baseline {:.3f})'.format(
+                label, value, baseline_value
+            ))
+
+    for name, page in report.items():
+        if name not in baseline:
+            continue
+
+        baseline_page = baseline[name]
+        check('{} parse_ms p50'.format(name),
+              page['parse_ms']['p50'],
+              baseline_page['parse_ms']['p50'])
+        check('{} peak_memory'.format(name),
+              page['peak_memory'],
+              baseline_page['peak_memory'])
+
+        for match_type, times in page['match_ms'].items():
+            if match_type in baseline_page['match_ms']:
+                check('{} {} match_ms p50'.format(name, match_type),
+                      times['p50'],
+                      baseline_page['match_ms'][match_type]['p50'])
+
+    return regressions
+
+
+def _peak_memory(page):
+    '''
+    Return the peak memory in bytes allocated while parsing `page` and
+    matching all of its sites.
+
+    This is measured separately from the timings because tracing
+    allocations slows everything down. Only allocations made through
+    Python's allocator are traced, so the libxml2 document tree itself is
+    not counted, but the selectors and extracted strings are.
+    '''
+
+    tracemalloc.start()
+
+    try:
+        sel = parse_page(page['html'])
+
+        for site, _ in page['sites']:
+            match_page(site, sel, page['status'])
+
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak
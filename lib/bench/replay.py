@@ -0,0 +1,67 @@
+'''
+A stand-in for Splash that replays recorded responses.
+
+Record a workload by setting ``[splash] record_dir`` on the scrape workers,
+then point workers at a ReplaySplash (see bin/replay-splash.py and
+bin/run-worker.py --splash-url) to run the same workload again offline.
+'''
+
+import json
+import time
+
+from helper.cassette import CassetteStore
+from bench.splash import SplashServer
+
+
+class ReplaySplash(SplashServer):
+    '''
+    Serves the responses recorded in a CassetteStore.
+
+    Each response is delayed by the time Splash originally took, divided by
+    `speed`: a speed of 2 replays twice as fast as recorded, and a speed of 0
+    replays without any delay. URLs that were not recorded get a 404 error.
+    '''
+
+    def __init__(self, root, host='127.0.0.1', port=8051, speed=1.0):
+        ''' Constructor. '''
+
+        super().__init__(host, port)
+        self.speed = speed
+        self.misses = 0
+        self.store = CassetteStore(root)
+        self.index = self.store.index()
+
+    def usernames(self):
+        ''' Return the recorded usernames, sorted. '''
+
+        return sorted({entry['username'] for entry in self.index.values()})
+
+    def render(self, target_url):
+        ''' See SplashServer.render(). '''
+
+        entry = self.index.get(target_url)
+
+        with self._lock:
+            self.requests += 1
+
+            if entry is None:
+                self.misses += 1
+                self.errors += 1
+
+        if entry is None:
+            return 404, json.dumps({
+                'error': 404,
+                'type': 'ReplayError',
+                'description': 'No recording for {}'.format(target_url),
+            }).encode('utf8')
+
+        cassette = self.store.read(entry)
+
+        if self.speed > 0:
+            time.sleep(cassette['elapsed'] / self.speed)
+
+        if cassette['status'] != 200:
+            with self._lock:
+                self.errors += 1
+
+        return cassette['status'], cassette['body'].encode('utf8')
@@ -0,0 +1,75 @@
+''' Summarizing and saving benchmark results. '''
+
+from datetime import datetime
+import json
+import os
+import subprocess
+
+from helper.functions import get_path
+
+
+def percentile(values, p):
+    '''
+    Return the `p`th percentile (0-100) of `values`, using linear
+    interpolation between the closest ranks, or None if `values` is empty.
+    '''
+
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def summarize(values):
+    ''' Return count, mean, p50, p95, p99 and max of `values`. '''
+
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+def git_revision():
+    ''' Return the current git commit, or None if it can't be determined. '''
+
+    try:
+        output = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=get_path(),
+            stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return output.decode('ascii').strip()
+
+
+def save_report(report, directory, name):
+    '''
+    Save `report` as JSON in `directory`, named after the time, the git
+    commit and `name`, so that runs can be compared across commits. Returns
+    the path of the saved file.
+    '''
+
+    os.makedirs(directory, exist_ok=True)
+    revision = report.get('git_revision') or 'unknown'
+    filename = '{}-{}-{}.json'.format(
+        datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'),
+        revision,
+        name
+    )
+    path = os.path.join(directory, filename)
+
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+
+    return path
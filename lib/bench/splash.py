@@ -0,0 +1,185 @@
+'''
+Stand-ins for Splash that serve canned ``render.json`` responses.
+
+This lets benchmarks exercise the scrape workers without rendering real
+pages or sending any traffic to real sites. See also bench.replay.
+'''
+
+import base64
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import json
+import os
+import random
+from socketserver import ThreadingMixIn
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+
+CANNED_HTML = '''<!DOCTYPE html>
+<html>
+<head><title>Benchmark page</title></head>
+<body>
+<div id="content">
+<h1>Sorry, this page isn't available.</h1>
+<p>The link you followed may be broken, or the page may have been removed.</p>
+</div>
+</body>
+</html>'''
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SplashServer:
+    '''
+    Base class for threaded HTTP servers that mimic Splash's ``render.json``
+    endpoint. Subclasses implement render().
+    '''
+
+    def __init__(self, host='127.0.0.1', port=8051):
+        ''' Constructor. '''
+
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        ''' The base URL of this server. '''
+
+        return 'http://{}:{}/'.format(self.host, self.port)
+
+    def start(self):
+        ''' Start serving in a background thread. '''
+
+        splash_server = self
+
+        class Handler(_Handler):
+            splash = splash_server
+
+        self._server = _ThreadingHTTPServer((self.host, self.port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        ''' Stop serving. '''
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def render(self, target_url):
+        '''
+        Return a ``(status, body)`` tuple for a render request for
+        `target_url`, where `body` is the JSON response as bytes.
+        '''
+
+        raise NotImplementedError()
+
+
+class FakeSplash(SplashServer):
+    '''
+    Serves a canned page for every render request.
+
+    Each response is delayed by a normally distributed `latency` (seconds,
+    with standard deviation `jitter`), and fails with a 502 error with
+    probability `error_rate`. Screenshots are taken round-robin from a pool of
+    `image_pool` distinct JPEGs of `image_size` pixels, so that the content
+    store sees a realistic mix of new and duplicate images.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=8051, latency=0.5, jitter=0.1,
+                 error_rate=0.0, image_size=(1024, 768), image_pool=32):
+        ''' Constructor. '''
+
+        super().__init__(host, port)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._images = [_make_jpeg(image_size) for _ in range(image_pool)]
+
+    def render(self, target_url):
+        ''' See SplashServer.render(). '''
+
+        delay = max(0, random.gauss(self.latency, self.jitter))
+        time.sleep(delay)
+
+        with self._lock:
+            self.requests += 1
+            request_number = self.requests
+
+            if random.random() < self.error_rate:
+                self.errors += 1
+                error = True
+            else:
+                error = False
+
+        if error:
+            return 502, json.dumps({
+                'error': 502,
+                'type': 'RenderError',
+                'description': 'Simulated render error.',
+            }).encode('utf8')
+
+        image = self._images[request_number % len(self._images)]
+
+        return 200, json.dumps({
+            'url': target_url,
+            'html': CANNED_HTML,
+            'jpeg': image,
+            'history': [{'response': {'status': 200}}],
+        }).encode('utf8')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    ''' Request handler for SplashServer. '''
+
+    splash = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path != '/render.json':
+            self.send_error(404)
+            return
+
+        target_url = parse_qs(url.query).get('url', [''])[0]
+        status, data = self.splash.render(target_url)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        ''' Don't log each request. '''
+
+        pass
+
+
+def _make_jpeg(size):
+    '''
+    Return a base64 encoded JPEG of `size` pixels, with a random patch so
+    that each image is distinct.
+    '''
+
+    color = tuple(random.randrange(256) for _ in range(3))
+    image = Image.new('RGB', size, color)
+    patch = Image.frombytes('RGB', (64, 64), os.urandom(64 * 64 * 3))
+    image.paste(patch, (16, 16))
+    data = io.BytesIO()
+    image.save(data, 'JPEG', quality=80)
+
+    return base64.b64encode(data.getvalue()).decode('ascii')
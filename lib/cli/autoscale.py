@@ -0,0 +1,338 @@
+import calendar
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from rq import Queue, Worker
+from rq.exceptions import NoSuchJobError
+from rq.worker import WorkerStatus
+
+import app.database
+from app.fleet import set_fleet
+from app.metrics import counter_totals, get_metrics
+import cli
+from helper.functions import get_path
+import worker
+
+
+# The job type whose timings describe each queue (see app.metrics).
+QUEUE_JOB_TYPES = {
+    'scrape': 'check_username',
+    'archive': 'create_archive',
+    'batch': 'plan_batch',
+}
+
+
+class WorkerPool:
+    ''' Worker processes for one queue, scaled between bounds. '''
+
+    def __init__(self, queue_name, min_workers, max_workers, command, redis):
+        ''' Constructor. '''
+
+        self.queue_name = queue_name
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.command = command
+        self.redis = redis
+        self.target = min_workers
+        self.processes = []
+        self.draining = dict()
+        self.up_intervals = 0
+        self.down_intervals = 0
+        self.backlog = 0
+        self.reason = 'minimum'
+
+    def as_dict(self):
+        ''' Return dictionary representation of this pool. '''
+
+        return {
+            'backlog': self.backlog,
+            'draining': len(self.draining),
+            'max': self.max_workers,
+            'min': self.min_workers,
+            'reason': self.reason,
+            'running': len(self.processes),
+            'target': self.target,
+        }
+
+    def adjust(self, desired, scale_up_after, scale_down_after):
+        '''
+        Move the target towards `desired` workers, with hysteresis: only
+        after the pool has needed more (or fewer) workers for
+        `scale_up_after` (or `scale_down_after`) consecutive intervals.
+        Returns True if the target changed.
+        '''
+
+        desired = max(self.min_workers, min(desired, self.max_workers))
+
+        if desired > self.target:
+            self.up_intervals += 1
+            self.down_intervals = 0
+
+            if self.up_intervals >= scale_up_after:
+                self.target = desired
+                self.up_intervals = 0
+                return True
+        elif desired < self.target:
+            self.down_intervals += 1
+            self.up_intervals = 0
+
+            if self.down_intervals >= scale_down_after:
+                # Shrink gradually, since load often comes back.
+                self.target -= max(1, (self.target - desired) // 2)
+                self.down_intervals = 0
+                return True
+        else:
+            self.up_intervals = 0
+            self.down_intervals = 0
+
+        return False
+
+    def reconcile(self, drain_timeout, logger):
+        '''
+        Start or drain workers so that the number running matches the
+        target, and reap workers that have exited.
+        '''
+
+        now = time.time()
+
+        for process in list(self.processes):
+            if process.poll() is not None:
+                # Workers exit after --max-jobs, or if they crash. Either way
+                # they are replaced below.
+                logger.info('%s worker %d exited with status %d.',
+                            self.queue_name, process.pid, process.returncode)
+                self.processes.remove(process)
+
+        for process, deadline in list(self.draining.items()):
+            if process.poll() is not None:
+                del self.draining[process]
+            elif now > deadline:
+                job_deadline = self._job_deadline(process)
+
+                if job_deadline is not None and now < job_deadline:
+                    # RQ stops the job when it times out, so wait until then.
+                    self.draining[process] = job_deadline
+                else:
+                    logger.warning('Killing %s worker %d: still busy after '
+                                   '%d seconds.',
+                                   self.queue_name, process.pid,
+                                   drain_timeout)
+                    process.kill()
+
+        while len(self.processes) < self.target:
+            process = subprocess.Popen(self.command)
+            logger.info('Started %s worker %d.', self.queue_name, process.pid)
+            self.processes.append(process)
+
+        while len(self.processes) > self.target:
+            self.drain(self._pop_idle(), now + drain_timeout, logger)
+
+    def drain(self, process, deadline, logger):
+        '''
+        Ask `process` to exit after its current job. RQ workers do a warm
+        shutdown on SIGTERM. The process is killed if it is still running
+        after `deadline`, unless its job hasn't timed out yet.
+        '''
+
+        logger.info('Draining %s worker %d.', self.queue_name, process.pid)
+        process.send_signal(signal.SIGTERM)
+        self.draining[process] = deadline
+
+    def _get_rq_worker(self, process):
+        '''
+        Return the RQ worker for `process`, or None if it hasn't registered
+        yet.
+        '''
+
+        key = Worker.redis_worker_namespace_prefix + \
+            worker.get_worker_name(process.pid)
+
+        return Worker.find_by_key(key, connection=self.redis)
+
+    def _job_deadline(self, process):
+        '''
+        Return the time at which the current job of `process` times out (with
+        the same allowance as RQ's started job registry), or None if it isn't
+        running a job.
+        '''
+
+        rq_worker = self._get_rq_worker(process)
+
+        if rq_worker is None:
+            return None
+
+        try:
+            job = rq_worker.get_current_job()
+        except NoSuchJobError:
+            return None
+
+        if job is None or job.started_at is None:
+            return None
+
+        started = calendar.timegm(job.started_at.utctimetuple())
+
+        return started + (job.timeout or Queue.DEFAULT_TIMEOUT) + 60
+
+    def _pop_idle(self):
+        '''
+        Remove and return an idle worker process, so that draining doesn't
+        wait for a job, or the newest process if all of them are busy.
+        '''
+
+        for process in reversed(self.processes):
+            rq_worker = self._get_rq_worker(process)
+
+            if rq_worker is None or \
+                    rq_worker.get_state() != WorkerStatus.BUSY:
+                self.processes.remove(process)
+                return process
+
+        return self.processes.pop()
+
+
+class AutoscaleCli(cli.BaseCli):
+    '''
+    Run scrape, archive and batch planner workers, scaling each pool with its
+    workload.
+
+    Pools grow with the queue backlog and queue wait, but scrape workers are
+    not added while Splash is saturated. Workers are stopped gracefully:
+    they finish their current job first. Settings are in the [autoscale]
+    section of the configuration. The state of the fleet is shown by
+    /api/tasks/workers.
+    '''
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        settings = dict(config.items('autoscale'))
+        interval = int(settings['interval'])
+        drain_timeout = int(settings['drain_timeout'])
+        redis = app.database.get_redis(dict(config.items('redis')))
+        script = os.path.join(get_path('bin'), 'run-worker.py')
+        pools = []
+
+        for queue_name in ('scrape', 'archive', 'batch'):
+            command = [sys.executable, script,
+                       '--no-fork',
+                       '--max-jobs', settings['max_jobs'],
+                       queue_name]
+            pools.append(WorkerPool(
+                queue_name,
+                int(settings['{}_min_workers'.format(queue_name)]),
+                int(settings['{}_max_workers'.format(queue_name)]),
+                command,
+                redis
+            ))
+
+        self._stopping = False
+        self._checks = None
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        while not self._stopping:
+            self._scale(redis, pools, settings)
+
+            for pool in pools:
+                pool.reconcile(drain_timeout, self._logger)
+
+            # Workers that crashed can't fail their own jobs.
+            orphaned = worker.fail_orphaned_jobs()
+
+            if orphaned > 0:
+                self._logger.warning('Recovered %d orphaned jobs.',
+                                     orphaned)
+
+            set_fleet(redis,
+                      {pool.queue_name: pool.as_dict() for pool in pools},
+                      ttl=interval * 3)
+            time.sleep(interval)
+
+        self._shutdown(pools, drain_timeout)
+
+    def _scale(self, redis, pools, settings):
+        ''' Set each pool's target from the current workload. '''
+
+        jobs_per_worker = int(settings['jobs_per_worker'])
+        max_queue_wait = float(settings['max_queue_wait'])
+        metrics = get_metrics(redis, minutes=2)
+        splash_saturated = self._splash_saturated(redis, metrics, settings)
+
+        for pool in pools:
+            pool.backlog = Queue(pool.queue_name, connection=redis).count
+            desired = math.ceil(pool.backlog / jobs_per_worker)
+            reason = 'backlog'
+            job_metrics = metrics.get(QUEUE_JOB_TYPES[pool.queue_name], {})
+            queue_wait = job_metrics.get('queue_wait', {}).get('p95')
+
+            if pool.backlog > 0 and queue_wait is not None and \
+                    queue_wait > max_queue_wait and desired <= pool.target:
+                desired = pool.target + 1
+                reason = 'queue wait'
+
+            if pool.queue_name == 'scrape' and splash_saturated and \
+                    desired > pool.target:
+                desired = pool.target
+                reason = 'splash saturated'
+
+            if pool.adjust(desired,
+                           int(settings['scale_up_after']),
+                           int(settings['scale_down_after'])):
+                pool.reason = reason
+                self._logger.info('Scaling %s workers to %d (%s).',
+                                  pool.queue_name, pool.target, reason)
+
+    def _shutdown(self, pools, drain_timeout):
+        ''' Drain all workers and wait for them to exit. '''
+
+        self._logger.info('Stopping: draining all workers.')
+        deadline = time.time() + drain_timeout
+
+        for pool in pools:
+            pool.target = 0
+
+            while len(pool.processes) > 0:
+                pool.drain(pool.processes.pop(), deadline, self._logger)
+
+        while any(pool.draining for pool in pools):
+            time.sleep(1)
+
+            for pool in pools:
+                pool.reconcile(drain_timeout, self._logger)
+
+    def _splash_saturated(self, redis, metrics, settings):
+        '''
+        Return True if Splash is failing or slow: the fraction of checks
+        that failed since the last interval exceeds splash_max_error_rate,
+        or the 95th percentile render time exceeds splash_max_latency.
+        '''
+
+        checks = counter_totals(redis, 'hgprofiler_checks_total', 'status')
+        previous, self._checks = self._checks, checks
+        saturated = False
+
+        if previous is not None:
+            done = sum(checks.values()) - sum(previous.values())
+            errors = checks.get('e', 0) - previous.get('e', 0)
+
+            if done > 0 and errors / done > \
+                    float(settings['splash_max_error_rate']):
+                saturated = True
+
+        render = metrics.get('check_username', {}).get('splash_render', {})
+        latency = render.get('p95')
+
+        if latency is not None and \
+                latency > float(settings['splash_max_latency']):
+            saturated = True
+
+        return saturated
+
+    def _stop(self, signum, frame):
+        ''' Signal handler: stop after the current interval. '''
+
+        self._stopping = True
@@ -0,0 +1,344 @@
+from datetime import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+
+from rq import Worker
+
+import app
+import app.database
+from bench.replay import ReplaySplash
+from bench.report import git_revision, save_report, summarize
+from bench.splash import FakeSplash
+import cli
+from helper.functions import get_path
+
+
+class BenchmarkCli(cli.BaseCli):
+    '''
+    Measure end-to-end search throughput and latency.
+
+    Usernames are submitted through the API exactly as the UI does, and
+    scrape workers render pages with a local stand-in for Splash, so that
+    results are reproducible and no traffic is sent to real sites. The
+    stand-in serves either a canned page or, with --replay, responses
+    recorded from real Splash. The report is printed and saved as JSON so
+    that runs can be compared across commits.
+
+    The benchmark uses the configured queues, so it refuses to start its
+    workers while other workers are registered: they would take benchmark
+    jobs to real Splash, and the benchmark's workers would answer real
+    searches from the stand-in. Run it against an idle installation.
+    '''
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            '--usernames',
+            type=int,
+            metavar='N',
+            help='Number of usernames to search for. (Default: 10, or all '
+                 'recorded usernames with --replay)'
+        )
+
+        arg_parser.add_argument(
+            '--group',
+            type=int,
+            help='ID of the site group to search. (Default: all valid sites)'
+        )
+
+        arg_parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            metavar='N',
+            help='Number of workers to start for the benchmark. No other '
+                 'workers may be running. Use 0 to rely on workers that are '
+                 'already running, which must have been started with '
+                 '--splash-url pointing at the Splash stand-in. (Default: 4)'
+        )
+
+        arg_parser.add_argument(
+            '--latency',
+            type=float,
+            default=0.5,
+            metavar='SECONDS',
+            help='Mean render latency of the fake Splash server. '
+                 '(Default: 0.5)'
+        )
+
+        arg_parser.add_argument(
+            '--jitter',
+            type=float,
+            default=0.1,
+            metavar='SECONDS',
+            help='Standard deviation of the render latency. (Default: 0.1)'
+        )
+
+        arg_parser.add_argument(
+            '--error-rate',
+            type=float,
+            default=0.0,
+            metavar='P',
+            help='Fraction of renders that fail. (Default: 0)'
+        )
+
+        arg_parser.add_argument(
+            '--replay',
+            metavar='RECORD_DIR',
+            help='Replay the Splash responses recorded in this directory '
+                 '(see [splash] record_dir) instead of serving a canned page.'
+        )
+
+        arg_parser.add_argument(
+            '--speed',
+            type=float,
+            default=1.0,
+            help='Replay speed relative to the recording, with --replay. '
+                 '(Default: 1)'
+        )
+
+        arg_parser.add_argument(
+            '--splash-port',
+            type=int,
+            default=8051,
+            help='Port for the fake Splash server. (Default: 8051)'
+        )
+
+        arg_parser.add_argument(
+            '--timeout',
+            type=float,
+            default=600,
+            metavar='SECONDS',
+            help='Give up waiting for results after this long. '
+                 '(Default: 600)'
+        )
+
+        arg_parser.add_argument(
+            '--email',
+            default='admin',
+            help='Email of the user to submit searches as. (Default: admin)'
+        )
+
+        arg_parser.add_argument(
+            '--password',
+            default='MemexPass1',
+            help='Password of the user to submit searches as.'
+        )
+
+        arg_parser.add_argument(
+            '--label',
+            default='benchmark',
+            help='A label to include in the report file name.'
+        )
+
+        arg_parser.add_argument(
+            '--output-dir',
+            default=get_path('data/benchmarks'),
+            help='Directory to save reports in. (Default: data/benchmarks)'
+        )
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        flask_app = app.bootstrap(log_level=args.verbosity)
+        redis = app.database.get_redis(dict(config.items('redis')))
+
+        if args.replay is not None:
+            splash = ReplaySplash(args.replay,
+                                  port=args.splash_port,
+                                  speed=args.speed)
+            usernames = splash.usernames()
+
+            if len(usernames) == 0:
+                raise cli.CliError('No responses recorded in {}'.format(
+                    args.replay
+                ))
+
+            usernames = usernames[:args.usernames]
+        else:
+            splash = FakeSplash(port=args.splash_port,
+                                latency=args.latency,
+                                jitter=args.jitter,
+                                error_rate=args.error_rate)
+            usernames = ['bench{:06d}'.format(i)
+                         for i in range(args.usernames or 10)]
+
+        if args.workers > 0:
+            running = Worker.all(connection=redis)
+
+            if len(running) > 0:
+                raise cli.CliError(
+                    '{} workers are already running ({}). Stop them before '
+                    'running the benchmark, or use --workers 0 if they were '
+                    'started with --splash-url pointing at the Splash '
+                    'stand-in.'.format(
+                        len(running),
+                        ', '.join(sorted(w.name for w in running))
+                    )
+                )
+
+        splash.start()
+        self._logger.info('Splash stand-in is listening on %s', splash.url)
+        workers = self._start_workers(args.workers, splash.url)
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe('result', 'archive')
+
+        try:
+            client = flask_app.test_client()
+            token = self._authenticate(client, args.email, args.password)
+            report = self._measure(client, token, pubsub, usernames, args)
+        finally:
+            pubsub.close()
+            self._stop_workers(workers)
+            splash.stop()
+
+        report['splash_requests'] = splash.requests
+        report['splash_errors'] = splash.errors
+        report['parameters'] = {
+            'usernames': len(usernames),
+            'group': args.group,
+            'workers': args.workers,
+            'latency': args.latency,
+            'jitter': args.jitter,
+            'error_rate': args.error_rate,
+            'replay': args.replay,
+            'speed': args.speed,
+        }
+        report['git_revision'] = git_revision()
+        report['date'] = datetime.utcnow().isoformat()
+
+        print(json.dumps(report, indent=2, sort_keys=True))
+        path = save_report(report, args.output_dir, args.label)
+        self._logger.info('Saved report to %s', path)
+
+    def _authenticate(self, client, email, password):
+        ''' Return an auth token for `email`. '''
+
+        response = client.post(
+            '/api/authentication/',
+            data=json.dumps({'email': email, 'password': password}),
+            content_type='application/json'
+        )
+
+        if response.status_code != 200:
+            raise cli.CliError('Cannot authenticate as "{}".'.format(email))
+
+        return json.loads(response.get_data(as_text=True))['token']
+
+    def _measure(self, client, token, pubsub, usernames, args):
+        '''
+        Submit the searches and wait for all of their results and final
+        archives. Returns a report dictionary.
+        '''
+
+        request_json = {'usernames': usernames}
+
+        if args.group is not None:
+            request_json['group'] = args.group
+
+        started = time.time()
+        response = client.post(
+            '/api/username/',
+            data=json.dumps(request_json),
+            content_type='application/json',
+            headers={'X-Auth': token}
+        )
+
+        if response.status_code != 202:
+            raise cli.CliError('Search request failed ({}): {}'.format(
+                response.status_code, response.get_data(as_text=True)
+            ))
+
+        submitted = time.time()
+        tracker_ids = set(json.loads(
+            response.get_data(as_text=True)
+        )['tracker_ids'].values())
+        result_latencies = []
+        archive_latencies = []
+        statuses = {'f': 0, 'n': 0, 'e': 0}
+        totals = dict()
+        pending_archives = set(tracker_ids)
+        deadline = started + args.timeout
+        last_result = submitted
+
+        self._logger.info('Submitted %d searches; waiting for results.',
+                          len(tracker_ids))
+
+        while len(pending_archives) > 0 and time.time() < deadline:
+            message = pubsub.get_message(timeout=1)
+
+            if message is None:
+                continue
+
+            now = time.time()
+            data = json.loads(message['data'].decode('utf8'))
+
+            if message['channel'] == b'result':
+                if data['tracker_id'] not in tracker_ids:
+                    continue
+
+                result_latencies.append(now - submitted)
+                statuses[data['status']] += 1
+                totals[data['tracker_id']] = data['total']
+                last_result = now
+            else:
+                archive = data['archive']
+                tracker_id = archive['tracker_id']
+
+                if tracker_id in pending_archives and \
+                        tracker_id in totals and \
+                        archive['site_count'] >= totals[tracker_id]:
+                    archive_latencies.append(now - submitted)
+                    pending_archives.remove(tracker_id)
+
+        if len(pending_archives) > 0:
+            self._logger.warning('Timed out waiting for %d searches.',
+                                 len(pending_archives))
+
+        elapsed = last_result - submitted
+        checks = len(result_latencies)
+
+        return {
+            'checks': checks,
+            'checks_per_second': checks / elapsed if elapsed > 0 else None,
+            'elapsed': elapsed,
+            'submit_seconds': submitted - started,
+            'statuses': statuses,
+            'time_to_result': summarize(result_latencies),
+            'time_to_archive': summarize(archive_latencies),
+            'timed_out': len(pending_archives),
+        }
+
+    def _start_workers(self, count, splash_url):
+        '''
+        Start `count` workers for the batch, scrape and archive queues, which
+        send Splash requests to `splash_url`.
+        '''
+
+        script = os.path.join(get_path('bin'), 'run-worker.py')
+        workers = []
+
+        for _ in range(count):
+            workers.append(subprocess.Popen(
+                [sys.executable, script, 'batch', 'scrape', 'archive',
+                 '--splash-url', splash_url],
+                stdout=subprocess.DEVNULL
+            ))
+
+        return workers
+
+    def _stop_workers(self, workers):
+        ''' Stop worker processes and wait for them to exit. '''
+
+        for process in workers:
+            process.terminate()
+
+        for process in workers:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
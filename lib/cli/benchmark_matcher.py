@@ -0,0 +1,99 @@
+import json
+
+from bench.matcher import compare, load_corpus, run
+from bench.report import git_revision, save_report
+import cli
+from helper.functions import get_path
+
+
+class BenchmarkMatcherCli(cli.BaseCli):
+    '''
+    Time the page matchers against the corpus in lib/bench/corpus.
+
+    Exits with an error if any matcher returns an unexpected result, or if
+    a baseline report is given and parsing, matching or peak memory has
+    regressed past the tolerance.
+    '''
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            '--iterations',
+            type=int,
+            default=20,
+            metavar='N',
+            help='Number of times to parse and match each page. (Default: 20)'
+        )
+
+        arg_parser.add_argument(
+            '--baseline',
+            metavar='REPORT',
+            help='A report from an earlier run to compare against.'
+        )
+
+        arg_parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=0.25,
+            help='Allowed slowdown relative to the baseline, as a fraction. '
+                 '(Default: 0.25)'
+        )
+
+        arg_parser.add_argument(
+            '--output-dir',
+            default=get_path('data/benchmarks'),
+            help='Directory to save reports in. (Default: data/benchmarks)'
+        )
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        pages = load_corpus()
+        self._logger.info('Loaded %d pages; running %d iterations.',
+                          len(pages), args.iterations)
+        results = run(pages, args.iterations)
+
+        for name, page in sorted(results.items()):
+            self._logger.info(
+                '%s (%d bytes): parse %.2f ms, %s, peak %d KiB',
+                name,
+                page['bytes'],
+                page['parse_ms']['p50'],
+                ', '.join('{} {:.2f} ms'.format(match_type, times['p50'])
+                          for match_type, times
+                          in sorted(page['match_ms'].items())),
+                page['peak_memory'] // 1024
+            )
+
+        report = {
+            'git_revision': git_revision(),
+            'iterations': args.iterations,
+            'pages': results,
+        }
+        path = save_report(report, args.output_dir, 'matcher')
+        self._logger.info('Saved report to %s', path)
+
+        mismatches = [site for page in results.values()
+                      for site in page['mismatches']]
+
+        if len(mismatches) > 0:
+            raise cli.CliError('Unexpected match results: {}'.format(
+                ', '.join(mismatches)
+            ))
+
+        if args.baseline is not None:
+            with open(args.baseline) as baseline_file:
+                baseline = json.load(baseline_file)
+
+            regressions = compare(results, baseline['pages'], args.tolerance)
+
+            if len(regressions) > 0:
+                for regression in regressions:
+                    self._logger.error('Regression: %s', regression)
+
+                raise cli.CliError('{} regressions found.'.format(
+                    len(regressions)
+                ))
+
+            self._logger.info('No regressions against %s', args.baseline)
@@ -0,0 +1,64 @@
+import time
+
+from bench.replay import ReplaySplash
+import cli
+
+
+class ReplaySplashCli(cli.BaseCli):
+    '''
+    Serve recorded Splash responses.
+
+    Record responses by setting [splash] record_dir for the scrape workers,
+    then run this server and start workers with --splash-url pointing at it
+    to replay the same workload without contacting any real site.
+    '''
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            'record_dir',
+            help='The directory that responses were recorded in.'
+        )
+
+        arg_parser.add_argument(
+            '--ip',
+            default='127.0.0.1',
+            help='Specify an IP address to bind to. (Defaults to loopback.)'
+        )
+
+        arg_parser.add_argument(
+            '--port',
+            type=int,
+            default=8051,
+            help='Port to listen on. (Default: 8051)'
+        )
+
+        arg_parser.add_argument(
+            '--speed',
+            type=float,
+            default=1.0,
+            help='Replay speed relative to the recording, e.g. 2 to respond '
+                 'twice as fast, or 0 to respond immediately. (Default: 1)'
+        )
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        splash = ReplaySplash(args.record_dir,
+                              host=args.ip,
+                              port=args.port,
+                              speed=args.speed)
+        self._logger.info('Loaded %d recorded responses.', len(splash.index))
+        splash.start()
+        self._logger.info('Replaying on %s (speed %s)', splash.url, args.speed)
+
+        try:
+            while True:
+                time.sleep(60)
+                self._logger.info('%d requests, %d errors, %d not recorded',
+                                  splash.requests,
+                                  splash.errors,
+                                  splash.misses)
+        except KeyboardInterrupt:
+            splash.stop()
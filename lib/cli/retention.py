@@ -0,0 +1,39 @@
+import app.database
+import app.queue
+import cli
+import worker.retention
+
+
+class RetentionCli(cli.BaseCli):
+    '''
+    Delete old searches and unused files according to the policies in the
+    [retention] configuration section.
+    '''
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            '--queue',
+            action='store_true',
+            help='Queue a retention job for a worker on the retention queue '
+                 'instead of running it in this process.'
+        )
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        if args.queue:
+            job_id = app.queue.schedule_retention()
+            self._logger.info('Queued retention job %s.', job_id)
+            return
+
+        database_config = dict(config.items('database'))
+        db = app.database.get_engine(database_config)
+        session = app.database.get_session(db)
+
+        self._logger.info('Applying retention policies.')
+        report = worker.retention.collect(session, config)
+
+        for key, value in sorted(report.items()):
+            self._logger.info('%s: %d', key, value)
@@ -1,11 +1,49 @@
+import logging
 import sys
 from redis import Redis
-from rq import Queue, Connection, Worker
+from rq import Queue, Connection, SimpleWorker, Worker
 
 import cli
 import worker
 
 
+class PrewarmedWorker(SimpleWorker):
+    '''
+    A worker that runs jobs in its own process instead of forking a child
+    for each job.
+
+    Connection pools, imported modules and other process state are reused
+    from one job to the next, so each job starts without any setup cost.
+    Sessions are closed after each job (see worker.end_job()). A job that
+    crashes the process takes down only this worker, which the process
+    supervisor restarts; the job is then moved to the failed queue (or
+    queued again, if it can resume) by the next worker to start on this
+    host, or by the autoscaler (see worker.fail_orphaned_jobs()). Ordinary
+    job exceptions are handled as usual.
+    '''
+
+    def __init__(self, *args, max_jobs=None, **kwargs):
+        ''' Constructor. Stop after `max_jobs` jobs, if given. '''
+
+        super().__init__(*args, **kwargs)
+        self.max_jobs = max_jobs
+        self.jobs_executed = 0
+
+    def execute_job(self, *args, **kwargs):
+        ''' Run a job in this process, then clean up after it. '''
+
+        try:
+            return super().execute_job(*args, **kwargs)
+        finally:
+            worker.end_job()
+            self.jobs_executed += 1
+
+            if self.max_jobs is not None and \
+                    self.jobs_executed >= self.max_jobs:
+                self.log.info('Stopping after %d jobs.', self.jobs_executed)
+                self._stop_requested = True
+
+
 class RunWorkerCli(cli.BaseCli):
     '''
     A wrapper for RQ workers.
@@ -22,6 +60,29 @@ class RunWorkerCli(cli.BaseCli):
             help='Names of queues for this worker to service.'
         )
 
+        arg_parser.add_argument(
+            '--no-fork',
+            action='store_true',
+            help='Run jobs in this process instead of forking a child for '
+                 'each job. Database and Redis connections are opened once '
+                 'and reused for every job.'
+        )
+
+        arg_parser.add_argument(
+            '--max-jobs',
+            type=int,
+            metavar='N',
+            help='With --no-fork, exit after running N jobs, so that the '
+                 'process supervisor starts a fresh worker.'
+        )
+
+        arg_parser.add_argument(
+            '--splash-url',
+            metavar='URL',
+            help='Send Splash requests to URL instead of the splash_url '
+                 'configuration value (see [splash] url).'
+        )
+
     def _run(self, args, config):
         '''
         Main entry point.
@@ -33,7 +94,44 @@ class RunWorkerCli(cli.BaseCli):
         port = redis_config.get('port', 6379)
         host = redis_config.get('host', 'localhost')
 
+        if args.max_jobs is not None and not args.no_fork:
+            raise cli.CliError('--max-jobs requires --no-fork.')
+
+        if args.splash_url is not None:
+            worker.get_config().set('splash', 'url', args.splash_url)
+
+        # Log messages from jobs with the trace ID of the search that queued
+        # them (see app.trace).
+        job_log_handler = logging.StreamHandler(sys.stderr)
+        job_log_handler.setFormatter(logging.Formatter(
+            '%(asctime)s [%(name)s] %(levelname)s [%(trace_id)s]: %(message)s',
+            '%Y-%m-%d %H:%M:%S'
+        ))
+        job_log_handler.addFilter(worker.trace_log_filter)
+        job_logger = logging.getLogger('worker')
+        job_logger.addHandler(job_log_handler)
+        job_logger.setLevel(getattr(logging, args.verbosity.upper()))
+
+        # Import the job modules before forking, so that forked children
+        # don't import them for every job. Only connect if jobs will run in
+        # this process.
+        worker.warm_up(connect=args.no_fork)
+
+        # Fail the jobs of workers that crashed, e.g. this worker's
+        # predecessor.
+        orphaned = worker.fail_orphaned_jobs()
+
+        if orphaned > 0:
+            self._logger.warning('Recovered %d orphaned jobs.', orphaned)
+
         with Connection(Redis(host, port)):
             queues = map(Queue, args.queues)
-            w = Worker(queues, exc_handler=worker.handle_exception)
+
+            if args.no_fork:
+                w = PrewarmedWorker(queues,
+                                    exc_handler=worker.handle_exception,
+                                    max_jobs=args.max_jobs)
+            else:
+                w = Worker(queues, exc_handler=worker.handle_exception)
+
             w.work()
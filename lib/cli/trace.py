@@ -0,0 +1,113 @@
+from app.trace import read_trace
+import cli
+
+
+class TraceCli(cli.BaseCli):
+    '''
+    Print the spans of a username search and its critical path.
+
+    Spans are only recorded if [trace] span_file is set. The trace ID of a
+    search is returned by the API when the search is submitted.
+    '''
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            'trace_id',
+            help='The trace ID of the search.'
+        )
+
+        arg_parser.add_argument(
+            '--file',
+            action='append',
+            help='Read spans from this file instead of [trace] span_file. '
+                 'Repeat to read several files, e.g. rotated span files.'
+        )
+
+        arg_parser.add_argument(
+            '--phases',
+            action='store_true',
+            help='Include the phases of each job in the tree.'
+        )
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        spans = read_trace(args.trace_id, args.file)
+
+        if len(spans) == 0:
+            raise cli.CliError('No spans found for trace {}'.format(
+                args.trace_id
+            ))
+
+        span_ids = {span['span_id'] for span in spans}
+        children = dict()
+
+        for span in spans:
+            children.setdefault(span['parent_id'], []).append(span)
+
+        for siblings in children.values():
+            siblings.sort(key=lambda span: span['start'])
+
+        # The search request is the root. If its span is missing, jobs whose
+        # parent is unknown are shown as roots instead.
+        roots = [span for span in spans if span['parent_id'] not in span_ids]
+        origin = min(span['start'] for span in spans)
+
+        print('Trace {} ({} spans)'.format(args.trace_id, len(spans)))
+        print()
+
+        for root in sorted(roots, key=lambda span: span['start']):
+            self._print_tree(root, children, origin, 0, args.phases)
+
+        print()
+        print('Critical path:')
+        print()
+
+        root = max(roots, key=lambda span: span['end'])
+
+        for span in self._critical_path(root, children):
+            print(self._format_span(span, origin, 1))
+
+    def _critical_path(self, root, children):
+        '''
+        Return the chain of spans from `root` that determines when the trace
+        finished: at each level, the child that ended last.
+        '''
+
+        path = [root]
+
+        while path[-1]['span_id'] in children:
+            path.append(max(children[path[-1]['span_id']],
+                            key=lambda span: span['end']))
+
+        return path
+
+    def _format_span(self, span, origin, depth):
+        ''' Format a span as one line. '''
+
+        attributes = span.get('attributes') or {}
+        details = ', '.join('{}={}'.format(key, value)
+                            for key, value in sorted(attributes.items())
+                            if key != 'description' and value is not None)
+
+        return '{:>10.1f} ms {:>10.1f} ms  {}{}{}'.format(
+            (span['start'] - origin) * 1000,
+            (span['end'] - span['start']) * 1000,
+            '  ' * depth,
+            attributes.get('description') or span['name'],
+            ' ({})'.format(details) if details else ''
+        )
+
+    def _print_tree(self, span, children, origin, depth, phases):
+        ''' Print `span` and its descendants. '''
+
+        print(self._format_span(span, origin, depth))
+
+        for child in children.get(span['span_id'], []):
+            # Job spans have a queue; phases don't.
+            is_job = 'queue' in (child.get('attributes') or {})
+
+            if is_job or phases:
+                self._print_tree(child, children, origin, depth + 1, phases)
@@ -0,0 +1,656 @@
+'''
+Blob storage for file contents.
+
+A blob is identified by a key: the hex SHA-256 hash of its content,
+optionally followed by ``.<variant>`` for content derived from it (see
+model.file.blob_key()). Blobs are immutable: writing a key that already
+exists is a no-op.
+
+There are two backends, selected by ``[blob_store] backend``:
+
+``files``
+    Each blob is a separate file in the data directory, in a 2-level
+    fan-out: the blob with key e3b0c442... is stored in data/e/3/b0c442....
+
+``pack``
+    Small blobs are appended to large segment files in data/pack/, which
+    saves inodes and makes the data directory much faster to back up. Their
+    locations are recorded in an SQLite index, data/pack/index.sqlite. Blobs
+    larger than ``max_packed_size`` (e.g. zip files), and blobs written
+    before the pack backend was enabled, are still stored as separate files.
+
+Use get_store() to get the configured store.
+'''
+
+import abc
+import contextlib
+import fcntl
+import mmap
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+from helper.functions import get_path
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    ''' Return the blob store configured in ``[blob_store]``. '''
+
+    global _store
+
+    # Imported here, since importing the app package imports model.file,
+    # which imports this module.
+    import app.config
+
+    with _store_lock:
+        if _store is None:
+            config = dict(app.config.get_config().items('blob_store'))
+            file_store = FileStore(get_path('data'))
+
+            if config['backend'] == 'files':
+                _store = file_store
+            elif config['backend'] == 'pack':
+                _store = PackStore(
+                    os.path.join(get_path('data'), 'pack'),
+                    fallback=file_store,
+                    segment_size=int(config['segment_size']),
+                    max_packed_size=int(config['max_packed_size']),
+                    write_batch_size=int(config['write_batch_size']),
+                )
+            else:
+                raise ValueError('Unknown blob store backend: {}'
+                                 .format(config['backend']))
+
+        return _store
+
+
+class BlobStore(metaclass=abc.ABCMeta):
+    ''' Base class for blob stores. '''
+
+    def compact(self, threshold):
+        '''
+        Reclaim space used by deleted blobs in storage units where at least
+        `threshold` (0-1) of the space is unused. Returns the number of bytes
+        reclaimed.
+        '''
+
+        return 0
+
+    @abc.abstractmethod
+    def delete(self, key):
+        '''
+        Delete the blob with `key`, if it exists. Returns the number of bytes
+        it used.
+        '''
+
+    @abc.abstractmethod
+    def exists(self, key):
+        ''' Return True if there is a blob with `key`. '''
+
+    def flush(self):
+        ''' Make sure that all written blobs are durable and readable. '''
+
+        pass
+
+    @abc.abstractmethod
+    def iter_blobs(self, prefix=''):
+        '''
+        Generate a ``(key, size, mtime)`` tuple for each blob whose key starts
+        with `prefix`.
+        '''
+
+    def path(self, key):
+        '''
+        Return a filesystem path for the blob with `key`, or None if the blob
+        isn't stored in a file of its own.
+        '''
+
+        return None
+
+    @abc.abstractmethod
+    def read(self, key):
+        '''
+        Return the content of the blob with `key`.
+
+        Raises FileNotFoundError if there is no such blob.
+        '''
+
+    @abc.abstractmethod
+    def write(self, key, content):
+        ''' Store `content` as the blob with `key`. '''
+
+    def write_file(self, key, path):
+        '''
+        Store the file at `path` as the blob with `key`. The file is moved
+        (or removed) by this method, so it must be on the same filesystem as
+        the data directory.
+        '''
+
+        with open(path, 'rb') as file_:
+            self.write(key, file_.read())
+
+        os.unlink(path)
+
+
+class FileStore(BlobStore):
+    ''' Stores each blob in a separate file. '''
+
+    _KEY_RE = re.compile(r'^[0-9a-f]{64}(\.[a-z0-9_-]+)?$')
+
+    def __init__(self, root):
+        ''' Constructor. '''
+
+        self._root = root
+
+    def delete(self, key):
+        try:
+            path = self._path(key)
+            size = os.path.getsize(path)
+            os.unlink(path)
+        except FileNotFoundError:
+            return 0
+
+        return size
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def iter_blobs(self, prefix=''):
+        # Only walk the directories that can contain the prefix.
+        top = os.path.join(self._root, *prefix[:2])
+
+        for dir_path, dir_names, file_names in os.walk(top):
+            parts = os.path.relpath(dir_path, self._root).split(os.sep)
+
+            if len(parts) != 2:
+                continue
+
+            for file_name in file_names:
+                key = ''.join(parts) + file_name
+
+                # Skips temporary files (*.tmp) too.
+                if self._KEY_RE.match(key) is None or \
+                        not key.startswith(prefix):
+                    continue
+
+                try:
+                    stat = os.stat(os.path.join(dir_path, file_name))
+                except FileNotFoundError:
+                    continue
+
+                yield key, stat.st_size, stat.st_mtime
+
+    def path(self, key):
+        path = self._path(key)
+
+        return path if os.path.isfile(path) else None
+
+    def read(self, key):
+        with open(self._path(key), 'rb') as file_:
+            return file_.read()
+
+    def write(self, key, content):
+        path = self._path(key)
+
+        if os.path.isfile(path):
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so that concurrent readers never
+        # see a partially written blob.
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(content)
+
+            os.rename(temp_path, path)
+        except:
+            if os.path.isfile(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def write_file(self, key, path):
+        blob_path = self._path(key)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.rename(path, blob_path)
+
+    def _path(self, key):
+        ''' Return the path for `key`. '''
+
+        return os.path.join(self._root, key[0], key[1], key[2:])
+
+
+class PackStore(BlobStore):
+    '''
+    Stores small blobs in large, append-only segment files.
+
+    Blobs are appended to numbered segments (``<n>.seg``). Their locations
+    are recorded in an SQLite database, ``index.sqlite``, that all processes
+    share, so no process holds the index in memory. A blob's content is
+    appended and synced before its row is committed, so a row always refers
+    to complete content.
+
+    Writes are buffered and appended with a single write (and fsync) when
+    flush() is called, or when ``write_batch_size`` bytes are buffered.
+    Appends to a segment are serialized between processes with an exclusive
+    lock on the segment, and compactions with an exclusive lock on
+    ``compact.lock``. Segments are read through memory maps.
+    '''
+
+    _SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS blob ('
+        '  key TEXT PRIMARY KEY,'
+        '  segment INTEGER NOT NULL,'
+        '  offset INTEGER NOT NULL,'
+        '  length INTEGER NOT NULL,'
+        '  created REAL NOT NULL'
+        ') WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS blob_segment ON blob (segment)',
+    )
+
+    # Rows read per query by iter_blobs() and compact().
+    _CHUNK_SIZE = 1000
+
+    def __init__(self, root, fallback, segment_size, max_packed_size,
+                 write_batch_size):
+        ''' Constructor. '''
+
+        self._root = root
+        self._fallback = fallback
+        self._segment_size = segment_size
+        self._max_packed_size = max_packed_size
+        self._write_batch_size = write_batch_size
+        self._lock = threading.RLock()
+        self._pid = None
+        os.makedirs(root, exist_ok=True)
+
+        with self._transaction() as db:
+            for statement in self._SCHEMA:
+                db.execute(statement)
+
+    def compact(self, threshold):
+        with self._lock:
+            self.flush()
+            lock_path = os.path.join(self._root, 'compact.lock')
+
+            with open(lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+                # Read the index under the lock: another process may have
+                # compacted segments while this one was waiting.
+                live_bytes = dict(self._db().execute(
+                    'SELECT segment, SUM(length) FROM blob GROUP BY segment'
+                ))
+                active = self._active_segment()
+                reclaimed = 0
+
+                for segment in self._segments():
+                    if segment >= active:
+                        continue
+
+                    try:
+                        size = os.path.getsize(self._seg_path(segment))
+                    except FileNotFoundError:
+                        continue
+
+                    live = live_bytes.get(segment, 0)
+
+                    if size > 0 and (size - live) / size >= threshold:
+                        reclaimed += self._compact_segment(segment, size)
+
+            return reclaimed
+
+    def delete(self, key):
+        with self._lock:
+            self._check_pid()
+            size = self._fallback.delete(key)
+            self._pending = [p for p in self._pending if p[0] != key]
+            self._pending_bytes = sum(len(p[1]) for p in self._pending)
+
+            with self._transaction() as db:
+                row = db.execute('SELECT length FROM blob WHERE key = ?',
+                                 (key,)).fetchone()
+
+                if row is not None:
+                    db.execute('DELETE FROM blob WHERE key = ?', (key,))
+                    size += row[0]
+
+            return size
+
+    def exists(self, key):
+        with self._lock:
+            self._check_pid()
+
+            if any(p[0] == key for p in self._pending) or \
+                    self._lookup(key) is not None:
+                return True
+
+        return self._fallback.exists(key)
+
+    def flush(self):
+        with self._lock:
+            self._check_pid()
+
+            if len(self._pending) == 0:
+                return
+
+            pending = [(key, content, created, None)
+                       for key, content, created in self._pending]
+            self._pending = list()
+            self._pending_bytes = 0
+            self._append(pending)
+
+    def iter_blobs(self, prefix=''):
+        # Keys are ASCII, so every key with the prefix sorts below this.
+        end = prefix + '\x7f'
+        last = prefix
+
+        while True:
+            with self._lock:
+                rows = self._db().execute(
+                    'SELECT key, length, created FROM blob '
+                    'WHERE key >= ? AND key < ? ORDER BY key LIMIT ?',
+                    (last, end, self._CHUNK_SIZE)
+                ).fetchall()
+
+            if len(rows) == 0:
+                break
+
+            yield from rows
+            last = rows[-1][0] + '\x00'
+
+        yield from self._fallback.iter_blobs(prefix)
+
+    def path(self, key):
+        with self._lock:
+            if self._lookup(key) is not None:
+                return None
+
+        return self._fallback.path(key)
+
+    def read(self, key):
+        with self._lock:
+            self._check_pid()
+
+            for content_key, content, created in self._pending:
+                if content_key == key:
+                    return content
+
+            # If the segment was removed by a compaction in another process,
+            # the blob has moved: look it up again.
+            for attempt in range(2):
+                entry = self._lookup(key)
+
+                if entry is None:
+                    break
+
+                try:
+                    return self._read_entry(*entry)
+                except FileNotFoundError:
+                    self._close_map(entry[0])
+
+        return self._fallback.read(key)
+
+    def write(self, key, content):
+        if len(content) > self._max_packed_size:
+            self._fallback.write(key, content)
+            return
+
+        with self._lock:
+            if self.exists(key):
+                return
+
+            self._pending.append((key, bytes(content), time.time()))
+            self._pending_bytes += len(content)
+
+            if self._pending_bytes >= self._write_batch_size:
+                self.flush()
+
+    def write_file(self, key, path):
+        if os.path.getsize(path) > self._max_packed_size:
+            self._fallback.write_file(key, path)
+        else:
+            super().write_file(key, path)
+
+    def _active_segment(self):
+        ''' Return the number of the segment that new blobs are added to. '''
+
+        segments = self._segments()
+
+        if len(segments) == 0:
+            return self._next_segment(0)
+        else:
+            return segments[-1]
+
+    def _append(self, items):
+        '''
+        Append ``(key, content, created, source)`` `items` to the active
+        segment and record them in the index.
+
+        `source` is None for a new blob. For a blob moved by compaction it is
+        the ``(segment, offset)`` it was moved from, and its row is only
+        updated if it still points there, so that a blob deleted in the
+        meantime doesn't come back.
+        '''
+
+        segment = self._active_segment()
+
+        while True:
+            try:
+                fd = os.open(self._seg_path(segment),
+                             os.O_WRONLY | os.O_APPEND)
+            except FileNotFoundError:
+                segment = self._active_segment()
+                continue
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                stat = os.fstat(fd)
+
+                if stat.st_nlink == 0:
+                    # The segment was removed by a compaction.
+                    segment = self._active_segment()
+                    continue
+                elif stat.st_size >= self._segment_size:
+                    # Another process filled this segment: start the next.
+                    segment = self._next_segment(segment)
+                    continue
+
+                offset = stat.st_size
+                content = b''.join(item[1] for item in items)
+                view = memoryview(content)
+
+                while len(view) > 0:
+                    view = view[os.write(fd, view):]
+
+                os.fsync(fd)
+                self._index(segment, offset, items)
+                break
+            finally:
+                os.close(fd)
+
+    def _check_pid(self):
+        '''
+        After a fork, discard the database connection, memory maps and
+        buffered writes, which belong to the parent process.
+        '''
+
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._connection = None
+            self._maps = dict()
+            self._pending = list()
+            self._pending_bytes = 0
+
+    def _close_map(self, segment):
+        ''' Close the memory map of `segment`, if it's open. '''
+
+        seg_map = self._maps.pop(segment, None)
+
+        if seg_map is not None:
+            seg_map.close()
+
+    def _compact_segment(self, segment, size):
+        '''
+        Move the live blobs in `segment` (which is `size` bytes long) to the
+        active segment and remove it. The caller must hold the compaction
+        lock. Returns the number of bytes reclaimed.
+        '''
+
+        seg_path = self._seg_path(segment)
+        moved = 0
+
+        with open(seg_path, 'rb') as seg_file:
+            # Wait for any process that is still appending to it.
+            fcntl.flock(seg_file, fcntl.LOCK_EX)
+            last = ''
+
+            while True:
+                rows = self._db().execute(
+                    'SELECT key, offset, length, created FROM blob '
+                    'WHERE segment = ? AND key > ? ORDER BY key LIMIT ?',
+                    (segment, last, self._CHUNK_SIZE)
+                ).fetchall()
+
+                if len(rows) == 0:
+                    break
+
+                items = list()
+                batch_bytes = 0
+
+                for key, offset, length, created in rows:
+                    content = os.pread(seg_file.fileno(), length, offset)
+                    items.append((key, content, created, (segment, offset)))
+                    batch_bytes += length
+
+                    if batch_bytes >= self._write_batch_size:
+                        self._append(items)
+                        items = list()
+                        batch_bytes = 0
+
+                    moved += length
+
+                if len(items) > 0:
+                    self._append(items)
+
+                last = rows[-1][0]
+
+            self._close_map(segment)
+            os.unlink(seg_path)
+
+        return size - moved
+
+    def _db(self):
+        ''' Return this process's connection to the index. '''
+
+        self._check_pid()
+
+        if self._connection is None:
+            db = sqlite3.connect(os.path.join(self._root, 'index.sqlite'),
+                                 timeout=60,
+                                 isolation_level=None,
+                                 check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._connection = db
+
+        return self._connection
+
+    def _index(self, segment, offset, items):
+        '''
+        Record `items` (see _append()), which were appended to `segment` at
+        `offset`, in the index.
+        '''
+
+        with self._transaction() as db:
+            for key, content, created, source in items:
+                if source is None:
+                    db.execute(
+                        'INSERT OR IGNORE INTO blob '
+                        '(key, segment, offset, length, created) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (key, segment, offset, len(content), created)
+                    )
+                else:
+                    db.execute(
+                        'UPDATE blob SET segment = ?, offset = ? '
+                        'WHERE key = ? AND segment = ? AND offset = ?',
+                        (segment, offset, key) + source
+                    )
+
+                offset += len(content)
+
+    def _lookup(self, key):
+        ''' Return ``(segment, offset, length)`` for `key`, or None. '''
+
+        return self._db().execute(
+            'SELECT segment, offset, length FROM blob WHERE key = ?', (key,)
+        ).fetchone()
+
+    def _next_segment(self, segment):
+        ''' Create the segment after `segment` and return its number. '''
+
+        while True:
+            segment += 1
+
+            try:
+                fd = os.open(self._seg_path(segment),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                return segment
+            except FileExistsError:
+                if os.path.getsize(self._seg_path(segment)) < \
+                        self._segment_size:
+                    return segment
+
+    def _read_entry(self, segment, offset, length):
+        ''' Return `length` bytes at `offset` in `segment`. '''
+
+        seg_map = self._maps.get(segment)
+
+        if seg_map is None or len(seg_map) < offset + length:
+            self._close_map(segment)
+
+            with open(self._seg_path(segment), 'rb') as seg_file:
+                seg_map = mmap.mmap(seg_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+
+            self._maps[segment] = seg_map
+
+        return seg_map[offset:offset + length]
+
+    def _seg_path(self, segment):
+        return os.path.join(self._root, '{:06d}.seg'.format(segment))
+
+    def _segments(self):
+        ''' Return a sorted list of segment numbers. '''
+
+        return sorted(int(name[:-4]) for name in os.listdir(self._root)
+                      if name.endswith('.seg'))
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        '''
+        A context manager for a write transaction on the index. The index is
+        locked for writing when the transaction starts.
+        '''
+
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+
+        try:
+            yield db
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+        db.execute('COMMIT')
@@ -0,0 +1,108 @@
+'''
+Recorded Splash responses ("cassettes").
+
+When ``[splash] record_dir`` is set, the scrape worker saves each Splash
+response in a CassetteStore, and bench.replay.ReplaySplash serves them again
+later. Each cassette is a gzipped JSON document stored at
+``<root>/<site>/<username>.json.gz``, so recording the same site and
+username again replaces the earlier response. ``<root>/index.jsonl`` maps
+the rendered URLs to cassettes, since that is all a Splash request carries.
+'''
+
+import gzip
+import json
+import os
+import time
+from urllib.parse import quote
+
+
+INDEX_NAME = 'index.jsonl'
+
+
+class CassetteStore:
+    ''' A directory of recorded Splash responses. '''
+
+    def __init__(self, root):
+        ''' Constructor. '''
+
+        self.root = root
+
+    def path(self, site_name, username):
+        ''' Return the path of the cassette for `site_name` and `username`. '''
+
+        return os.path.join(self.root,
+                            quote(site_name, safe=''),
+                            '{}.json.gz'.format(quote(username, safe='')))
+
+    def record(self, site_name, username, url, status, body, elapsed):
+        '''
+        Save a Splash response.
+
+        `body` is the response body as bytes, `status` its HTTP status and
+        `elapsed` the number of seconds Splash took to respond.
+        '''
+
+        path = self.path(site_name, username)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cassette = {
+            'site': site_name,
+            'username': username,
+            'url': url,
+            'status': status,
+            'elapsed': elapsed,
+            'recorded': time.time(),
+            'body': body.decode('utf8'),
+        }
+
+        # Write to a temporary file and rename it so that a concurrent
+        # replay never reads a partial cassette.
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+        with gzip.open(temp_path, 'wt', encoding='utf8') as cassette_file:
+            json.dump(cassette, cassette_file)
+
+        os.rename(temp_path, path)
+
+        # Index lines are short enough to be appended atomically by
+        # concurrent workers.
+        entry = json.dumps({
+            'url': url,
+            'site': site_name,
+            'username': username,
+            'path': os.path.relpath(path, self.root),
+        })
+
+        with open(os.path.join(self.root, INDEX_NAME), 'a') as index_file:
+            index_file.write(entry + '\n')
+
+    def index(self):
+        '''
+        Return a dictionary that maps each recorded URL to its index entry,
+        a dictionary with keys ``url``, ``site``, ``username`` and ``path``.
+        '''
+
+        index = dict()
+        index_path = os.path.join(self.root, INDEX_NAME)
+
+        if not os.path.exists(index_path):
+            return index
+
+        with open(index_path) as index_file:
+            for line in index_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Skip a line truncated by a crash.
+                    continue
+
+                index[entry['url']] = entry
+
+        return index
+
+    def read(self, entry):
+        ''' Return the cassette for index `entry` as a dictionary. '''
+
+        path = os.path.join(self.root, entry['path'])
+
+        with gzip.open(path, 'rt', encoding='utf8') as cassette_file:
+            return json.load(cassette_file)
@@ -5,8 +5,10 @@ from sqlalchemy import (DateTime,
                         Integer,
                         String,
                         UniqueConstraint)
+from sqlalchemy.orm import relationship
 
 from model import Base
+from model.file import file_url
 
 
 class Archive(Base):
@@ -14,9 +16,7 @@ class Archive(Base):
 
     __tablename__ = 'archive'
     __table_args__ = (
-        UniqueConstraint('tracker_id',
-                         'zip_file_id',
-                         name='tracker_id_zip_file_id'),
+        UniqueConstraint('tracker_id', name='archive_tracker_id'),
     )
 
     id = Column(Integer, primary_key=True)
@@ -29,6 +29,23 @@ class Archive(Base):
     not_found_count = Column(Integer, nullable=False)
     error_count = Column(Integer, nullable=False)
     zip_file_id = Column(Integer, ForeignKey('file.id', name='fk_zip_file'))
+    zip_file = relationship('File',
+                            foreign_keys=[zip_file_id],
+                            lazy='joined')
+    contact_sheet_file_id = Column(
+        Integer,
+        ForeignKey('file.id', name='fk_contact_sheet_file')
+    )
+    contact_sheet_file = relationship('File',
+                                      foreign_keys=[contact_sheet_file_id])
+    contact_sheet_map_file_id = Column(
+        Integer,
+        ForeignKey('file.id', name='fk_contact_sheet_map_file')
+    )
+    contact_sheet_map_file = relationship(
+        'File',
+        foreign_keys=[contact_sheet_map_file_id]
+    )
 
     def __init__(self,
                  tracker_id,
@@ -38,7 +55,7 @@ class Archive(Base):
                  found_count,
                  not_found_count,
                  error_count,
-                 zip_file_id):
+                 zip_file_id=None):
         ''' Constructor. '''
 
         self.tracker_id = tracker_id
@@ -53,16 +70,38 @@ class Archive(Base):
     def as_dict(self):
         ''' Return dictionary representation of this archive. '''
 
-        return {
-            'id': self.id,
-            'tracker_id': self.tracker_id,
-            'username': self.username,
-            'group_id': self.group_id,
-            'date': self.date.isoformat(),
-            'site_count': self.site_count,
-            'found_count': self.found_count,
-            'not_found_count': self.not_found_count,
-            'error_count': self.error_count,
-            'zip_file_url': '/api/file/{}'.format(self.zip_file_id),
-            'zip_file_id': self.zip_file_id
-        }
+        return archive_row_dict(self)
+
+
+def archive_row_query(session):
+    '''
+    Return a query for archive rows suitable for archive_row_dict().
+
+    This selects plain columns instead of hydrating ``Archive`` instances.
+    '''
+
+    return session.query(*Archive.__table__.columns)
+
+
+def archive_row_dict(row):
+    '''
+    Return dictionary representation of an archive.
+
+    `row` may be an ``Archive`` or a row from archive_row_query().
+    '''
+
+    return {
+        'id': row.id,
+        'tracker_id': row.tracker_id,
+        'username': row.username,
+        'group_id': row.group_id,
+        'date': row.date.isoformat(),
+        'site_count': row.site_count,
+        'found_count': row.found_count,
+        'not_found_count': row.not_found_count,
+        'error_count': row.error_count,
+        'zip_file_url': '/api/archive/{}/download'.format(row.id),
+        'zip_file_id': row.zip_file_id,
+        'contact_sheet_url': file_url(row.contact_sheet_file_id),
+        'contact_sheet_map_url': file_url(row.contact_sheet_map_file_id),
+    }
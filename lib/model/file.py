@@ -1,39 +1,71 @@
 import time
 import binascii
 import hashlib
+import io
 import os
+import struct
+import tempfile
 import zipfile
-import string
 
-from sqlalchemy import Column, Integer, String
+from PIL import Image
+from sqlalchemy import (BigInteger,
+                        Column,
+                        event,
+                        ForeignKey,
+                        func,
+                        Integer,
+                        select,
+                        String)
 from sqlalchemy.dialects.postgresql import BYTEA
+from sqlalchemy.orm import Session
 
-from helper.functions import get_path, random_string
+from helper.blob import get_store
+from helper.functions import get_path
 from model import Base
 
 
 class File(Base):
     '''
-    Data model for a file stored in the file system.
+    Data model for a file stored in the blob store.
 
-    Files are stored in a content-addressable file system: a SHA-2 hash of the
-    content determines the path where it is stored. For example, a file with
-    hash e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855 is
-    stored in
-    data/e/3/b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855.
+    Files are stored in a content-addressable blob store (see helper.blob): a
+    SHA-2 hash of the content is the key it is stored under. For example, a
+    file with hash
+    e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855 has that
+    blob key. Use read() to get a file's content.
 
-    Zip archives can be created by setting zip_archive=True and passing a list of file tuples
-    and/or str_files tuples:
+    Zip archives are created with store_zip() (or streamed without being
+    stored with iter_zip()), which take a list of file tuples and/or
+    str_files tuples:
 
-    zip_files = [
-        ('filename.jpg','path/to/file')
+    files = [
+        ('filename.jpg', 'blob key', 'image/jpeg')
     ]
 
-    zip_str_files = [
-        ('filename.csv','some,juicy,content')
+    str_files = [
+        ('filename.csv', 'some,juicy,content', 'text/csv')
     ]
 
-    zip_str_files are created in-memory using StringIO and written as zipfile.ZipInfo.
+    Identical content is stored only once: use store_file() to create files,
+    which returns the existing row (and increments its ``ref_count``) when a
+    file with the same hash already exists. Use release_file() to drop a
+    reference.
+
+    A file's row and its blob are created and removed while holding a
+    transaction-level advisory lock on its hash (see _lock_hash()). Blobs are
+    only removed after the transaction that deleted the last row has been
+    committed, and only if no row with that hash has been created since.
+
+    Images also have derived variants (see IMAGE_VARIANTS), such as
+    thumbnails. A variant is generated from the original the first time it
+    is needed and stored under the original's key plus a suffix, e.g. the
+    thumbnail of the file above has key
+    e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855.thumb.
+
+    Images may have a perceptual hash (``phash``, see image_dhash()), which
+    is similar for images that look alike, so that near-duplicates can be
+    found with phash_neighbors(). A near-duplicate is still stored, but it
+    may record the earlier file that it looks like in ``canonical_file_id``.
     '''
 
     __tablename__ = 'file'
@@ -41,55 +73,57 @@ class File(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(255))
     mime = Column(String(255))
-    hash = Column(BYTEA(32))  # sha256
-
-    def __init__(self,
-                 name,
-                 mime,
-                 content=None,
-                 zip_archive=False,
-                 zip_files=[],
-                 zip_str_files=[]):
+    hash = Column(BYTEA(32), index=True, unique=True)  # sha256
+    ref_count = Column(Integer, nullable=False, default=1)
+    phash = Column(BigInteger, index=True)
+    canonical_file_id = Column(Integer,
+                               ForeignKey('file.id',
+                                          name='fk_canonical_file',
+                                          ondelete='SET NULL'),
+                               nullable=True)
+
+    def __init__(self, name, mime, content=None, hash_=None, phash=None):
         '''
         Constructor.
+
+        Either pass `content`, which is written to the blob store, or pass
+        the `hash_` of content that has already been written there.
         '''
 
         self.name = name
         self.mime = mime
+        self.phash = phash
 
-        # Create dummy content to use in hash if there is no content (zip archives)
         if content is None:
-            content = ('DUMMY DATA - {}' + random_string(1000)).encode('utf8')
+            if hash_ is None:
+                raise ValueError('Either content or hash_ is required.')
+
+            self.hash = hash_
+            return
 
         hash_ = hashlib.sha256()
         hash_.update(content)
         self.hash = hash_.digest()
+        get_store().write(self.blob_key(), content)
 
-        # Write content to file.
-        data_dir = get_path('data')
-        hash_hex = binascii.hexlify(self.hash).decode('ascii')
-        dir1 = os.path.join(data_dir, hash_hex[0])
-        dir2 = os.path.join(dir1, hash_hex[1])
-        path = os.path.join(dir2, hash_hex[2:])
+    def blob_key(self, variant=None):
+        ''' Return the blob key of this file, or of one of its `variant`s. '''
 
-        if not os.path.isdir(dir1):
-            os.mkdir(dir1)
+        return blob_key(self.hash, variant)
 
-        if not os.path.isdir(dir2):
-            os.mkdir(dir2)
+    def chown(self, uid, gid):
+        '''
+        Change ownership of this file and its two immediate ancestors, if it
+        is stored in a file of its own.
+        '''
 
-        if not os.path.isfile(path):
-            if zip_archive:
-                self.zip_files(path, zip_files, zip_str_files)
-            else:
-                file_ = open(path, 'wb')
-                file_.write(content)
-                file_.close()
+        store = get_store()
+        store.flush()
+        file_path = store.path(self.blob_key())
 
-    def chown(self, uid, gid):
-        ''' Change ownership of this file and its two immediate ancestors. '''
+        if file_path is None:
+            return
 
-        file_path = os.path.join(get_path('data'), self.relpath())
         os.chown(file_path, uid, gid)
 
         ancestor1_path = os.path.dirname(file_path)
@@ -98,41 +132,19 @@ class File(Base):
         ancestor2_path = os.path.dirname(ancestor1_path)
         os.chown(ancestor2_path, uid, gid)
 
-    def zip_files(self, path, files, str_files):
-        ''' Create a zip archive of files and string files.'''
-
-        zip_file = zipfile.ZipFile(path, 'w')
-        data_dir = get_path('data')
-
-        # Add files
-        for f in files:
-            f_path = os.path.join(data_dir, f[1])
-            zip_file.write(f_path, arcname=f[0], compress_type=zipfile.ZIP_DEFLATED)
-
-        # Write string files
-        for str_file in str_files:
-            info = zipfile.ZipInfo(str_file[0])
-            info.date_time = time.localtime(time.time())[:6]
-            info.compress_type = zipfile.ZIP_DEFLATED
-            # http://stackoverflow.com/questions/434641/how-do-i-set-permissions-attributes-on-a-file-in-a-zip-file-using-pythons-zip/6297838#6297838
-            info.external_attr = 0o644 << 16 # rw-r-r
-            zip_file.writestr(info, str_file[1])
-
-        zip_file.close()
-
-    def relpath(self):
-        ''' Return path to the file relative to the data directory. '''
-
-        hash_ = binascii.hexlify(self.hash).decode('ascii')
+    def read(self, variant=None):
+        '''
+        Return the content of this file, or of one of its `variant`s (which
+        must already exist, see get_variant()).
+        '''
 
-        return os.path.join(hash_[0], hash_[1], hash_[2:])
+        return get_store().read(self.blob_key(variant))
 
-    def url(self):
+    def url(self, variant=None):
         '''
-        Return API relative URL for file.
+        Return API relative URL for file, or for one of its `variant`s.
         '''
-        return '/api/file/{}'.format(self.id)
-
+        return file_url(self.id, variant)
 
     def as_dict(self):
         ''' Return dictionary representation of this file. '''
@@ -141,6 +153,545 @@ class File(Base):
             'id': self.id,
             'name': self.name,
             'mime': self.mime,
-            'path': self.relpath(),
-            'url': '/api/file/{}'.format(self.id)
+            'url': '/api/file/{}'.format(self.id),
+            'canonical_file_id': self.canonical_file_id,
         }
+
+
+# Derived versions of image files, keyed by variant name. Each image is
+# scaled down to fit within `size` (but never scaled up) and saved in `format`
+# with the given PIL `options`.
+IMAGE_VARIANTS = {
+    'thumb': {
+        'size': (400, 300),
+        'format': 'JPEG',
+        'mime': 'image/jpeg',
+        'options': {'quality': 70, 'optimize': True, 'progressive': True},
+    },
+    'webp': {
+        'size': (1920, 10000),
+        'format': 'WEBP',
+        'mime': 'image/webp',
+        'options': {'quality': 80, 'method': 4},
+    },
+}
+
+
+_PHASH_MASK = (1 << 64) - 1
+
+
+class _BufferWriter:
+    '''
+    A write-only, non-seekable buffer whose contents can be drained
+    incrementally. Used to stream zip archives (see iter_zip()).
+    '''
+
+    def __init__(self):
+        ''' Constructor. '''
+
+        self._chunks = list()
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        ''' Return everything written since the last call and reset. '''
+
+        data = b''.join(self._chunks)
+        self._chunks = list()
+
+        return data
+
+
+class _HashingWriter:
+    '''
+    A write-only, non-seekable file wrapper that hashes everything written
+    through it.
+
+    Because it cannot seek, ``zipfile`` writes archives through it in a single
+    streaming pass (using data descriptors instead of seeking back to patch
+    each local header).
+    '''
+
+    def __init__(self, fileobj):
+        ''' Constructor. '''
+
+        self._fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self._fileobj.write(data)
+
+    def flush(self):
+        self._fileobj.flush()
+
+
+def hamming_distance(phash1, phash2):
+    ''' Return the number of bits that differ between two perceptual hashes. '''
+
+    return bin((phash1 ^ phash2) & _PHASH_MASK).count('1')
+
+
+def image_dhash(content):
+    '''
+    Return a 64 bit perceptual hash ("difference hash") of image `content`.
+
+    The image is reduced to 9x8 grayscale pixels and each bit records whether
+    a pixel is brighter than its right-hand neighbour, so small differences
+    such as timestamps or ads change few (if any) bits. The hash is returned
+    as a signed integer so that it fits in a BIGINT column.
+
+    Raises OSError if `content` isn't a readable image.
+    '''
+
+    image = Image.open(io.BytesIO(content)).convert('L')
+    pixels = list(image.resize((9, 8), Image.LANCZOS).getdata())
+    phash = 0
+
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            phash = (phash << 1) | (left > right)
+
+    return _signed_phash(phash)
+
+
+def phash_neighbors(phash, distance):
+    '''
+    Return a list of all perceptual hashes within Hamming `distance` of
+    `phash` (including `phash` itself).
+
+    The list grows quickly with `distance` (65 hashes for 1, 2,081 for 2), but
+    it lets near-duplicates be found with an indexed ``IN`` query.
+    '''
+
+    phashes = {phash & _PHASH_MASK}
+
+    for _ in range(distance):
+        phashes |= {p ^ (1 << bit) for p in phashes for bit in range(64)}
+
+    return [_signed_phash(p) for p in phashes]
+
+
+def pop_bytes_removed(session):
+    '''
+    Return the number of bytes of content removed after commits of
+    `session` since the last call.
+    '''
+
+    return session.info.pop('bytes_removed', 0)
+
+
+def retain_file(session, file_):
+    '''
+    Add one reference to `file_`. The caller is responsible for committing
+    the session.
+    '''
+
+    _lock_hash(session, file_.hash)
+    file_.ref_count = File.ref_count + 1
+    session.flush()
+
+
+def store_file(session, name, mime, content, phash=None):
+    '''
+    Store `content` and return a ``File`` for it.
+
+    If a file with identical content already exists, its reference count is
+    incremented and the existing file is returned; otherwise a new file is
+    created (with perceptual hash `phash`, if given). The caller is
+    responsible for committing the session.
+    '''
+
+    hash_ = hashlib.sha256(content).digest()
+
+    return _get_or_create(
+        session,
+        hash_,
+        lambda: File(name=name, mime=mime, content=content, phash=phash)
+    )
+
+
+def blob_key(hash_, variant=None):
+    '''
+    Return the blob key for content with `hash_`, or for its `variant`.
+    '''
+
+    key = binascii.hexlify(hash_).decode('ascii')
+
+    if variant is None:
+        return key
+    else:
+        return '{}.{}'.format(key, variant)
+
+
+def file_url(file_id, variant=None):
+    '''
+    Return API relative URL for the file with `file_id`, or for one of its
+    `variant`s, or None if `file_id` is None.
+    '''
+
+    if file_id is None:
+        return None
+    elif variant is None:
+        return '/api/file/{}'.format(file_id)
+    else:
+        return '/api/file/{}/{}'.format(file_id, variant)
+
+
+def get_variant(file_, variant):
+    '''
+    Return the blob key of `file_`'s `variant`, generating the variant first
+    if it doesn't exist yet.
+
+    Raises ValueError if `variant` is unknown or `file_` isn't an image.
+    '''
+
+    try:
+        spec = IMAGE_VARIANTS[variant]
+    except KeyError:
+        raise ValueError('Unknown variant: {}'.format(variant))
+
+    if file_.mime is None or not file_.mime.startswith('image/'):
+        raise ValueError('Only images have variants.')
+
+    store = get_store()
+    key = file_.blob_key(variant)
+
+    if not store.exists(key):
+        image = Image.open(io.BytesIO(file_.read()))
+
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        image.thumbnail(spec['size'], Image.LANCZOS)
+        content = io.BytesIO()
+        image.save(content, spec['format'], **spec['options'])
+        store.write(key, content.getvalue())
+        store.flush()
+
+    return key
+
+
+def store_zip(session, name, files=(), str_files=()):
+    '''
+    Build a zip archive of `files` and `str_files` (see ``File``) and return a
+    ``File`` for it.
+
+    The archive is written and hashed in a single streaming pass to a
+    temporary file in the data directory, which is then moved into the blob
+    store. The caller is responsible for committing the session.
+    '''
+
+    data_dir = get_path('data')
+    fd, temp_path = tempfile.mkstemp(dir=data_dir, suffix='.zip.tmp')
+
+    def make_file():
+        get_store().write_file(blob_key(hash_), temp_path)
+        return File(name=name, mime='application/zip', hash_=hash_)
+
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            writer = _HashingWriter(temp_file)
+            write_zip(writer, files, str_files)
+
+        hash_ = writer.hash.digest()
+        return _get_or_create(session, hash_, make_file)
+    finally:
+        # The temporary file is left over if the archive already exists.
+        if os.path.isfile(temp_path):
+            os.unlink(temp_path)
+
+
+def iter_zip(files=(), str_files=()):
+    '''
+    Generate a zip archive of `files` and `str_files` (see ``File``) as a
+    sequence of byte strings, without writing it to disk.
+
+    A chunk is produced after each member, so memory use is bounded by the
+    largest member rather than the whole archive.
+    '''
+
+    buffer = _BufferWriter()
+    zip_file = zipfile.ZipFile(buffer, 'w')
+
+    for _ in _write_zip_members(zip_file, files, str_files):
+        yield buffer.drain()
+
+    zip_file.close()
+    yield buffer.drain()
+
+
+def write_zip(fileobj, files=(), str_files=()):
+    '''
+    Write a zip archive of `files` and `str_files` (see ``File``) to
+    `fileobj`.
+
+    Each member's compression method is chosen by its MIME type (see
+    zip_compress_type()).
+    '''
+
+    zip_file = zipfile.ZipFile(fileobj, 'w')
+
+    for _ in _write_zip_members(zip_file, files, str_files):
+        pass
+
+    zip_file.close()
+
+
+def zip_compress_type(mime):
+    '''
+    Return the zip compression method for a member with type `mime`.
+
+    Images and archives are already compressed, so deflating them costs CPU
+    for almost no size gain: store them as-is and deflate everything else.
+    '''
+
+    if mime.startswith('image/') or mime == 'application/zip':
+        return zipfile.ZIP_STORED
+    else:
+        return zipfile.ZIP_DEFLATED
+
+
+def release_file(session, file_):
+    '''
+    Drop one reference to `file_`.
+
+    When the last reference is released, the row is deleted, and the content
+    is removed from the blob store once the session is committed. Returns
+    True if the row was deleted. The caller is responsible for committing the
+    session.
+    '''
+
+    _lock_hash(session, file_.hash)
+    ref_count = _decrement(session, file_.id, 1)
+
+    if ref_count is not None and ref_count <= 0:
+        session.delete(file_)
+        session.flush()
+        _remove_after_commit(session, [file_.hash])
+        return True
+    else:
+        session.expire(file_, ['ref_count'])
+        return False
+
+
+def release_files(session, ref_counts):
+    '''
+    Drop references to many files at once: `ref_counts` maps file IDs to the
+    number of references to drop.
+
+    This is the batch equivalent of release_file(). Returns the number of
+    files deleted. The caller is responsible for committing the session.
+    '''
+
+    files = session.query(File.id, File.hash) \
+                   .filter(File.id.in_(list(ref_counts.keys()))) \
+                   .all()
+
+    # Lock in a consistent order, so that concurrent batches can't deadlock.
+    for hash_ in sorted({bytes(file_.hash) for file_ in files}):
+        _lock_hash(session, hash_)
+
+    released = [file_ for file_ in files
+                if _decrement(session, file_.id, ref_counts[file_.id]) <= 0]
+
+    if len(released) == 0:
+        return 0
+
+    session.query(File) \
+           .filter(File.id.in_([file_.id for file_ in released])) \
+           .delete(synchronize_session=False)
+    _remove_after_commit(session, [file_.hash for file_ in released])
+
+    return len(released)
+
+
+def remove_blobs(hash_):
+    '''
+    Remove the content with `hash_`, and all of its variants, from the blob
+    store. Returns the number of bytes removed.
+
+    This does not check whether a file still refers to the content: use
+    release_file() instead.
+    '''
+
+    store = get_store()
+    keys = [blob_key(hash_)]
+    keys.extend(blob_key(hash_, variant) for variant in IMAGE_VARIANTS)
+
+    return sum(store.delete(key) for key in keys)
+
+
+def remove_unused_blobs(session, hash_, keys=None):
+    '''
+    Remove the content with `hash_` and all of its variants (or only the
+    blobs with `keys`) from the blob store, unless a file refers to it.
+    Returns the number of bytes removed, or None if the content is in use.
+
+    The check is made while holding the hash's lock, which is held until the
+    end of the transaction: the caller is responsible for ending it.
+    `session` may also be a connection.
+    '''
+
+    _lock_hash(session, hash_)
+    existing = session.execute(
+        select([File.id]).where(File.hash == hash_).limit(1)
+    ).first()
+
+    if existing is not None:
+        return None
+    elif keys is None:
+        return remove_blobs(hash_)
+    else:
+        store = get_store()
+        return sum(store.delete(key) for key in keys)
+
+
+@event.listens_for(Session, 'before_commit')
+def _flush_blobs(session):
+    '''
+    The blob store may buffer writes: make blobs written during a transaction
+    durable and readable before the transaction's rows are committed.
+    '''
+
+    get_store().flush()
+
+
+@event.listens_for(Session, 'after_commit')
+def _remove_released_blobs(session):
+    '''
+    Remove the content of files deleted by the transaction that was just
+    committed (see _remove_after_commit()).
+
+    Each hash is checked again while holding its lock, in a transaction of
+    its own: the content is kept if a file with the same hash was created in
+    the meantime, or if the deletion was rolled back.
+    '''
+
+    if session.transaction is not None and session.transaction.nested:
+        # Releasing a savepoint doesn't commit anything.
+        return
+
+    hashes = session.info.pop('released_hashes', None)
+
+    if not hashes:
+        return
+
+    bytes_removed = 0
+
+    for hash_ in sorted(hashes):
+        with session.get_bind().begin() as connection:
+            bytes_removed += remove_unused_blobs(connection, hash_) or 0
+
+    session.info['bytes_removed'] = \
+        session.info.get('bytes_removed', 0) + bytes_removed
+
+
+def _decrement(session, file_id, count):
+    '''
+    Subtract `count` from the reference count of file `file_id`, and return
+    the new count (or None if there is no such file).
+    '''
+
+    return session.execute(
+        File.__table__.update()
+                      .where(File.id == file_id)
+                      .values(ref_count=File.ref_count - count)
+                      .returning(File.ref_count)
+    ).scalar()
+
+
+def _get_or_create(session, hash_, make_file):
+    '''
+    Return the ``File`` with `hash_`, incrementing its reference count, or
+    add the new file returned by `make_file()` if there is none.
+
+    `make_file()` writes the content to the blob store. It is called while
+    holding the hash's lock, so the content can't be removed by a concurrent
+    release of the last file with the same hash.
+    '''
+
+    _lock_hash(session, hash_)
+    file_ = session.query(File).filter(File.hash == hash_).first()
+
+    if file_ is None:
+        file_ = make_file()
+        session.add(file_)
+        session.flush()
+    else:
+        retain_file(session, file_)
+
+    return file_
+
+
+def _lock_hash(session, hash_):
+    '''
+    Take an advisory lock on `hash_` that is held until the end of the
+    current transaction. `session` may also be a connection.
+
+    The lock key is the first 8 bytes of the hash: a collision only makes
+    unrelated files wait for each other.
+    '''
+
+    key = struct.unpack('>q', bytes(hash_[:8]))[0]
+    session.execute(select([func.pg_advisory_xact_lock(key)]))
+
+
+def _remove_after_commit(session, hashes):
+    '''
+    Remove the content with `hashes` once the session is committed (see
+    _remove_released_blobs()).
+    '''
+
+    session.info.setdefault('released_hashes', set()) \
+                .update(bytes(hash_) for hash_ in hashes)
+
+
+def _signed_phash(phash):
+    ''' Convert an unsigned 64 bit perceptual hash to a signed integer. '''
+
+    if phash >= 1 << 63:
+        return phash - (1 << 64)
+    else:
+        return phash
+
+
+def _write_zip_members(zip_file, files, str_files):
+    '''
+    Add `files` and `str_files` to `zip_file`, yielding after each member.
+    '''
+
+    store = get_store()
+
+    # Add files
+    for arcname, key, mime in files:
+        compress_type = zip_compress_type(mime)
+        path = store.path(key)
+
+        if path is not None:
+            zip_file.write(path, arcname=arcname, compress_type=compress_type)
+        else:
+            info = zipfile.ZipInfo(arcname)
+            info.date_time = time.localtime(time.time())[:6]
+            info.compress_type = compress_type
+            info.external_attr = 0o644 << 16 # rw-r-r
+            zip_file.writestr(info, store.read(key))
+
+        yield
+
+    # Write string files
+    for arcname, content, mime in str_files:
+        info = zipfile.ZipInfo(arcname)
+        info.date_time = time.localtime(time.time())[:6]
+        info.compress_type = zip_compress_type(mime)
+        # http://stackoverflow.com/questions/434641/how-do-i-set-permissions-attributes-on-a-file-in-a-zip-file-using-pythons-zip/6297838#6297838
+        info.external_attr = 0o644 << 16 # rw-r-r
+        zip_file.writestr(info, content)
+        yield
@@ -6,6 +6,7 @@ from sqlalchemy import ForeignKey
 from sqlalchemy import UniqueConstraint
 from sqlalchemy.orm import relationship
 from model import Base
+from model.site import Site
 
 
 group_join_site = Table(
@@ -30,7 +31,8 @@ class Group(Base):
     # One group has 0-n sites.
     sites = relationship(
         'Site',
-        secondary=group_join_site
+        secondary=group_join_site,
+        order_by='Site.name'
     )
 
     def __init__(self, name, sites):
@@ -39,13 +41,39 @@ class Group(Base):
         self.name = name
         self.sites = sites
 
-    def as_dict(self):
-        ''' Return dictionary representation of this site. '''
-        # Sort labels by name
-        sites = [site.as_dict() for site in self.sites]
-        sorted_sites = sorted(sites, key=lambda x: x['name'])
+    def as_dict(self, expand_sites=False):
+        '''
+        Return dictionary representation of this group.
+
+        Sites are represented by their ID and name only, unless
+        `expand_sites` is True.
+        '''
+
+        if expand_sites:
+            sites = [site.as_dict() for site in self.sites]
+        else:
+            sites = [{'id': site.id, 'name': site.name} for site in self.sites]
+
         return {
             'id': self.id,
             'name': self.name,
-            'sites': sorted_sites,
+            'sites': sites,
         }
+
+
+def group_site_query(session, group_ids):
+    '''
+    Return a query for the sites that belong to the groups in `group_ids`.
+
+    Each row has ``group_id``, ``id`` and ``name`` columns, ordered by site
+    name. This loads the sites for many groups in one query without
+    hydrating ``Site`` instances.
+    '''
+
+    return (
+        session
+        .query(group_join_site.c.group_id, Site.id, Site.name)
+        .join(Site, Site.id == group_join_site.c.site_id)
+        .filter(group_join_site.c.group_id.in_(group_ids))
+        .order_by(Site.name)
+    )
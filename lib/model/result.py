@@ -1,12 +1,15 @@
 from sqlalchemy import (Column,
                         ForeignKey,
+                        Index,
                         Integer,
                         String,
                         UniqueConstraint)
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql.expression import type_coerce
 from sqlalchemy_utils import ChoiceType
 
 from model import Base
+from model.file import File, file_url
 
 
 class Result(Base):
@@ -15,6 +18,9 @@ class Result(Base):
     __tablename__ = 'result'
     __table_args__ = (
         UniqueConstraint('tracker_id', 'site_url', name='tracker_id_site_url'),
+        # Finds the results that use a file, e.g. for near-duplicate
+        # screenshots of a site (see worker.scrape).
+        Index('ix_result_image_file', 'image_file_id', 'site_name', 'status'),
     )
 
     STATUS_TYPES = [
@@ -32,11 +38,12 @@ class Result(Base):
                            ForeignKey('file.id',
                                       name='fk_image_file'),
                            nullable=True)
+    # Files are shared between results with identical screenshots, so they
+    # are not deleted along with a result: see model.file.release_file().
     image_file = relationship('File',
                               lazy='joined',
                               backref='result',
-                              uselist=False,
-                              cascade='all')
+                              uselist=False)
     error = Column(String(255), nullable=True)
 
     def __init__(self,
@@ -57,17 +64,60 @@ class Result(Base):
         self.thumb = thumb
         self.error = error
 
+    @property
+    def image_file_name(self):
+        ''' The name of the screenshot file, as in result_row_query(). '''
+
+        if self.image_file is None:
+            return None
+
+        return self.image_file.name
+
     def as_dict(self):
         ''' Return dictionary representation of this result. '''
 
-        return {
-            'error': self.error,
-            'id': self.id,
-            'image_file_id': self.image_file_id,
-            'image_file_url': self.image_file.url(),
-            'image_file_name': self.image_file.name,
-            'site_name': self.site_name,
-            'site_url': self.site_url,
-            'status': self.status.code,
-            'tracker_id': self.tracker_id,
-        }
+        return result_row_dict(self)
+
+
+def result_row_query(session):
+    '''
+    Return a query for result rows suitable for result_row_dict().
+
+    This selects plain columns instead of hydrating ``Result`` and ``File``
+    instances, which is much cheaper for large lists.
+    '''
+
+    return (
+        session
+        .query(Result.id,
+               Result.tracker_id,
+               Result.site_name,
+               Result.site_url,
+               type_coerce(Result.status, String).label('status'),
+               Result.image_file_id,
+               Result.error,
+               File.name.label('image_file_name'))
+        .outerjoin(File, Result.image_file_id == File.id)
+    )
+
+
+def result_row_dict(row):
+    '''
+    Return dictionary representation of a result.
+
+    `row` may be a ``Result`` or a row from result_row_query().
+    '''
+
+    return {
+        'error': row.error,
+        'id': row.id,
+        'image_file_id': row.image_file_id,
+        'image_file_url': file_url(row.image_file_id),
+        'image_file_thumb_url': file_url(row.image_file_id, 'thumb'),
+        'image_file_name': row.image_file_name,
+        'site_name': row.site_name,
+        'site_url': row.site_url,
+        # A Result's status is a Choice; the query selects the code.
+        'status': getattr(row.status, 'code', row.status),
+        'tracker_id': row.tracker_id,
+    }
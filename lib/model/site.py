@@ -57,6 +57,9 @@ class Site(Base):
                                    cascade='all')
     tested_at = Column(DateTime, nullable=True)
     valid = Column(Boolean, nullable=False, default=False)
+    # Set when a site test's "not found" screenshot looks different from the
+    # previous test's, which often means that the site definition is broken.
+    not_found_changed = Column(Boolean, nullable=False, default=False)
 
     def __init__(self, name, url, category, test_username_pos,
                  status_code=None, match_type=None, match_expr=None,
@@ -76,44 +79,77 @@ class Site(Base):
         else:
             self.test_username_neg = test_username_neg
 
-    def as_dict(self):
-        ''' Return dictionary representation of this site. '''
+    def as_dict(self, test_results=True):
+        '''
+        Return dictionary representation of this site.
 
-        # Preformat..
-        if self.tested_at:
-            tested_at = self.tested_at.isoformat()
-        else:
-            tested_at = None
+        If `test_results` is False, the nested test results are replaced by
+        their IDs so that the test results (and their files) do not need to
+        be loaded.
+        '''
 
-        if self.test_result_pos:
-            test_result_pos = self.test_result_pos.as_dict()
-        else:
-            test_result_pos = None
+        site_dict = site_row_dict(self)
 
-        if self.test_result_neg:
-            test_result_neg = self.test_result_neg.as_dict()
-        else:
-            test_result_neg = None
-
-        return {
-            'id': self.id,
-            'name': self.name,
-            'url': self.url,
-            'category': self.category,
-            'status_code': self.status_code,
-            'match_type': self.match_type,
-            'match_type_description': self.MATCH_TYPES[self.match_type],
-            'match_expr': self.match_expr,
-            'test_username_pos': self.test_username_pos,
-            'test_username_pos_url': self.get_url(self.test_username_pos),
-            'test_username_neg': self.test_username_neg,
-            'test_username_neg_url': self.get_url(self.test_username_neg),
-            'test_result_pos': test_result_pos,
-            'test_result_neg': test_result_neg,
-            'tested_at': tested_at,
-            'valid': self.valid,
-        }
+        if test_results:
+            del site_dict['test_result_pos_id']
+            del site_dict['test_result_neg_id']
+
+            if self.test_result_pos:
+                site_dict['test_result_pos'] = self.test_result_pos.as_dict()
+            else:
+                site_dict['test_result_pos'] = None
+
+            if self.test_result_neg:
+                site_dict['test_result_neg'] = self.test_result_neg.as_dict()
+            else:
+                site_dict['test_result_neg'] = None
+
+        return site_dict
 
     def get_url(self, username):
         ''' Interpolate a username into this site's URL. '''
         return self.url % username
+
+
+def site_row_query(session):
+    '''
+    Return a query for site rows suitable for site_row_dict().
+
+    This selects plain columns instead of hydrating ``Site`` instances and
+    their eagerly loaded test results.
+    '''
+
+    return session.query(*Site.__table__.columns)
+
+
+def site_row_dict(row):
+    '''
+    Return dictionary representation of a site without nested test results.
+
+    `row` may be a ``Site`` or a row from site_row_query().
+    '''
+
+    if row.tested_at:
+        tested_at = row.tested_at.isoformat()
+    else:
+        tested_at = None
+
+    return {
+        'id': row.id,
+        'name': row.name,
+        'url': row.url,
+        'category': row.category,
+        'status_code': row.status_code,
+        'match_type': row.match_type,
+        'match_type_description': Site.MATCH_TYPES[row.match_type],
+        'match_expr': row.match_expr,
+        'test_username_pos': row.test_username_pos,
+        'test_username_pos_url': row.url % row.test_username_pos,
+        'test_username_neg': row.test_username_neg,
+        'test_username_neg_url': row.url % row.test_username_neg,
+        'test_result_pos_id': row.test_result_pos_id,
+        'test_result_neg_id': row.test_result_neg_id,
+        'tested_at': tested_at,
+        'valid': row.valid,
+        'not_found_changed': row.not_found_changed,
+    }
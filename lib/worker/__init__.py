@@ -2,17 +2,107 @@
 This package contains workers that handle work placed on the message queues.
 '''
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
 import json
+import os
+import socket
+import time
 
 import rq
+from rq.exceptions import NoSuchJobError
+from rq.job import JobStatus
+from rq.registry import StartedJobRegistry
 
+import app.admission
 import app.config
 import app.database
+import app.metrics
+import app.trace
 
 
 _config = None
 _db = None
 _redis = None
+_timings = None
+_timing_started = None
+_trace = None
+_trace_id = None
+_spans = None
+_sessions = []
+
+
+# Jobs that can be run again after their worker dies, e.g. batch planners
+# (see worker.batch), and how many times.
+RESUMABLE_JOBS = {'plan_batch'}
+MAX_RESUMES = 3
+
+# Adds the current job's trace ID to log records.
+trace_log_filter = app.trace.TraceLogFilter(lambda: _trace_id)
+
+
+def end_job():
+    '''
+    Release the resources used by the current job.
+
+    Workers that run many jobs in one process call this after each job, so
+    that sessions return their connections to the pool.
+    '''
+
+    global _timings, _trace, _trace_id, _spans
+
+    while len(_sessions) > 0:
+        _sessions.pop().close()
+
+    _timings = None
+    _trace = None
+    _trace_id = None
+    _spans = None
+
+
+def fail_orphaned_jobs():
+    '''
+    Move jobs left behind by dead workers on this host to the failed queue.
+
+    A worker that runs jobs in its own process (see cli.run_worker) has no
+    parent to notice if a job crashes it, so the job would stay in the
+    started registry until RQ expires it, long after its timeout. A worker
+    is dead if the process named by its RQ worker name (host.pid) no longer
+    exists. Its job is handled like any other failed job (see
+    handle_exception()), and the worker is unregistered. Jobs that can
+    resume where they left off (RESUMABLE_JOBS) are queued again instead, up
+    to MAX_RESUMES times.
+
+    Returns the number of jobs recovered.
+    '''
+
+    redis = get_redis()
+    orphaned = 0
+
+    for rq_worker in rq.Worker.all(connection=redis):
+        pid = rq_worker.name.rpartition('.')[2]
+
+        if not pid.isdigit() or rq_worker.name != get_worker_name(int(pid)) \
+                or _is_running(int(pid)):
+            continue
+
+        try:
+            job = rq_worker.get_current_job()
+        except NoSuchJobError:
+            job = None
+
+        if job is not None:
+            StartedJobRegistry(job.origin, connection=redis).remove(job)
+            _recover_job(job, rq_worker.name)
+            orphaned += 1
+
+        rq_worker.register_death()
+
+    if orphaned > 0:
+        flush_metrics()
+
+    return orphaned
 
 
 def finish_job():
@@ -22,7 +112,9 @@ def finish_job():
 
     if 'current' in job.meta:
         job.meta['current'] = job.meta['total']
-        job.save()
+
+    finish_timing(job)
+    job.save()
 
     notification = json.dumps({
         'id': job.id,
@@ -33,6 +125,56 @@ def finish_job():
     get_redis().publish('worker', notification)
 
 
+def finish_timing(job=None):
+    '''
+    Stop timing the current job (see start_timing()).
+
+    The timings, including the job's total run time, are stored in the job's
+    ``timings`` metadata and added to the histograms in app.metrics. The
+    caller is responsible for saving the job. Returns the timings.
+    '''
+
+    global _timings
+
+    if _timings is None:
+        return None
+
+    timings = _timings
+    timings['total'] = time.perf_counter() - _timing_started
+    _timings = None
+
+    if job is None:
+        job = get_job()
+
+    _write_spans(job)
+
+    job_type = _job_type(job)
+    job.meta['timings'] = timings
+    app.metrics.record_timings(get_redis(), job_type, timings)
+
+    for phase_name, seconds in timings.items():
+        app.metrics.observe('hgprofiler_job_phase_seconds',
+                            seconds,
+                            job=job_type,
+                            phase=phase_name)
+
+    app.metrics.count('hgprofiler_jobs_total',
+                      job=job_type,
+                      outcome='finished')
+    flush_metrics()
+
+    return timings
+
+
+def flush_metrics():
+    ''' Write this worker's buffered metrics to Redis (see app.metrics). '''
+
+    if _db is not None:
+        app.metrics.set_pool_gauges(_db)
+
+    app.metrics.flush(get_redis())
+
+
 def get_config():
     ''' Get application configuration. '''
 
@@ -62,6 +204,15 @@ def get_job():
     return rq.get_current_job(connection=get_redis())
 
 
+def get_worker_name(pid):
+    '''
+    Return the RQ worker name of process `pid` on this host. RQ names
+    workers after the short host name and the process ID.
+    '''
+
+    return '{}.{}'.format(socket.gethostname().partition('.')[0], pid)
+
+
 def get_redis():
     ''' Get a Redis connection handle. '''
 
@@ -75,9 +226,28 @@ def get_redis():
 
 
 def get_session():
-    ''' Get a database session (a.k.a. transaction). '''
+    '''
+    Get a database session (a.k.a. transaction).
+
+    The session is closed by end_job().
+    '''
+
+    session = app.database.get_session(get_db())
+    _sessions.append(session)
+
+    return session
+
 
-    return app.database.get_session(get_db())
+def get_trace():
+    '''
+    Return the trace for jobs queued by the current job, i.e. with the
+    current job as their parent span, or None if the job is not traced.
+    '''
+
+    if _trace is None:
+        return None
+
+    return {'trace_id': _trace['trace_id'], 'parent_id': _trace['span_id']}
 
 
 def handle_exception(job, exc_type, exc_value, traceback):
@@ -86,24 +256,40 @@ def handle_exception(job, exc_type, exc_value, traceback):
 
     Note `return True` at the end of this function: this tells RQ to continue
     handling this exception. We only register this exception handler so that
-    we can send a notification to the client.
+    we can send a notification to the client, count the failure, and release
+    the job's admission (see app.admission).
     '''
 
-    notification = json.dumps({
-        'id': job.id,
-        'status': 'failed',
-        'queue': job.origin,
-    })
+    global _timings
+
+    # Discard the failed job's timings, but keep its span so that the trace
+    # shows where it failed.
+    _timings = None
+    _job_failed(job, error=exc_type.__name__)
+    flush_metrics()
 
-    get_redis().publish('worker', notification)
     return True
 
 
-def init_job(job, description):
-    ''' Initialize job metadata. '''
+def init_job(job, description, trace=None, pipeline=None):
+    '''
+    Initialize job metadata.
+
+    `trace` is the job's trace (see app.trace), which is stored in the
+    metadata so that it can be seen with the job. Jobs receive their trace as
+    an argument, because a worker may dequeue the job before this saves it.
+
+    If `pipeline` is given, the commands are queued on it and the caller is
+    responsible for executing it.
+    '''
 
     job.meta['description'] = description
-    job.save()
+
+    if trace is not None:
+        job.meta['trace_id'] = trace['trace_id']
+        job.meta['parent_span_id'] = trace['parent_id']
+
+    job.save(pipeline=pipeline)
 
     notification = json.dumps({
         'id': job.id,
@@ -111,13 +297,52 @@ def init_job(job, description):
         'queue': job.origin,
     })
 
-    get_redis().publish('worker', notification)
+    (pipeline or get_redis()).publish('worker', notification)
+
+
+@contextmanager
+def phase(name):
+    '''
+    Time a phase of the current job. Does nothing if the job is not being
+    timed (see start_timing()).
+
+        with worker.phase('splash'):
+            ...
+    '''
+
+    started = time.time()
+    perf_started = time.perf_counter()
 
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - perf_started, started)
 
-def start_job(total=None):
-    ''' Mark the current job as started. '''
+
+def record_phase(name, seconds, started=None):
+    '''
+    Add `seconds` to the time spent in phase `name` by the current job.
+
+    If the job is traced and the phase's `started` time (a UNIX timestamp)
+    is given, the phase is also recorded as a span.
+    '''
+
+    if _timings is not None:
+        _timings[name] = _timings.get(name, 0) + seconds
+
+    if _spans is not None and started is not None:
+        _spans.append((name, started, started + seconds))
+
+
+def start_job(total=None, trace=None):
+    '''
+    Mark the current job as started.
+
+    `trace` is the trace that the job was queued with, if any.
+    '''
 
     job = get_job()
+    start_timing(job, trace)
 
     if total is not None:
         job.meta['total'] = total
@@ -133,6 +358,56 @@ def start_job(total=None):
     get_redis().publish('worker', notification)
 
 
+def start_timing(job=None, trace=None):
+    '''
+    Start timing the phases of the current job.
+
+    start_job() calls this, so it only needs to be called directly by jobs
+    that don't send job notifications. The first phase, ``queue_wait``, is
+    the time the job spent in the queue.
+
+    If `trace` is given (see app.trace) and a span file is configured, the
+    job and its phases are also written as spans when the job finishes. Log
+    records get the trace ID in either case.
+    '''
+
+    global _timings, _timing_started, _trace, _trace_id, _spans
+
+    if job is None:
+        job = get_job()
+
+    # Log records get the trace ID whether or not spans are written (see
+    # trace_log_filter).
+    _trace_id = trace['trace_id'] if trace is not None else None
+
+    now = time.time()
+    _timing_started = time.perf_counter()
+    _timings = OrderedDict()
+
+    if job.enqueued_at is not None:
+        # RQ records times in UTC.
+        waited = max(0, (datetime.utcnow() - job.enqueued_at).total_seconds())
+    else:
+        waited = None
+
+    if trace is not None and app.trace.tracing_enabled():
+        # The job's span starts when it was queued, so that it covers its
+        # queue_wait phase.
+        _trace = {
+            'trace_id': trace['trace_id'],
+            'parent_id': trace['parent_id'],
+            'span_id': job.id,
+            'start': now - (waited or 0),
+        }
+        _spans = []
+    else:
+        _trace = None
+        _spans = None
+
+    if waited is not None:
+        record_phase('queue_wait', waited, now - waited)
+
+
 def update_job(current):
     ''' Update the current job with new progress information. '''
 
@@ -154,3 +429,128 @@ def update_job(current):
     })
 
     get_redis().publish('worker', notification)
+
+
+def warm_up(connect=True):
+    '''
+    Prepare this process to run jobs.
+
+    Imports the job modules (and their dependencies, such as parsel, lxml
+    and PIL). If `connect` is True, also opens a database connection and a
+    Redis connection, which are kept in their pools for later jobs. Don't
+    connect in a process that will fork, since children must not share
+    connections with their parent.
+    '''
+
+    import worker.archive
+    import worker.batch
+    import worker.retention
+    import worker.scrape
+
+    if connect:
+        with get_db().connect() as connection:
+            connection.execute('SELECT 1')
+
+        get_redis().ping()
+
+
+def _is_running(pid):
+    ''' Return True if a process with ID `pid` exists. '''
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _recover_job(job, worker_name):
+    '''
+    Queue `job`, which was orphaned by worker `worker_name`, again if it can
+    resume. Otherwise, move it to the failed queue.
+    '''
+
+    redis = get_redis()
+    resumes = job.meta.get('resumes', 0)
+
+    if _job_type(job) in RESUMABLE_JOBS and resumes < MAX_RESUMES:
+        job.meta['resumes'] = resumes + 1
+        rq.Queue(job.origin, connection=redis).enqueue_job(job)
+    else:
+        job.set_status(JobStatus.FAILED)
+        rq.get_failed_queue(connection=redis).quarantine(
+            job,
+            exc_info='Worker {} died while running this job.'
+                     .format(worker_name)
+        )
+        _job_failed(job, error='WorkerDied')
+
+
+def _job_failed(job, error):
+    '''
+    Notify clients that `job` failed, count the failure, release the job's
+    admission and write its span with `error`.
+    '''
+
+    notification = json.dumps({
+        'id': job.id,
+        'status': 'failed',
+        'queue': job.origin,
+    })
+
+    get_redis().publish('worker', notification)
+
+    user_id = (job.kwargs or {}).get('user_id')
+
+    if user_id is not None:
+        app.admission.release(get_redis(), user_id, job_id=job.id)
+
+    _write_spans(job, error=error)
+    app.metrics.count('hgprofiler_jobs_total',
+                      job=_job_type(job),
+                      outcome='failed')
+
+
+def _job_type(job):
+    ''' Return the name of `job`'s function, e.g. "check_username". '''
+
+    return job.func_name.rpartition('.')[2]
+
+
+def _write_spans(job, **attributes):
+    '''
+    Write the current job's span and its phase spans, if the job is traced.
+    `attributes` are added to the job's span.
+    '''
+
+    global _trace, _spans
+
+    if _trace is None:
+        return
+
+    trace_id = _trace['trace_id']
+    job_span_id = _trace['span_id']
+    spans = [app.trace.span(trace_id,
+                            job_span_id,
+                            _trace['parent_id'],
+                            _job_type(job),
+                            _trace['start'],
+                            time.time(),
+                            queue=job.origin,
+                            description=job.meta.get('description'),
+                            **attributes)]
+
+    for name, start, end in _spans:
+        spans.append(app.trace.span(trace_id,
+                                    app.trace.new_span_id(),
+                                    job_span_id,
+                                    name,
+                                    start,
+                                    end))
+
+    _trace = None
+    _spans = None
+    app.trace.write_spans(spans)
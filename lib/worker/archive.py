@@ -2,11 +2,26 @@ import re
 import io
 import csv
 import json
+import math
+import os
 
-from sqlalchemy.orm import subqueryload
+from PIL import Image
+from sqlalchemy import func, String, type_coerce
+from sqlalchemy.exc import IntegrityError
 
+from app.tracker import get_tracker, STATUS_FIELDS
 import worker
 from model import Archive, File, Result
+from model.file import (blob_key,
+                        get_variant,
+                        release_file,
+                        store_file,
+                        store_zip)
+
+# Contact sheets have this many tiles per row, and each screenshot is scaled
+# to fit in a tile of this size.
+CONTACT_SHEET_COLUMNS = 10
+CONTACT_SHEET_TILE_SIZE = (200, 150)
 
 
 class ArchiveException(Exception):
@@ -16,6 +31,26 @@ class ArchiveException(Exception):
         self.message = message
 
 
+def archive_filename(username):
+    ''' Return the base filename (without extension) for `username`. '''
+
+    return re.sub('[\W_]+', '', username)  # Strip non-alphanumeric char
+
+
+def screenshot_name(result):
+    '''
+    Return the name of `result`'s screenshot inside an archive.
+
+    Screenshot files are shared between results with identical content, so
+    the file's own name may belong to a different site: name it after the
+    result's site instead.
+    '''
+
+    extension = os.path.splitext(result.image_file_name)[1]
+
+    return '{}{}'.format(result.site_name, extension)
+
+
 def results_csv_string(results):
     ''' Generate in-memory csv of the results and return it as a string. '''
 
@@ -30,11 +65,16 @@ def results_csv_string(results):
 
     # Add results
     for result in results:
+        if result.image_file_name is None:
+            screenshot = None
+        else:
+            screenshot = screenshot_name(result)
+
         data.append([
             result.site_name,
             result.site_url,
             result.status.value,
-            result.image_file.name,
+            screenshot,
         ])
 
     writer.writerows(data)
@@ -42,95 +82,308 @@ def results_csv_string(results):
     return output.getvalue()
 
 
-def create_zip(filename, results):
+def zip_members(db_session, archive):
     '''
-    Generate zip archive of results and return the file id.
+    Return the members of `archive`'s zip file as a tuple of
+    ``(files, str_files)``, suitable for model.file.store_zip() or
+    model.file.iter_zip().
 
-    Adds all images for results that have screenshots.
-    Adds csv result summary created on the fly (as IOString).
+    This selects only the result and file columns that are needed, rather
+    than loading ``Result`` and ``File`` instances.
     '''
 
-    db_session = worker.get_session()
+    results = (
+        db_session
+        .query(Result.site_name,
+               Result.site_url,
+               Result.status,
+               File.name.label('image_file_name'),
+               File.mime.label('image_file_mime'),
+               File.hash.label('image_file_hash'))
+        .outerjoin(File, Result.image_file_id == File.id)
+        .filter(Result.tracker_id == archive.tracker_id)
+        .order_by(Result.site_name)
+        .all()
+    )
+
     files = []
-    str_files = []
 
     # Create list of images
     for result in results:
-        # Add the name to results for the csv output
-        files.append((result.image_file.name, result.image_file.relpath()))
+        if result.image_file_hash is not None:
+            files.append((screenshot_name(result),
+                          blob_key(result.image_file_hash),
+                          result.image_file_mime))
 
     # Generate in-memory results csv
+    filename = archive_filename(archive.username)
     csv_string = results_csv_string(results)
-    str_file = ('{}.csv'.format(filename), csv_string)
-    str_files.append(str_file)
+    str_files = [('{}.csv'.format(filename), csv_string, 'text/csv')]
+
+    return files, str_files
+
+
+def create_zip(archive_id):
+    '''
+    Store the zip file for an archive in the data directory, so that later
+    downloads don't need to generate it again.
 
-    zip_file = File(name='{}.zip'.format(filename),
-                    mime='application/zip',
-                    zip_archive=True,
-                    zip_files=files,
-                    zip_str_files=str_files)
+    Archives are normally streamed on demand (see ArchiveView.download), so
+    this only runs for archives that are downloaded frequently.
+    '''
+
+    worker.start_job()
+    db_session = worker.get_session()
+    archive = db_session.query(Archive).get(archive_id)
 
-    db_session.add(zip_file)
+    if archive is None or archive.zip_file_id is not None:
+        worker.finish_job()
+        return
+
+    files, str_files = zip_members(db_session, archive)
 
     try:
+        zip_file = store_zip(
+            db_session,
+            name='{}.zip'.format(archive_filename(archive.username)),
+            files=files,
+            str_files=str_files
+        )
+        archive.zip_file_id = zip_file.id
         db_session.commit()
     except Exception as e:
+        db_session.rollback()
         raise ArchiveException(e)
 
-    return zip_file.id
+    worker.finish_job()
 
 
-def create_archive(username, group_id, tracker_id):
-    """
-    Archive summary of results in the database and store
-    a zip archive in the data directory.
-    """
+def create_contact_sheet(db_session, archive):
+    '''
+    Create a contact sheet for `archive` and store it in the archive's
+    ``contact_sheet_file``, with its tile map in ``contact_sheet_map_file``.
 
-    redis = worker.get_redis()
-    db_session = worker.get_session()
-    found_count = 0
-    not_found_count = 0
-    error_count = 0
+    The contact sheet is a single JPEG with a tile for each result's
+    screenshot, ordered by site name. The map is a JSON document like this:
+
+        {
+            "tile_width": 200,
+            "tile_height": 150,
+            "columns": 10,
+            "tiles": [
+                {"result_id": 1, "site_name": "About.me", "status": "f",
+                 "x": 0, "y": 0, "width": 200, "height": 150},
+                ...
+            ]
+        }
+
+    The caller is responsible for committing the session.
+    '''
 
     results = (
         db_session
-        .query(Result)
-        .options(subqueryload(Result.image_file))
-        .filter(Result.tracker_id == tracker_id)
+        .query(Result.id,
+               Result.site_name,
+               type_coerce(Result.status, String).label('status'),
+               File)
+        .join(File, Result.image_file_id == File.id)
+        .filter(Result.tracker_id == archive.tracker_id)
+        .order_by(Result.site_name)
         .all()
     )
-    site_count = len(results)
 
-    # Generate zip file
-    filename = re.sub('[\W_]+', '', username)  # Strip non-alphanumeric char
-    zip_file_id = create_zip(filename, results)
+    tile_width, tile_height = CONTACT_SHEET_TILE_SIZE
+    columns = max(1, min(CONTACT_SHEET_COLUMNS, len(results)))
+    rows = max(1, math.ceil(len(results) / columns))
+    sheet = Image.new('RGB', (columns * tile_width, rows * tile_height),
+                      'white')
+    tiles = []
 
-    for result in results:
-        if result.status == 'e':
-            error_count += 1
-        elif result.status == 'f':
-            found_count += 1
-        elif result.status == 'n':
-            not_found_count += 1
-
-    archive = Archive(tracker_id=tracker_id,
-                      username=username,
-                      group_id=group_id,
-                      site_count=site_count,
-                      found_count=found_count,
-                      not_found_count=not_found_count,
-                      error_count=error_count,
-                      zip_file_id=zip_file_id)
+    for index, result in enumerate(results):
+        try:
+            get_variant(result.File, 'thumb')
+            thumb = Image.open(io.BytesIO(result.File.read('thumb')))
+        except (OSError, ValueError):
+            # Leave a blank tile for unreadable images.
+            continue
+
+        thumb.thumbnail(CONTACT_SHEET_TILE_SIZE, Image.LANCZOS)
+        x = (index % columns) * tile_width
+        y = (index // columns) * tile_height
+        sheet.paste(thumb, (x, y))
+        tiles.append({
+            'result_id': result.id,
+            'site_name': result.site_name,
+            'status': result.status,
+            'x': x,
+            'y': y,
+            'width': thumb.width,
+            'height': thumb.height,
+        })
+
+    sheet_data = io.BytesIO()
+    sheet.save(sheet_data, 'JPEG', quality=75, optimize=True)
+    map_data = json.dumps({
+        'tile_width': tile_width,
+        'tile_height': tile_height,
+        'columns': columns,
+        'tiles': tiles,
+    })
+    filename = archive_filename(archive.username)
+
+    archive.contact_sheet_file = store_file(
+        db_session,
+        name='{}-contact-sheet.jpg'.format(filename),
+        mime='image/jpeg',
+        content=sheet_data.getvalue()
+    )
+    archive.contact_sheet_map_file = store_file(
+        db_session,
+        name='{}-contact-sheet.json'.format(filename),
+        mime='application/json',
+        content=map_data.encode('utf8')
+    )
+
+
+def create_archive(username, group_id, tracker_id, trace=None):
+    """
+    Create or update the summary of results for `tracker_id`.
+
+    There is one archive per search. The counts are read from the search's
+    progress tracker, which check_username() updates as each result arrives,
+    so this doesn't need to load the results. The zip file is not created
+    here: it is generated when the archive is downloaded.
+
+    `trace` is the search's trace, if any (see app.trace).
+    """
+
+    worker.start_timing(trace=trace)
+    redis = worker.get_redis()
+    db_session = worker.get_session()
+
+    with worker.phase('counts'):
+        tracker = get_tracker(redis, tracker_id)
+        counts = _result_counts(db_session, tracker_id, tracker)
+
+    site_count = sum(counts.values())
+
+    with worker.phase('lock'):
+        archive = _lock_archive(db_session, tracker_id)
+
+    status = 'updated'
+
+    if archive is None:
+        archive = Archive(tracker_id=tracker_id,
+                          username=username,
+                          group_id=group_id,
+                          site_count=site_count,
+                          found_count=counts['found'],
+                          not_found_count=counts['not_found'],
+                          error_count=counts['error'])
+
+        try:
+            # Archive jobs for the same search can run concurrently, so flush
+            # inside a savepoint and fall back to updating the existing row.
+            with db_session.begin_nested():
+                db_session.add(archive)
+            status = 'created'
+        except IntegrityError:
+            archive = _lock_archive(db_session, tracker_id)
+
+    if status == 'updated':
+        if archive.site_count > site_count:
+            # A job that ran later has already written newer counts.
+            db_session.rollback()
+            _finish_timing()
+            return
+
+        if archive.site_count < site_count and archive.zip_file is not None:
+            # A stored zip file is out of date once more results arrive.
+            zip_file = archive.zip_file
+            archive.zip_file = None
+            db_session.flush()
+            release_file(db_session, zip_file)
+
+        archive.site_count = site_count
+        archive.found_count = counts['found']
+        archive.not_found_count = counts['not_found']
+        archive.error_count = counts['error']
+
+    # The contact sheet is created once, when the last result arrives.
+    if tracker is not None and \
+            site_count >= tracker['total'] and \
+            archive.contact_sheet_file_id is None and \
+            worker.get_config().getboolean('archive', 'contact_sheet'):
+        with worker.phase('contact_sheet'):
+            create_contact_sheet(db_session, archive)
 
     # Write to db
-    db_session.add(archive)
-    db_session.commit()
+    with worker.phase('db_commit'):
+        db_session.commit()
 
     # Publish
-    message = {
-        'id': archive.id,
-        'name': archive.username,
-        'status': 'created',
-        'archive': archive.as_dict(),
-    }
-    redis.publish('archive', json.dumps(message))
+    with worker.phase('notify'):
+        message = {
+            'id': archive.id,
+            'name': archive.username,
+            'status': status,
+            'archive': archive.as_dict(),
+        }
+        redis.publish('archive', json.dumps(message))
+
+    _finish_timing()
+
+
+def _finish_timing():
+    '''
+    Record create_archive()'s phase timings.
+
+    Archive jobs don't send job notifications, so this is used instead of
+    worker.finish_job().
+    '''
+
+    job = worker.get_job()
+    worker.finish_timing(job)
+    job.save()
+
+
+def _lock_archive(db_session, tracker_id):
+    '''
+    Return the archive for `tracker_id`, locking its row until the end of the
+    transaction, or None if there is no archive yet.
+    '''
+
+    return (
+        db_session
+        .query(Archive)
+        .filter(Archive.tracker_id == tracker_id)
+        .with_for_update(of=Archive)
+        .first()
+    )
+
+
+def _result_counts(db_session, tracker_id, tracker):
+    '''
+    Return a dictionary of result counts for `tracker_id` with keys
+    ``found``, ``not_found`` and ``error``.
+
+    The counts come from the search's progress `tracker`. If the tracker has
+    expired (i.e. it is None), they are counted in the database with a single
+    grouped query.
+    '''
+
+    if tracker is not None:
+        return {field: tracker[field] for field in STATUS_FIELDS.values()}
+
+    counts = {field: 0 for field in STATUS_FIELDS.values()}
+    query = (
+        db_session
+        .query(type_coerce(Result.status, String), func.count(Result.id))
+        .filter(Result.tracker_id == tracker_id)
+        .group_by(Result.status)
+    )
+
+    for status, count in query:
+        counts[STATUS_FIELDS[status]] = count
+
+    return counts
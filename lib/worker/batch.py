@@ -0,0 +1,130 @@
+'''
+Planning of search batches (see app.batch).
+
+Each planner job expands the next ``[batch] plan_chunk_size`` usernames of a
+batch into scrape jobs, then queues another planner job for the rest, so
+that no single job runs for long. Planners run on their own queue. Each
+chunk is admitted before its jobs are queued (see app.admission): while the
+user has too many jobs outstanding, or the scrape queue is full, the planner
+waits up to ``[batch] max_wait`` seconds and then queues itself again, so
+that other batches get their turn.
+
+The jobs for each username, its tracker and the batch's progress are written
+with one pipelined transaction, so a planner that is run again (e.g. after
+its worker died, see worker.fail_orphaned_jobs()) resumes with the first
+username that wasn't planned.
+'''
+
+import time
+
+from app.admission import (admit, max_chunk_usernames, release,
+                           TooManyRequests)
+from app.batch import add_planned, get_batch, get_entries, set_batch_status
+import app.queue
+from app.tracker import init_tracker
+import worker
+from model import Site
+
+
+def plan_batch(batch_id, trace=None):
+    '''
+    Queue scrape jobs for the next chunk of usernames in batch `batch_id`.
+
+    `trace` is the search's trace, if any (see app.trace).
+    '''
+
+    worker.start_job(trace=trace)
+    redis = worker.get_redis()
+    db_session = worker.get_session()
+    config = worker.get_config()
+    batch = get_batch(redis, batch_id)
+
+    if batch is None or batch['planner'] != worker.get_job().id or \
+            batch['planned'] >= batch['usernames']:
+        # The batch has expired, another planner has taken over, or there is
+        # nothing left to plan.
+        worker.finish_job()
+        return
+
+    with worker.phase('site_query'):
+        sites = db_session.query(Site) \
+                          .filter(Site.id.in_(batch['site_ids'])) \
+                          .order_by(Site.id) \
+                          .all()
+
+    chunk_size = min(config.getint('batch', 'plan_chunk_size'),
+                     max_chunk_usernames(len(sites)))
+
+    with worker.phase('entries'):
+        entries = get_entries(redis, batch_id, batch['planned'], chunk_size)
+
+    jobs = len(entries) * len(sites)
+
+    try:
+        with worker.phase('admission'):
+            admit(redis, batch['user_id'], jobs)
+    except TooManyRequests as error:
+        set_batch_status(redis, batch_id, 'waiting')
+
+        with worker.phase('wait'):
+            time.sleep(min(error.retry_after,
+                           config.getint('batch', 'max_wait')))
+
+        app.queue.schedule_batch(batch_id, trace=worker.get_trace())
+        worker.finish_job()
+        return
+
+    set_batch_status(redis, batch_id, 'planning')
+    planned = 0
+
+    try:
+        with worker.phase('enqueue'):
+            for tracker_id, username in entries:
+                _plan_username(redis, batch, sites, tracker_id, username)
+                planned += 1
+    except Exception:
+        # The admitted jobs that weren't queued are no longer outstanding.
+        # Running the planner again resumes with the first username that
+        # wasn't planned.
+        release(redis, batch['user_id'], (len(entries) - planned) * len(sites))
+        set_batch_status(redis, batch_id, 'failed')
+        raise
+
+    if batch['planned'] + len(entries) < batch['usernames']:
+        app.queue.schedule_batch(batch_id, trace=worker.get_trace())
+    else:
+        set_batch_status(redis, batch_id, 'planned')
+
+    worker.finish_job()
+
+
+def _plan_username(redis, batch, sites, tracker_id, username):
+    '''
+    Queue a job for each site for `username`, in a single round trip.
+
+    The username's tracker was created with the batch. Sites that were
+    deleted since then are skipped, and are removed from the tracker's total.
+    '''
+
+    pipe = redis.pipeline(transaction=True)
+    total = len(sites)
+
+    if total != len(batch['site_ids']):
+        init_tracker(redis, tracker_id, total, pipeline=pipe)
+
+    for site in sites:
+        app.queue.schedule_username(
+            username=username,
+            site=site,
+            group_id=batch['group_id'],
+            total=total,
+            tracker_id=tracker_id,
+            test=batch['test'],
+            trace=worker.get_trace(),
+            user_id=batch['user_id'],
+            batch_id=batch['id'],
+            pipeline=pipe
+        )
+
+    add_planned(pipe, batch['id'], 1, total)
+    pipe.execute()
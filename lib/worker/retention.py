@@ -0,0 +1,342 @@
+'''
+Retention and garbage collection.
+
+Old searches are deleted according to the policies in the ``[retention]``
+section of the configuration:
+
+    max_age_days            delete searches older than this
+    keep_last               keep only this many of the most recent searches
+                            for each username
+    found_only_after_days   delete all but the "found" results of searches
+                            older than this
+
+A value of 0 disables a policy. Rows are deleted in batches of
+``batch_size``, using keyset iteration (see app.database.query_chunks()), and
+files are released as the rows that reference them are deleted. The archives
+of trimmed searches are recounted, and their stored zip files and contact
+sheets are released.
+
+Finally, the blob store is reconciled against the ``file`` table: blobs
+that no row refers to are deleted, rows whose blob is missing are counted,
+and pack files (see helper.blob) are compacted.
+'''
+
+from collections import Counter
+from datetime import timedelta
+import time
+
+from sqlalchemy import exists, func, or_, String, type_coerce
+
+from app.database import query_chunks
+from helper.blob import get_store
+import worker
+from model import Archive, File, Result, Site
+from model.file import (blob_key,
+                        pop_bytes_removed,
+                        release_files,
+                        remove_unused_blobs)
+
+# The generic error image is shared by every error result without being
+# reference counted, so it is never released.
+ERROR_IMAGE_NAME = 'hgprofiler_error.png'
+
+
+def run_retention():
+    ''' Apply the retention policies and return a report (see collect()). '''
+
+    worker.start_job()
+    report = collect(worker.get_session(), worker.get_config())
+    worker.finish_job()
+
+    return report
+
+
+def collect(db_session, config):
+    '''
+    Apply the retention policies in `config` and reconcile the data
+    directory.
+
+    Returns a dictionary of counts: ``archives_deleted``,
+    ``archives_trimmed``, ``results_deleted``, ``files_deleted``,
+    ``orphan_blobs_deleted``, ``missing_blobs`` and ``bytes_reclaimed``.
+    '''
+
+    retention = dict(config.items('retention'))
+    batch_size = int(retention['batch_size'])
+    max_age_days = int(retention['max_age_days'])
+    keep_last = int(retention['keep_last'])
+    found_only_after_days = int(retention['found_only_after_days'])
+    report = Counter()
+
+    # Searches to delete entirely.
+    expired = list()
+
+    if max_age_days > 0:
+        cutoff = func.current_timestamp() - timedelta(days=max_age_days)
+        expired.append(Archive.date < cutoff)
+
+    if keep_last > 0:
+        ranked = db_session.query(
+            Archive.id,
+            func.row_number().over(
+                partition_by=Archive.username,
+                order_by=(Archive.date.desc(), Archive.id.desc())
+            ).label('rank')
+        ).subquery()
+        superseded = db_session.query(ranked.c.id) \
+                               .filter(ranked.c.rank > keep_last)
+        expired.append(Archive.id.in_(superseded))
+
+    if len(expired) > 0:
+        _delete_searches(db_session, expired, batch_size, report)
+
+    # Searches to trim to "found" results.
+    if found_only_after_days > 0:
+        cutoff = func.current_timestamp() - \
+            timedelta(days=found_only_after_days)
+        trackers = db_session.query(Archive.tracker_id) \
+                             .filter(Archive.date < cutoff)
+        _delete_results(
+            db_session,
+            [Result.tracker_id.in_(trackers), Result.status != 'f'],
+            batch_size,
+            report
+        )
+        _trim_archives(db_session, cutoff, batch_size, report)
+
+    _reconcile_data_dir(
+        db_session,
+        batch_size,
+        int(retention['orphan_grace_seconds']),
+        report
+    )
+
+    # Reclaim space used by deleted blobs in pack files.
+    report['bytes_reclaimed'] += get_store().compact(
+        float(retention['compact_threshold'])
+    )
+
+    return {key: report[key] for key in ('archives_deleted',
+                                         'archives_trimmed',
+                                         'results_deleted',
+                                         'files_deleted',
+                                         'orphan_blobs_deleted',
+                                         'missing_blobs',
+                                         'bytes_reclaimed')}
+
+
+def _delete_searches(db_session, criteria, batch_size, report):
+    '''
+    Delete the archives matching any of `criteria` in batches, with their
+    results and files.
+    '''
+
+    # Columns rather than instances, since instances would be expired by
+    # each commit, after their rows have been deleted.
+    query = db_session.query(Archive.id,
+                             Archive.tracker_id,
+                             Archive.zip_file_id,
+                             Archive.contact_sheet_file_id,
+                             Archive.contact_sheet_map_file_id) \
+                      .filter(or_(*criteria)) \
+                      .order_by(Archive.id)
+
+    for archives in query_chunks(query, Archive.id, batch_size):
+        _delete_archives(db_session, archives, batch_size, report)
+
+
+def _delete_archives(db_session, archives, batch_size, report):
+    '''
+    Delete `archives` (rows with the archive's ID, tracker ID and file IDs),
+    their results, and their files.
+    '''
+
+    tracker_ids = [archive.tracker_id for archive in archives]
+    _delete_results(db_session,
+                    [Result.tracker_id.in_(tracker_ids)],
+                    batch_size,
+                    report)
+
+    ref_counts = Counter()
+
+    for archive in archives:
+        for file_id in (archive.zip_file_id,
+                        archive.contact_sheet_file_id,
+                        archive.contact_sheet_map_file_id):
+            if file_id is not None:
+                ref_counts[file_id] += 1
+
+    db_session.query(Archive) \
+              .filter(Archive.id.in_([archive.id for archive in archives])) \
+              .delete(synchronize_session=False)
+
+    if len(ref_counts) > 0:
+        report['files_deleted'] += release_files(db_session, ref_counts)
+
+    db_session.commit()
+    report['archives_deleted'] += len(archives)
+    report['bytes_reclaimed'] += pop_bytes_removed(db_session)
+
+
+def _delete_results(db_session, criteria, batch_size, report):
+    '''
+    Delete results matching all `criteria` in batches, releasing their
+    screenshots. Results used by site tests are kept.
+    '''
+
+    error_image_ids = {
+        row.id for row in
+        db_session.query(File.id).filter(File.name == ERROR_IMAGE_NAME)
+    }
+
+    site_test = exists().where(or_(Site.test_result_pos_id == Result.id,
+                                   Site.test_result_neg_id == Result.id))
+
+    query = (
+        db_session
+        .query(Result.id, Result.image_file_id)
+        .filter(*criteria)
+        .filter(~site_test)
+        .order_by(Result.id)
+    )
+
+    for results in query_chunks(query, Result.id, batch_size):
+        ref_counts = Counter(
+            result.image_file_id for result in results
+            if result.image_file_id is not None and
+            result.image_file_id not in error_image_ids
+        )
+
+        db_session.query(Result) \
+                  .filter(Result.id.in_([result.id for result in results])) \
+                  .delete(synchronize_session=False)
+
+        if len(ref_counts) > 0:
+            report['files_deleted'] += release_files(db_session, ref_counts)
+
+        db_session.commit()
+        report['results_deleted'] += len(results)
+        report['bytes_reclaimed'] += pop_bytes_removed(db_session)
+
+
+def _trim_archives(db_session, cutoff, batch_size, report):
+    '''
+    Update the archives of searches older than `cutoff` that were trimmed to
+    "found" results.
+
+    Their counts are recounted from the results that remain, and stored zip
+    files and contact sheets, which still contain the deleted results, are
+    released. A new zip file is generated when the archive is downloaded.
+    '''
+
+    query = (
+        db_session
+        .query(Archive)
+        .filter(Archive.date < cutoff)
+        .filter(or_(Archive.not_found_count > 0, Archive.error_count > 0))
+        .order_by(Archive.id)
+    )
+
+    for archives in query_chunks(query, Archive.id, batch_size):
+        tracker_ids = [archive.tracker_id for archive in archives]
+        counts = Counter()
+        count_query = (
+            db_session
+            .query(Result.tracker_id,
+                   type_coerce(Result.status, String),
+                   func.count(Result.id))
+            .filter(Result.tracker_id.in_(tracker_ids))
+            .group_by(Result.tracker_id, Result.status)
+        )
+
+        for tracker_id, status, count in count_query:
+            counts[tracker_id, status] = count
+
+        ref_counts = Counter()
+
+        for archive in archives:
+            archive.found_count = counts[archive.tracker_id, 'f']
+            archive.not_found_count = counts[archive.tracker_id, 'n']
+            archive.error_count = counts[archive.tracker_id, 'e']
+            archive.site_count = archive.found_count + \
+                archive.not_found_count + archive.error_count
+
+            for file_id in (archive.zip_file_id,
+                            archive.contact_sheet_file_id,
+                            archive.contact_sheet_map_file_id):
+                if file_id is not None:
+                    ref_counts[file_id] += 1
+
+            archive.zip_file = None
+            archive.contact_sheet_file = None
+            archive.contact_sheet_map_file = None
+
+        db_session.flush()
+
+        if len(ref_counts) > 0:
+            report['files_deleted'] += release_files(db_session, ref_counts)
+
+        db_session.commit()
+        report['archives_trimmed'] += len(archives)
+        report['bytes_reclaimed'] += pop_bytes_removed(db_session)
+
+
+def _reconcile_data_dir(db_session, batch_size, grace_seconds, report):
+    '''
+    Delete blobs that no ``File`` refers to, and count files whose blob is
+    missing.
+
+    Keys are reconciled one hash prefix at a time (1/256th of the keys), so
+    that only one prefix's keys and hashes are held in memory. Blobs
+    modified in the last `grace_seconds` are kept, since their row may not be
+    committed yet, and each hash is checked again just before its blobs are
+    deleted (see model.file.remove_unused_blobs()).
+    '''
+
+    store = get_store()
+    cutoff = time.time() - grace_seconds
+
+    for prefix in range(256):
+        blobs = dict()
+        originals = set()
+
+        # Keys are <hash>[.<variant>]
+        for key, size, mtime in store.iter_blobs('{:02x}'.format(prefix)):
+            hash_hex, _, variant = key.partition('.')
+
+            if mtime <= cutoff:
+                blobs.setdefault(hash_hex, []).append(key)
+
+            if variant == '':
+                originals.add(hash_hex)
+
+        known = set()
+        query = db_session.query(File.id, File.hash) \
+                          .filter(File.hash >= bytes([prefix]))
+
+        if prefix < 255:
+            query = query.filter(File.hash < bytes([prefix + 1]))
+
+        for files in query_chunks(query.order_by(File.id), File.id,
+                                  batch_size):
+            for file_ in files:
+                hash_hex = blob_key(bytes(file_.hash))
+                known.add(hash_hex)
+
+                if hash_hex not in originals:
+                    report['missing_blobs'] += 1
+
+        db_session.commit()
+
+        for hash_hex, keys in blobs.items():
+            if hash_hex in known:
+                continue
+
+            bytes_removed = remove_unused_blobs(db_session,
+                                                bytes.fromhex(hash_hex),
+                                                keys)
+            db_session.commit()
+
+            if bytes_removed is not None:
+                report['orphan_blobs_deleted'] += len(keys)
+                report['bytes_reclaimed'] += bytes_removed
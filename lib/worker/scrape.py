@@ -1,22 +1,43 @@
 import base64
 import json
 from datetime import datetime
+import logging
 import re
 import sys
+import time
 from urllib.parse import urljoin
 
 import parsel
 import requests
+from sqlalchemy import exists
 
+import app.config
 import app.database
 import app.queue
+from app.admission import release
+from app.batch import update_batch
+from app.metrics import count as count_metric
+from app.stats import invalidate_site_stats
+from app.tracker import update_tracker
+from helper.cassette import CassetteStore
 import worker
 from model import File, Result, Site
 from model.configuration import get_config
+from model.file import (get_variant,
+                        hamming_distance,
+                        image_dhash,
+                        phash_neighbors,
+                        store_file)
 
 USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:40.0) '\
              'Gecko/20100101 Firefox/40.1'
 
+_logger = logging.getLogger(__name__)
+
+# Splash responses are recorded here, if enabled (see
+# _record_splash_response()). One store is shared by all jobs in a process.
+_cassette_store = None
+
 
 class ScrapeException(Exception):
     ''' Represents a user-facing exception. '''
@@ -41,26 +62,33 @@ def test_site(site_id, tracker_id, request_timeout=10):
     redis = worker.get_redis()
     db_session = worker.get_session()
     site = db_session.query(Site).get(site_id)
+    previous_neg_phash = None
 
-    # Do positive test.
-    result_pos_id = check_username(username=site.test_username_pos,
-                                   site_id=site_id,
-                                   group_id=None,
-                                   total=2,
-                                   tracker_id=tracker_id + '-1',
-                                   test=True)
+    if site.test_result_neg is not None and \
+            site.test_result_neg.status == 'n':
+        previous_neg_phash = site.test_result_neg.image_file.phash
 
-    result_pos = db_session.query(Result).get(result_pos_id)
+    # Do positive test.
+    result_pos = _check_username(db_session=db_session,
+                                 redis=redis,
+                                 username=site.test_username_pos,
+                                 site=site,
+                                 group_id=None,
+                                 total=2,
+                                 tracker_id=tracker_id + '-1',
+                                 request_timeout=request_timeout,
+                                 test=True)
 
     # Do negative test.
-    result_neg_id = check_username(username=site.test_username_neg,
-                                   site_id=site_id,
-                                   group_id=None,
-                                   total=2,
-                                   tracker_id=tracker_id + '-2',
-                                   test=True)
-
-    result_neg = db_session.query(Result).get(result_neg_id)
+    result_neg = _check_username(db_session=db_session,
+                                 redis=redis,
+                                 username=site.test_username_neg,
+                                 site=site,
+                                 group_id=None,
+                                 total=2,
+                                 tracker_id=tracker_id + '-2',
+                                 request_timeout=request_timeout,
+                                 test=True)
 
     # Update site with test results
     site.test_result_pos = result_pos
@@ -74,8 +102,20 @@ def test_site(site_id, tracker_id, request_timeout=10):
     else:
         site.valid = False
 
+    # Flag a change in the appearance of the "not found" page.
+    neg_phash = result_neg.image_file.phash
+
+    if result_neg.status == 'n' and \
+            previous_neg_phash is not None and \
+            neg_phash is not None:
+        distance = hamming_distance(previous_neg_phash, neg_phash)
+        site.not_found_changed = distance > _near_duplicate_distance()
+    elif result_neg.status == 'n':
+        site.not_found_changed = False
+
     site.tested_at = datetime.utcnow()
     db_session.commit()
+    invalidate_site_stats(redis)
 
     # Send redis notification
     msg = {
@@ -85,21 +125,56 @@ def test_site(site_id, tracker_id, request_timeout=10):
         'resource': None,
     }
     redis.publish('site', json.dumps(msg))
+    worker.finish_job()
 
 
-def check_username(username, site_id, group_id, total,
-                   tracker_id, request_timeout=10, test=False):
+def check_username(username, site_id, group_id, total, tracker_id,
+                   request_timeout=10, test=False, trace=None, user_id=None,
+                   batch_id=None):
     """
     Check if `username` exists on the specified site.
+
+    `trace` is the search's trace, if any (see app.trace). `user_id` is the
+    user who requested the search, whose outstanding jobs (see
+    app.admission) include this one. `batch_id` is the batch that the search
+    belongs to, if any (see app.batch).
     """
 
-    worker.start_job()
+    worker.start_job(trace=trace)
     redis = worker.get_redis()
     db_session = worker.get_session()
 
-    # Make a splash request.
-    site = db_session.query(Site).get(site_id)
-    err = None
+    with worker.phase('site_query'):
+        site = db_session.query(Site).get(site_id)
+
+    result = _check_username(db_session=db_session,
+                             redis=redis,
+                             username=username,
+                             site=site,
+                             group_id=group_id,
+                             total=total,
+                             tracker_id=tracker_id,
+                             request_timeout=request_timeout,
+                             test=test,
+                             batch_id=batch_id)
+
+    if user_id is not None:
+        release(redis, user_id, job_id=worker.get_job().id)
+
+    worker.finish_job()
+
+    return result.id
+
+
+def _check_username(db_session, redis, username, site, group_id, total,
+                    tracker_id, request_timeout, test=False, batch_id=None):
+    """
+    Check if `username` exists on `site`, save the result, and return it.
+
+    This is the body of check_username(), without the job's bookkeeping, so
+    that test_site() can check its usernames within its own job. The
+    arguments are as for check_username().
+    """
 
     # Check site.
     splash_result = _splash_request(db_session, username,
@@ -107,33 +182,41 @@ def check_username(username, site_id, group_id, total,
     image_file = _save_image(db_session, splash_result)
 
     # Save result to DB.
-    result = Result(
-        tracker_id=tracker_id,
-        site_name=splash_result['site']['name'],
-        site_url=splash_result['url'],
-        status=splash_result['status'],
-        image_file_id=image_file.id,
-        error=splash_result['error']
-    )
-    db_session.add(result)
-    db_session.commit()
+    with worker.phase('db_commit'):
+        result = Result(
+            tracker_id=tracker_id,
+            site_name=splash_result['site']['name'],
+            site_url=splash_result['url'],
+            status=splash_result['status'],
+            image_file_id=image_file.id,
+            error=splash_result['error']
+        )
+        db_session.add(result)
+        db_session.commit()
+
+    count_metric('hgprofiler_checks_total',
+                 site=result.site_name,
+                 status=splash_result['status'])
 
     if not test:
-        # Notify clients of the result.
-        current = redis.incr(tracker_id)
-        result_dict = result.as_dict()
-        result_dict['current'] = current
-        # result_dict['image_file_url'] = image_file.url()
-        # result_dict['image_name'] = image_file.name
-        result_dict['total'] = total
-        redis.publish('result', json.dumps(result_dict))
-
-        # Queue archive job
-        app.queue.schedule_archive(username, group_id, tracker_id)
+        with worker.phase('notify'):
+            # Notify clients of the result.
+            tracker = update_tracker(redis, tracker_id,
+                                     splash_result['status'])
 
-    worker.finish_job()
+            if batch_id is not None:
+                update_batch(redis, batch_id, splash_result['status'])
 
-    return result.id
+            result_dict = result.as_dict()
+            result_dict['current'] = tracker['current']
+            result_dict['total'] = total
+            redis.publish('result', json.dumps(result_dict))
+
+            # Queue archive job
+            app.queue.schedule_archive(username, group_id, tracker_id,
+                                       trace=worker.get_trace())
+
+    return result
 
 
 def _check_splash_response(site, splash_response, splash_data):
@@ -141,12 +224,37 @@ def _check_splash_response(site, splash_response, splash_data):
     Parse response and test against site criteria to determine
     whether username exists. Used with requests response object.
     """
-    sel = parsel.Selector(text=splash_data['html'])
+    with worker.phase('html_parse'):
+        sel = parse_page(splash_data['html'])
+
+    upstream_status = None
+
+    if site.status_code is not None:
+        upstream_status = splash_data['history'][0]['response']['status']
+
+    with worker.phase('html_match'):
+        return match_page(site, sel, upstream_status)
+
+
+def parse_page(html):
+    """
+    Parse rendered `html` into a selector for match_page().
+
+    Parsing and matching are separate steps so that their costs can be
+    measured independently (see bench.matcher).
+    """
+    return parsel.Selector(text=html)
+
+
+def match_page(site, sel, upstream_status):
+    """
+    Test a parsed page against site criteria to determine whether the
+    username exists.
+    """
     status_ok = True
     match_ok = True
 
     if site.status_code is not None:
-        upstream_status = splash_data['history'][0]['response']['status']
         status_ok = site.status_code == upstream_status
 
     if site.match_expr is not None:
@@ -167,21 +275,138 @@ def _check_splash_response(site, splash_response, splash_data):
 
     return status_ok and match_ok
 
+
+def _find_near_duplicate(db_session, site_name, phash):
+    """
+    Return the ID of the earliest "not found" screenshot of `site_name` that
+    looks like an image with perceptual hash `phash`, or None.
+
+    The candidates are found with the index on ``file.phash``, and each is
+    checked against ``ix_result_image_file``.
+    """
+
+    neighbors = phash_neighbors(phash, _near_duplicate_distance())
+    same_site = (
+        exists()
+        .where(Result.image_file_id == File.id)
+        .where(Result.site_name == site_name)
+        .where(Result.status == 'n')
+    )
+    row = (
+        db_session
+        .query(File.id, File.canonical_file_id)
+        .filter(File.phash.in_(neighbors))
+        .filter(same_site)
+        .order_by(File.id)
+        .first()
+    )
+
+    if row is None:
+        return None
+
+    return row.canonical_file_id or row.id
+
+
+def _near_duplicate_distance():
+    """ Return the maximum Hamming distance between near-duplicates. """
+
+    distance = worker.get_config().getint('screenshot',
+                                          'near_duplicate_distance')
+
+    return max(0, min(distance, 2))
+
+
+def _record_splash_response(**response):
+    """
+    Save a Splash `response` (see helper.cassette.CassetteStore.record()) if
+    ``[splash] record_dir`` is set.
+
+    Recording must never fail a scrape, so errors are logged and ignored.
+    """
+
+    global _cassette_store
+
+    record_dir = worker.get_config().get('splash', 'record_dir')
+
+    if record_dir == '':
+        return
+
+    if _cassette_store is None:
+        _cassette_store = CassetteStore(app.config.get_path(record_dir))
+
+    try:
+        _cassette_store.record(**response)
+    except Exception:
+        _logger.exception('Could not record the Splash response for %s.',
+                          response['url'])
+
+
 def _save_image(db_session, scrape_result):
-    """ Save the image returned by Splash to a local file. """
+    """
+    Save the image returned by Splash to a local file.
+
+    If near-duplicate mapping is enabled, a "not found" screenshot that
+    looks like an earlier "not found" screenshot of the same site is linked
+    to that earlier image.
+    """
     if scrape_result['error'] is None:
         image_name = '{}.jpg'.format(scrape_result['site']['name'])
-        content = base64.decodestring(scrape_result['image'].encode('utf8'))
-        image_file = File(name=image_name,
-                          mime='image/jpeg',
-                          content=content)
-        db_session.add(image_file)
+
+        with worker.phase('image_decode'):
+            content = base64.decodestring(
+                scrape_result['image'].encode('utf8')
+            )
+
+        config = worker.get_config()
+        phash = None
+        canonical_file_id = None
+
+        if config.getboolean('screenshot', 'perceptual_hash'):
+            try:
+                with worker.phase('image_hash'):
+                    phash = image_dhash(content)
+            except OSError:
+                pass
+
+        if phash is not None and \
+                scrape_result['status'] == 'n' and \
+                config.getboolean('screenshot', 'map_near_duplicates'):
+            with worker.phase('image_dedupe'):
+                canonical_file_id = _find_near_duplicate(
+                    db_session,
+                    scrape_result['site']['name'],
+                    phash
+                )
 
         try:
-            db_session.commit()
+            with worker.phase('image_store'):
+                image_file = store_file(db_session,
+                                        name=image_name,
+                                        mime='image/jpeg',
+                                        content=content,
+                                        phash=phash)
+
+                # Only link to earlier files, so that links never form a
+                # cycle.
+                if canonical_file_id is not None and \
+                        image_file.canonical_file_id is None and \
+                        canonical_file_id < image_file.id:
+                    image_file.canonical_file_id = canonical_file_id
+
+                db_session.commit()
         except:
             db_session.rollback()
             raise ScrapeException('Could not save image')
+
+        try:
+            # Generate the thumbnail now so that the first page load that
+            # shows this result doesn't have to.
+            with worker.phase('thumbnail'):
+                get_variant(image_file, 'thumb')
+        except OSError:
+            # Unreadable image: the variant is generated (or fails) on
+            # request instead.
+            pass
     else:
         # Get the generic error image.
         image_file = (
@@ -197,7 +422,8 @@ def _save_image(db_session, scrape_result):
 def _splash_request(db_session, username, site, request_timeout):
     ''' Ask splash to render a page for us. '''
     target_url = site.get_url(username)
-    splash_url = get_config(db_session, 'splash_url', required=True).value
+    splash_url = worker.get_config().get('splash', 'url') or \
+        get_config(db_session, 'splash_url', required=True).value
     splash_headers = {
         'User-Agent': USER_AGENT,
     }
@@ -209,11 +435,30 @@ def _splash_request(db_session, username, site, request_timeout):
         'timeout': request_timeout,
         'resource_timeout': 5,
     }
+    started = time.time()
     splash_response = requests.get(
         urljoin(splash_url, 'render.json'),
         headers=splash_headers,
         params=splash_params
     )
+    splash_elapsed = time.time() - started
+
+    # `elapsed` runs until the response headers are parsed, so it covers
+    # connecting to Splash and rendering. The rest is the transfer.
+    render_elapsed = splash_response.elapsed.total_seconds()
+    worker.record_phase('splash_render', render_elapsed, started)
+    worker.record_phase('splash_transfer',
+                        max(0, splash_elapsed - render_elapsed),
+                        started + render_elapsed)
+    _record_splash_response(
+        site_name=site.name,
+        username=username,
+        url=target_url,
+        status=splash_response.status_code,
+        body=splash_response.content,
+        elapsed=splash_elapsed
+    )
+
     result = {
         'code': splash_response.status_code,
         'error': None,
@@ -222,7 +467,8 @@ def _splash_request(db_session, username, site, request_timeout):
         'url': target_url,
     }
 
-    splash_data = splash_response.json()
+    with worker.phase('json_decode'):
+        splash_data = splash_response.json()
 
     try:
         splash_response.raise_for_status()
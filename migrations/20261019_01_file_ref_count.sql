@@ -0,0 +1,45 @@
+-- Store identical files only once (see model.file.store_file()).
+--
+-- Duplicate file rows are merged into the oldest row with the same hash, the
+-- results and archives that refer to them are repointed, and each file's
+-- reference count is set to the number of rows that refer to it. Duplicates
+-- already share one blob, since blobs are keyed by hash.
+
+ALTER TABLE file ADD COLUMN ref_count INTEGER NOT NULL DEFAULT 1;
+
+UPDATE result
+SET image_file_id = canonical.id
+FROM file AS duplicate
+JOIN (SELECT hash, MIN(id) AS id FROM file GROUP BY hash) AS canonical
+  ON canonical.hash = duplicate.hash
+WHERE result.image_file_id = duplicate.id
+  AND duplicate.id <> canonical.id;
+
+UPDATE archive
+SET zip_file_id = canonical.id
+FROM file AS duplicate
+JOIN (SELECT hash, MIN(id) AS id FROM file GROUP BY hash) AS canonical
+  ON canonical.hash = duplicate.hash
+WHERE archive.zip_file_id = duplicate.id
+  AND duplicate.id <> canonical.id;
+
+DELETE FROM file
+USING (SELECT hash, MIN(id) AS id FROM file GROUP BY hash) AS canonical
+WHERE file.hash = canonical.hash
+  AND file.id <> canonical.id;
+
+UPDATE file
+SET ref_count = reference.count
+FROM (
+    SELECT file_id, COUNT(*) AS count
+    FROM (
+        SELECT image_file_id AS file_id FROM result
+        UNION ALL
+        SELECT zip_file_id AS file_id FROM archive
+    ) AS referrer
+    WHERE file_id IS NOT NULL
+    GROUP BY file_id
+) AS reference
+WHERE file.id = reference.file_id;
+
+CREATE UNIQUE INDEX ix_file_hash ON file (hash);
@@ -0,0 +1,38 @@
+-- Keep one archive per search (see worker.archive.create_archive()).
+--
+-- Each finished check used to insert an archive row. The row with the most
+-- sites (the newest, if there is a tie) is kept for each tracker, and the
+-- references that the other rows held on their zip files are released. Zip
+-- files that are no longer referenced are deleted; their blobs are removed
+-- by the next retention run (see worker.retention).
+
+CREATE TEMPORARY TABLE superseded_archive AS
+SELECT id, zip_file_id
+FROM archive
+WHERE id NOT IN (
+    SELECT DISTINCT ON (tracker_id) id
+    FROM archive
+    ORDER BY tracker_id, site_count DESC, id DESC
+);
+
+UPDATE file
+SET ref_count = file.ref_count - superseded.count
+FROM (
+    SELECT zip_file_id AS file_id, COUNT(*) AS count
+    FROM superseded_archive
+    WHERE zip_file_id IS NOT NULL
+    GROUP BY zip_file_id
+) AS superseded
+WHERE file.id = superseded.file_id;
+
+DELETE FROM archive
+WHERE id IN (SELECT id FROM superseded_archive);
+
+DELETE FROM file
+WHERE id IN (SELECT zip_file_id FROM superseded_archive)
+  AND ref_count <= 0;
+
+DROP TABLE superseded_archive;
+
+ALTER TABLE archive DROP CONSTRAINT tracker_id_zip_file_id;
+ALTER TABLE archive ADD CONSTRAINT archive_tracker_id UNIQUE (tracker_id);
@@ -0,0 +1,7 @@
+-- Contact sheets of a search's screenshots (see worker.archive).
+
+ALTER TABLE archive
+    ADD COLUMN contact_sheet_file_id INTEGER
+        CONSTRAINT fk_contact_sheet_file REFERENCES file (id),
+    ADD COLUMN contact_sheet_map_file_id INTEGER
+        CONSTRAINT fk_contact_sheet_map_file REFERENCES file (id);
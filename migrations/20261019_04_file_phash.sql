@@ -0,0 +1,15 @@
+-- Perceptual hashes of screenshots (see model.file.image_dhash()), links
+-- between near-duplicate screenshots, and the flag for sites whose "not
+-- found" page has changed.
+
+ALTER TABLE file
+    ADD COLUMN phash BIGINT,
+    ADD COLUMN canonical_file_id INTEGER
+        CONSTRAINT fk_canonical_file REFERENCES file (id) ON DELETE SET NULL;
+
+CREATE INDEX ix_file_phash ON file (phash);
+
+CREATE INDEX ix_result_image_file ON result (image_file_id, site_name, status);
+
+ALTER TABLE site
+    ADD COLUMN not_found_changed BOOLEAN NOT NULL DEFAULT false;
@@ -166,6 +166,9 @@ def submit_usernames(config,
     :param group_id (int): id of site group to use.
     :param chunk_size (int): usernames to sumbit per API requests.
     :param interval (int): interval in seconds between API requests.
+
+    If the server is saturated, it responds with 429 Too Many Requests and
+    a Retry-After header: the chunk is submitted again after that delay.
     """
     if not config.token:
         raise ProfilerError('Token is required for this function.')
@@ -179,6 +182,7 @@ def submit_usernames(config,
         click.echo('[*] Extracted {} usernames.'.format(len(usernames)))
 
     username_url = config.app_host + '/api/username/'
+    headers = dict(config.headers, Accept='application/json')
     responses = []
 
     with click.progressbar(length=len(usernames),
@@ -190,18 +194,54 @@ def submit_usernames(config,
             payload = {
                 'usernames': chunk,
             }
-            response = requests.post(username_url,
-                                     headers=config.headers,
-                                     json=payload,
-                                     verify=False)
+
+            while True:
+                response = requests.post(username_url,
+                                         headers=headers,
+                                         json=payload,
+                                         verify=False)
+
+                if response.status_code != 429:
+                    break
+
+                time.sleep(_retry_after(response, interval))
+
             response.raise_for_status()
             responses.append(response.content)
-            time.sleep(interval)
+
+            if chunk_end < len(usernames):
+                time.sleep(interval)
 
     click.secho('Submitted {} usernames.'.format(len(usernames)), fg='green')
     pprint(responses)
 
 
+def _retry_after(response, default):
+    """
+    Return the delay in seconds requested by a 429 response.
+
+    Raise ProfilerError if the request can never succeed, i.e. it was refused
+    although the user has no outstanding jobs.
+    """
+    try:
+        data = response.json()
+    except ValueError:
+        data = {'message': response.text.strip()}
+
+    if data.get('outstanding') == 0:
+        raise ProfilerError(data['message'])
+
+    try:
+        retry_after = max(1, int(response.headers['Retry-After']))
+    except (KeyError, ValueError):
+        retry_after = default
+
+    logging.info('Server is busy (%s). Retrying in %d seconds.',
+                 data.get('message'), retry_after)
+
+    return retry_after
+
+
 @cli.command()
 @click.argument('input-file',
                 type=click.File(),
@@ -368,13 +408,15 @@ def get_zip_results(config,
                 filename = '{}-{}.zip' \
                            .format(username,
                                    archive['date'])
-                response = requests.get(archive['zip_url'],
+                zip_url = urllib.parse.urljoin(config.app_host,
+                                               archive['zip_file_url'])
+                response = requests.get(zip_url,
                                         headers=config.headers,
                                         verify=False)
 
                 response.raise_for_status()
 
-                with open(os.join(output_dir, filename), 'wb') as f:
+                with open(os.path.join(output_dir, filename), 'wb') as f:
                     f.write(response.content)
 
                 time.sleep(interval)
@@ -389,6 +431,107 @@ def get_zip_results(config,
     click.secho(msg, fg='green')
 
 
+@cli.command()
+@click.argument('input-file',
+                type=click.File(),
+                required=True)
+@click.argument('output-dir',
+                type=click.Path(dir_okay=True, allow_dash=True),
+                required=True)
+@click.option('--interval',
+              type=click.FLOAT,
+              required=False,
+              default=0.25)
+@pass_config
+def get_contact_sheets(config, input_file, output_dir, interval):
+    """
+    \b
+    Return screenshot contact sheets for list of usernames.
+
+    Each contact sheet is a single image containing every screenshot for a
+    search, saved with a JSON file that maps tile coordinates to sites.
+    Contact sheets are only created if enabled on the server.
+
+    :param input_file (file): csv file containing 1 username per line.
+    :param output_dir (dir): output directory for contact sheets.
+    :param interval (int): interval in seconds between API requests.
+    """
+    if not config.token:
+        raise ProfilerError('Token is required for this function.')
+
+    reader = csv.reader(input_file)
+    usernames = [item[0] for item in list(reader)]
+
+    if not usernames:
+        raise ProfilerError('No usernames found.')
+
+    with click.progressbar(usernames,
+                           label='Getting contact sheets: ') as bar:
+        for username in bar:
+            archive_url = '{}/api/archive/?username={}' \
+                          .format(config.app_host, username)
+            response = requests.get(archive_url,
+                                    headers=config.headers,
+                                    verify=False)
+            response.raise_for_status()
+            time.sleep(interval)
+
+            for archive in response.json().get('archives', []):
+                if archive['contact_sheet_url'] is None:
+                    continue
+
+                for key, extension in (('contact_sheet_url', 'jpg'),
+                                       ('contact_sheet_map_url', 'json')):
+                    url = urllib.parse.urljoin(config.app_host, archive[key])
+                    response = requests.get(url,
+                                            headers=config.headers,
+                                            verify=False)
+                    response.raise_for_status()
+                    filename = '{}-{}.{}'.format(username,
+                                                 archive['date'],
+                                                 extension)
+
+                    with open(os.path.join(output_dir, filename), 'wb') as f:
+                        f.write(response.content)
+
+                    time.sleep(interval)
+
+
+@cli.command()
+@pass_config
+@click.argument('tracker-ids',
+                nargs=-1,
+                required=True)
+def get_progress(config, tracker_ids):
+    """
+    Show progress for one or more username searches.
+
+    :param tracker_ids (str): tracker IDs returned by submit_usernames.
+    """
+    if not config.token:
+        raise ProfilerError('Token is required for this function.')
+
+    for tracker_id in tracker_ids:
+        tracker_url = '{}/api/tracker/{}'.format(config.app_host, tracker_id)
+        response = requests.get(tracker_url,
+                                headers=config.headers,
+                                verify=False)
+
+        if response.status_code == 404:
+            click.secho('{}: not found'.format(tracker_id), fg='red')
+            continue
+
+        response.raise_for_status()
+        tracker = response.json()
+        click.echo('{}: {}/{} checked ({} found, {} not found, {} errors)'
+                   .format(tracker_id,
+                           tracker['current'],
+                           tracker['total'],
+                           tracker['found'],
+                           tracker['not_found'],
+                           tracker['error']))
+
+
 @cli.command()
 @pass_config
 @click.argument('resource',
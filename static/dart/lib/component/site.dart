@@ -237,6 +237,56 @@ class SiteComponent extends Object
         }
     }
 
+    /// Fetch the test results for the current page of sites.
+    ///
+    /// The site listing only includes the IDs of each site's test results,
+    /// so they are fetched with a single request for the whole page.
+    void _fetchTestResults() {
+        Map<int,Site> posSites = new Map<int,Site>();
+        Map<int,Site> negSites = new Map<int,Site>();
+
+        this.sites.values.forEach((site) {
+            if (site.testResultPosId != null) {
+                posSites[site.testResultPosId] = site;
+            }
+            if (site.testResultNegId != null) {
+                negSites[site.testResultNegId] = site;
+            }
+        });
+
+        List<int> ids = new List<int>.from(posSites.keys)
+            ..addAll(negSites.keys);
+
+        if (ids.isEmpty) {
+            return;
+        }
+
+        this.loading++;
+        String resultUrl = '/api/result/';
+        Map urlArgs = {
+            'ids': ids.join(','),
+        };
+
+        this.api
+            .get(resultUrl, urlArgs: urlArgs, needsAuth: true)
+            .then((response) {
+                response.data['results'].forEach((json) {
+                    Result result = new Result.fromJson(json);
+                    if (posSites.containsKey(result.id)) {
+                        posSites[result.id].testResultPos = result;
+                    }
+                    if (negSites.containsKey(result.id)) {
+                        negSites[result.id].testResultNeg = result;
+                    }
+                });
+            })
+            .catchError((response) {
+                String msg = response.data['message'];
+                this._showMessage(msg, 'danger');
+            })
+            .whenComplete(() {this.loading--;});
+    }
+
     /// Fetch a page of profiler sites.
     void fetchCurrentPage() {
         this.loading++;
@@ -265,6 +315,7 @@ class SiteComponent extends Object
                 this.totalTested = response.data['total_tested_count'];
                 this.totalTestedPercent = ((this.totalTested / this.totalSites) * 100).round();
 
+                this._fetchTestResults();
             })
             .catchError((response) {
                 String msg = response.data['message'];
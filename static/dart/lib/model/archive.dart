@@ -11,6 +11,8 @@ class Archive {
     int notFoundCount;
     int errorCount;
     String zipFileUrl;
+    String contactSheetUrl;
+    String contactSheetMapUrl;
 
     // Errors related to creating or loading this profile.
     String error;
@@ -40,5 +42,7 @@ class Archive {
         this.notFoundCount = json['not_found_count'];
         this.errorCount = json['error_count'];
         this.zipFileUrl = json['zip_file_url'];
+        this.contactSheetUrl = json['contact_sheet_url'];
+        this.contactSheetMapUrl = json['contact_sheet_map_url'];
     }
 }
@@ -7,6 +7,7 @@ class Result {
     String siteUrl;
     int imageFileId;
     String imageFileUrl;
+    String imageFileThumbUrl;
     int number;
     String status;
     int total;
@@ -29,6 +30,7 @@ class Result {
         this.siteUrl = json['site_url'];
         this.imageFileId = json['image_file_id'];
         this.imageFileUrl = json['image_file_url'];
+        this.imageFileThumbUrl = json['image_file_thumb_url'];
         this.number = json['number'];
         this.total = json['total'];
         this.error = json['error'];
@@ -12,10 +12,12 @@ class Site {
     String url;
     String testUsernamePos, testUsernamePosUrl;
     String testUsernameNeg, testUsernameNegUrl;
+    int testResultPosId, testResultNegId;
     Result testResultPos;
     Result testResultNeg;
     DateTime testedAt;
     bool valid;
+    bool notFoundChanged;
 
     // Errors related to creating or loading this site.
     String error;
@@ -46,19 +48,28 @@ class Site {
         this.testUsernameNeg = json['test_username_neg'];
         this.testUsernameNegUrl = json['test_username_neg_url'];
 
+        // Listings include only the IDs of the test results (see
+        // SiteComponent._fetchTestResults()); other responses include the
+        // results themselves.
+        this.testResultPosId = json['test_result_pos_id'];
+        this.testResultNegId = json['test_result_neg_id'];
+
         if (json['test_result_pos'] != null) {
            this.testResultPos = new Result.fromJson(json['test_result_pos']);
+           this.testResultPosId = this.testResultPos.id;
         } else {
             this.testResultPos = null;
         }
 
         if (json['test_result_neg'] != null) {
            this.testResultNeg = new Result.fromJson(json['test_result_neg']);
+           this.testResultNegId = this.testResultNeg.id;
         } else {
             this.testResultNeg = null;
         }
 
 	    this.valid = json['valid'];
+	    this.notFoundChanged = json['not_found_changed'];
 	    this.testedAt = json['tested_at'];
     }
 }
@@ -0,0 +1,171 @@
+'''
+Tests for app.admission.
+
+Run with ``python -m unittest discover tests``.
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import fakeredis
+from rq.job import Job
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from app.admission import (admit, check_batch, get_outstanding,
+                           max_chunk_usernames, reconcile, release,
+                           TooManyRequests, track_job)
+import app.admission
+from app.metrics import record_timings
+
+
+USER_ID = 1
+MAX_OUTSTANDING = app.admission._max_outstanding
+
+
+class TestAdmission(unittest.TestCase):
+    ''' Admit, release and reconcile a user's jobs. '''
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+
+    def track(self, job_id, status=None):
+        ''' Track a job, which has `status` (or doesn't exist). '''
+
+        pipe = self.redis.pipeline()
+        track_job(pipe, USER_ID, job_id)
+        pipe.execute()
+
+        if status is not None:
+            self.redis.hset(Job.key_for(job_id), 'status', status)
+
+    def test_admit(self):
+        estimate = admit(self.redis, USER_ID, 10)
+
+        self.assertEqual(estimate, {'queue_position': 10,
+                                    'estimated_wait': None})
+        self.assertEqual(get_outstanding(self.redis, USER_ID), 10)
+        self.assertEqual(get_outstanding(self.redis, USER_ID + 1), 0)
+
+    def test_estimated_wait(self):
+        # One job per second over the throughput window.
+        for _ in range(app.admission.THROUGHPUT_MINUTES * 60):
+            record_timings(self.redis, 'check_username', {'total': 0.5})
+
+        self.redis.rpush('rq:queue:scrape', *range(90))
+        estimate = admit(self.redis, USER_ID, 10)
+
+        self.assertEqual(estimate, {'queue_position': 100,
+                                    'estimated_wait': 100})
+
+    def test_too_many_outstanding(self):
+        admit(self.redis, USER_ID, MAX_OUTSTANDING - 5)
+
+        with self.assertRaises(TooManyRequests) as context:
+            admit(self.redis, USER_ID, 10)
+
+        error = context.exception
+        self.assertEqual(error.data['outstanding'], MAX_OUTSTANDING - 5)
+        self.assertIn(('Retry-After', str(error.retry_after)),
+                      error.get_headers())
+        self.assertEqual(get_outstanding(self.redis, USER_ID),
+                         MAX_OUTSTANDING - 5)
+
+        # Other users are admitted.
+        admit(self.redis, USER_ID + 1, 10)
+
+    def test_too_large(self):
+        with self.assertRaises(RequestEntityTooLarge):
+            admit(self.redis, USER_ID, MAX_OUTSTANDING + 1)
+
+        self.assertEqual(get_outstanding(self.redis, USER_ID), 0)
+
+    def test_queue_full(self):
+        self.redis.rpush('rq:queue:scrape',
+                         *range(app.admission._max_queue_depth))
+
+        with self.assertRaises(TooManyRequests) as context:
+            admit(self.redis, USER_ID, 10)
+
+        self.assertEqual(context.exception.data['queue_depth'],
+                         app.admission._max_queue_depth)
+        self.assertEqual(get_outstanding(self.redis, USER_ID), 0)
+
+    def test_release(self):
+        admit(self.redis, USER_ID, 3)
+        self.track('job1')
+        release(self.redis, USER_ID, 2)
+        self.assertEqual(get_outstanding(self.redis, USER_ID), 1)
+
+        # A tracked job is only released once.
+        release(self.redis, USER_ID, job_id='job1')
+        release(self.redis, USER_ID, job_id='job1')
+        self.assertEqual(get_outstanding(self.redis, USER_ID), 0)
+        self.assertFalse(self.redis.exists('admission.outstanding.1'))
+
+    def test_reconcile(self):
+        admit(self.redis, USER_ID, 4)
+
+        for job_id, status in (('queued', 'queued'),
+                               ('started', 'started'),
+                               ('finished', 'finished'),
+                               ('lost', None)):
+            self.track(job_id, status)
+
+        self.assertEqual(reconcile(self.redis, USER_ID), 2)
+        self.assertEqual(get_outstanding(self.redis, USER_ID), 2)
+        self.assertEqual(self.redis.smembers('admission.jobs.1'),
+                         {b'queued', b'started'})
+
+        # Released jobs aren't released again when they finish.
+        release(self.redis, USER_ID, job_id='lost')
+        self.assertEqual(get_outstanding(self.redis, USER_ID), 2)
+
+    def test_reconcile_interval(self):
+        admit(self.redis, USER_ID, 2)
+        self.track('lost1')
+        self.assertEqual(reconcile(self.redis, USER_ID), 1)
+
+        self.track('lost2')
+        self.assertEqual(reconcile(self.redis, USER_ID), 0)
+        self.assertEqual(get_outstanding(self.redis, USER_ID), 1)
+
+    def test_admit_reconciles(self):
+        admit(self.redis, USER_ID, MAX_OUTSTANDING)
+
+        for i in range(10):
+            self.track('lost{}'.format(i))
+
+        admit(self.redis, USER_ID, 10)
+        self.assertEqual(get_outstanding(self.redis, USER_ID),
+                         MAX_OUTSTANDING)
+
+
+class TestCheckBatch(unittest.TestCase):
+    ''' Check whether a batch can be planned. '''
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+
+    def test_check_batch(self):
+        estimate = check_batch(self.redis, 100, MAX_OUTSTANDING)
+
+        self.assertEqual(estimate['queue_position'], 100 * MAX_OUTSTANDING)
+        # Nothing is admitted until the batch is planned.
+        self.assertEqual(get_outstanding(self.redis, USER_ID), 0)
+
+    def test_too_many_sites(self):
+        with self.assertRaises(RequestEntityTooLarge):
+            check_batch(self.redis, 1, MAX_OUTSTANDING + 1)
+
+    def test_max_chunk_usernames(self):
+        self.assertEqual(max_chunk_usernames(1), MAX_OUTSTANDING)
+        self.assertEqual(max_chunk_usernames(MAX_OUTSTANDING), 1)
+        self.assertEqual(max_chunk_usernames(MAX_OUTSTANDING // 2 + 1), 1)
+        self.assertEqual(max_chunk_usernames(0), MAX_OUTSTANDING)
+
+
+if __name__ == '__main__':
+    unittest.main()
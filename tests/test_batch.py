@@ -0,0 +1,108 @@
+'''
+Tests for app.batch.
+
+Run with ``python -m unittest discover tests``.
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import fakeredis
+
+from app.batch import (add_planned, create_batch, get_batch, get_entries,
+                       set_batch_status, set_planner, update_batch)
+
+
+BATCH_ID = 'abc123'
+ENTRIES = [('tracker.aaaaaaaaaa', 'alice'),
+           ('tracker.bbbbbbbbbb', 'bob'),
+           ('tracker.cccccccccc', 'carol smith')]
+TRACE = {'trace_id': 'trace1', 'parent_id': 'span1'}
+
+
+class TestBatch(unittest.TestCase):
+    ''' Store batches and record their progress. '''
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        create_batch(self.redis, BATCH_ID, 1, ENTRIES, [3, 5], group_id=2,
+                     trace=TRACE)
+
+    def test_create(self):
+        batch = get_batch(self.redis, BATCH_ID)
+
+        self.assertEqual(batch['id'], BATCH_ID)
+        self.assertEqual(batch['user_id'], 1)
+        self.assertEqual(batch['group_id'], 2)
+        self.assertEqual(batch['site_ids'], [3, 5])
+        self.assertFalse(batch['test'])
+        self.assertEqual(batch['trace'], TRACE)
+        self.assertEqual(batch['status'], 'queued')
+        self.assertEqual(batch['usernames'], 3)
+        self.assertEqual(batch['planned'], 0)
+        self.assertEqual(batch['total'], 6)
+        self.assertEqual(batch['current'], 0)
+        self.assertEqual(batch['progress'], 0)
+        self.assertGreater(self.redis.ttl('batch.' + BATCH_ID), 0)
+        self.assertGreater(self.redis.ttl('batch.' + BATCH_ID + '.usernames'),
+                           0)
+
+    def test_defaults(self):
+        create_batch(self.redis, 'def456', 1, ENTRIES[:1], [], test=True)
+        batch = get_batch(self.redis, 'def456')
+
+        self.assertIsNone(batch['group_id'])
+        self.assertEqual(batch['site_ids'], [])
+        self.assertTrue(batch['test'])
+        self.assertIsNone(batch['trace'])
+        self.assertEqual(batch['total'], 0)
+        self.assertIsNone(batch['progress'])
+
+    def test_missing(self):
+        self.assertIsNone(get_batch(self.redis, 'def456'))
+
+    def test_entries(self):
+        self.assertEqual(get_entries(self.redis, BATCH_ID, 0, 2), ENTRIES[:2])
+        self.assertEqual(get_entries(self.redis, BATCH_ID, 2, 2), ENTRIES[2:])
+        self.assertEqual(get_entries(self.redis, BATCH_ID, 3, 2), [])
+
+    def test_plan(self):
+        pipe = self.redis.pipeline()
+        set_planner(pipe, BATCH_ID, 'job1')
+        add_planned(pipe, BATCH_ID, 1, 1)
+        pipe.execute()
+        set_batch_status(self.redis, BATCH_ID, 'planning')
+        batch = get_batch(self.redis, BATCH_ID)
+
+        self.assertEqual(batch['planner'], 'job1')
+        self.assertEqual(batch['status'], 'planning')
+        self.assertEqual(batch['planned'], 1)
+        self.assertEqual(batch['jobs'], 1)
+        # One job was queued for the first username (e.g. because a site was
+        # deleted), plus two for each of the others.
+        self.assertEqual(batch['total'], 5)
+
+    def test_update(self):
+        update_batch(self.redis, BATCH_ID, 'f')
+        update_batch(self.redis, BATCH_ID, 'n')
+        update_batch(self.redis, BATCH_ID, 'e')
+        batch = get_batch(self.redis, BATCH_ID)
+
+        self.assertEqual(batch['found'], 1)
+        self.assertEqual(batch['not_found'], 1)
+        self.assertEqual(batch['error'], 1)
+        self.assertEqual(batch['current'], 3)
+        self.assertEqual(batch['progress'], 0.5)
+
+    def test_update_invalid_status(self):
+        with self.assertRaises(ValueError):
+            update_batch(self.redis, BATCH_ID, 'x')
+
+        self.assertEqual(get_batch(self.redis, BATCH_ID)['current'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+'''
+Tests for helper.blob.
+
+Run with ``python -m unittest discover tests``.
+'''
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from helper.blob import FileStore, PackStore
+
+
+# 20 blobs of 300 bytes fill two 4 KiB segments.
+BLOBS = {'{:064x}'.format(i): bytes([i]) * 300 for i in range(1, 21)}
+
+
+def run_in_child(target, *args):
+    '''
+    Run `target(*args)` in a forked process and return its exit code, which
+    is non-zero if it raised an exception.
+    '''
+
+    process = multiprocessing.get_context('fork') \
+                             .Process(target=target, args=args)
+    process.start()
+    process.join()
+
+    return process.exitcode
+
+
+def compact(store):
+    store.compact(0.5)
+
+
+def delete(store, keys):
+    for key in keys:
+        store.delete(key)
+
+
+def write(store, blobs):
+    for key, content in blobs.items():
+        store.write(key, content)
+
+    store.flush()
+
+
+class TestPackStore(unittest.TestCase):
+    ''' Write, read, delete and compact blobs from two processes. '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = self.make_store()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_store(self):
+        ''' Return a new store on the test directory. '''
+
+        return PackStore(os.path.join(self.root, 'pack'),
+                         fallback=FileStore(self.root),
+                         segment_size=4096,
+                         max_packed_size=1024,
+                         write_batch_size=1024)
+
+    def test_write_in_child(self):
+        self.assertEqual(run_in_child(write, self.store, BLOBS), 0)
+
+        for key, content in BLOBS.items():
+            self.assertEqual(self.store.read(key), content)
+
+    def test_write_in_both(self):
+        keys = sorted(BLOBS)
+        child_blobs = {key: BLOBS[key] for key in keys[:10]}
+        parent_blobs = {key: BLOBS[key] for key in keys[10:]}
+        self.assertEqual(run_in_child(write, self.store, child_blobs), 0)
+        write(self.make_store(), parent_blobs)
+
+        for key, content in BLOBS.items():
+            self.assertEqual(self.store.read(key), content)
+
+    def test_delete_in_child(self):
+        write(self.store, BLOBS)
+        deleted = sorted(BLOBS)[::2]
+
+        # Map the segments before the child deletes blobs.
+        for key in BLOBS:
+            self.store.read(key)
+
+        self.assertEqual(run_in_child(delete, self.store, deleted), 0)
+
+        for key, content in BLOBS.items():
+            if key in deleted:
+                self.assertFalse(self.store.exists(key))
+                self.assertRaises(FileNotFoundError, self.store.read, key)
+            else:
+                self.assertEqual(self.store.read(key), content)
+
+    def test_compact_in_child(self):
+        write(self.store, BLOBS)
+        deleted = sorted(BLOBS)[:10]
+        delete(self.store, deleted)
+        segments = os.listdir(os.path.join(self.root, 'pack'))
+        self.assertEqual(run_in_child(compact, self.store), 0)
+        self.assertNotEqual(os.listdir(os.path.join(self.root, 'pack')),
+                            segments)
+
+        for key, content in BLOBS.items():
+            if key in deleted:
+                self.assertFalse(self.store.exists(key))
+            else:
+                self.assertEqual(self.store.read(key), content)
+
+        self.assertEqual(
+            sorted(key for key, size, mtime in self.store.iter_blobs()),
+            sorted(set(BLOBS) - set(deleted))
+        )
+
+    def test_concurrent_compaction(self):
+        write(self.store, BLOBS)
+        delete(self.store, sorted(BLOBS)[:10])
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=compact, args=(self.store,))
+                     for _ in range(2)]
+
+        for process in processes:
+            process.start()
+
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        for key in sorted(BLOBS)[10:]:
+            self.assertEqual(self.store.read(key), BLOBS[key])
+
+    def test_compaction_does_not_restore_deleted_blob(self):
+        write(self.store, BLOBS)
+        key = sorted(BLOBS)[0]
+        segment, offset, length = self.store._lookup(key)
+
+        # Another process deletes the blob while it is being moved.
+        self.assertEqual(run_in_child(delete, self.store, [key]), 0)
+        self.store._append([(key, BLOBS[key], 0, (segment, offset))])
+
+        self.assertFalse(self.store.exists(key))
+
+
+if __name__ == '__main__':
+    unittest.main()
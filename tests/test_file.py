@@ -0,0 +1,142 @@
+'''
+Tests for model.file.
+
+Run with ``python -m unittest discover tests``.
+'''
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from PIL import Image
+
+from helper.blob import FileStore
+import helper.blob
+from model.file import hamming_distance, image_dhash, iter_zip, \
+                       phash_neighbors, write_zip, zip_compress_type
+
+
+KEY = 'ab' * 32
+IMAGE = b'\x89PNG' + bytes(range(256)) * 4
+CSV = 'username,site\n' * 100
+
+
+class TestZip(unittest.TestCase):
+    ''' Create zip archives of stored files. '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        store = FileStore(self.root)
+        store.write(KEY, IMAGE)
+        self.old_store = helper.blob._store
+        helper.blob._store = store
+
+    def tearDown(self):
+        helper.blob._store = self.old_store
+        shutil.rmtree(self.root)
+
+    def test_compress_type(self):
+        self.assertEqual(zip_compress_type('image/png'), zipfile.ZIP_STORED)
+        self.assertEqual(zip_compress_type('application/zip'),
+                         zipfile.ZIP_STORED)
+        self.assertEqual(zip_compress_type('text/csv'), zipfile.ZIP_DEFLATED)
+        self.assertEqual(zip_compress_type('text/html'),
+                         zipfile.ZIP_DEFLATED)
+
+    def test_write_zip(self):
+        fileobj = io.BytesIO()
+        write_zip(fileobj,
+                  files=[('image.png', KEY, 'image/png')],
+                  str_files=[('results.csv', CSV, 'text/csv')])
+        fileobj.seek(0)
+
+        with zipfile.ZipFile(fileobj) as zip_file:
+            image = zip_file.getinfo('image.png')
+            csv = zip_file.getinfo('results.csv')
+
+            self.assertEqual(image.compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(csv.compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(zip_file.read('image.png'), IMAGE)
+            self.assertEqual(zip_file.read('results.csv').decode('utf8'),
+                             CSV)
+
+    def test_iter_zip(self):
+        files = [('image.png', KEY, 'image/png')]
+        str_files = [('results.csv', CSV, 'text/csv')]
+        chunks = list(iter_zip(files, str_files))
+
+        # One chunk per member, and one for the central directory.
+        self.assertEqual(len(chunks), 3)
+
+        streamed = io.BytesIO(b''.join(chunks))
+        written = io.BytesIO()
+        write_zip(written, files, str_files)
+        written.seek(0)
+
+        with zipfile.ZipFile(streamed) as zip1, \
+                zipfile.ZipFile(written) as zip2:
+            self.assertEqual(zip1.namelist(), zip2.namelist())
+
+            for name in zip1.namelist():
+                self.assertEqual(zip1.read(name), zip2.read(name))
+
+
+class TestPhash(unittest.TestCase):
+    ''' Find near-duplicate images by perceptual hash. '''
+
+    def test_hamming_distance(self):
+        self.assertEqual(hamming_distance(0, 0), 0)
+        self.assertEqual(hamming_distance(0, 0b1011), 3)
+        # Hashes are stored as signed integers.
+        self.assertEqual(hamming_distance(-1, 0), 64)
+        self.assertEqual(hamming_distance(-1, -2), 1)
+
+    def test_neighbors(self):
+        self.assertEqual(phash_neighbors(5, 0), [5])
+
+        for phash in (0, 5, -1, -(1 << 63)):
+            neighbors = phash_neighbors(phash, 2)
+
+            self.assertEqual(len(neighbors), 1 + 64 + 64 * 63 // 2)
+            self.assertEqual(len(set(neighbors)), len(neighbors))
+            self.assertIn(phash, neighbors)
+
+            for neighbor in neighbors:
+                self.assertLessEqual(hamming_distance(phash, neighbor), 2)
+                self.assertTrue(-(1 << 63) <= neighbor < 1 << 63)
+
+    def test_image_dhash(self):
+        gradient = Image.new('L', (90, 80))
+        gradient.putdata([255 - x * 255 // 89 for y in range(80)
+                          for x in range(90)])
+        similar = gradient.copy()
+        similar.putpixel((0, 0), 0)
+        flipped = gradient.transpose(Image.FLIP_LEFT_RIGHT)
+        phashes = [image_dhash(png(image))
+                   for image in (gradient, similar, flipped)]
+
+        self.assertEqual(phashes[0], -1)
+        self.assertLessEqual(hamming_distance(phashes[0], phashes[1]), 2)
+        self.assertEqual(hamming_distance(phashes[0], phashes[2]), 64)
+
+        with self.assertRaises(OSError):
+            image_dhash(b'not an image')
+
+
+def png(image):
+    ''' Return `image` encoded as PNG. '''
+
+    fileobj = io.BytesIO()
+    image.save(fileobj, 'PNG')
+
+    return fileobj.getvalue()
+
+
+if __name__ == '__main__':
+    unittest.main()
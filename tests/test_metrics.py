@@ -0,0 +1,146 @@
+'''
+Tests for app.metrics.
+
+Run with ``python -m unittest discover tests``.
+'''
+
+from collections import Counter
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import fakeredis
+
+from app.metrics import (BUCKETS, count, flush, get_metrics, observe,
+                         prometheus_text, record_timings, set_gauge)
+import app.metrics
+
+
+class TestHistograms(unittest.TestCase):
+    ''' Summarize rolling histograms of job timings. '''
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+
+    def test_empty(self):
+        self.assertEqual(get_metrics(self.redis), {})
+
+    def test_summary(self):
+        # 90 fast timings, 9 slower ones and one in the overflow bucket.
+        for _ in range(90):
+            record_timings(self.redis, 'check_username',
+                           {'fetch': 0.02, 'total': 0.03})
+
+        for _ in range(9):
+            record_timings(self.redis, 'check_username',
+                           {'fetch': 0.4, 'total': 0.5})
+
+        record_timings(self.redis, 'check_username',
+                       {'fetch': 100, 'total': 100})
+
+        metrics = get_metrics(self.redis)
+        fetch = metrics['check_username']['fetch']
+
+        self.assertEqual(set(metrics['check_username']), {'fetch', 'total'})
+        self.assertEqual(fetch['count'], 100)
+        self.assertAlmostEqual(fetch['mean'],
+                               (90 * 0.02 + 9 * 0.4 + 100) / 100)
+        self.assertEqual(fetch['p50'], 0.025)
+        self.assertEqual(fetch['p95'], 0.5)
+        self.assertEqual(fetch['p99'], 0.5)
+        self.assertEqual(len(fetch['buckets']), len(BUCKETS) + 1)
+        self.assertIn([0.025, 90], fetch['buckets'])
+        self.assertIn([0.5, 9], fetch['buckets'])
+        self.assertEqual(fetch['buckets'][-1], [None, 1])
+        self.assertEqual(sum(count for _, count in fetch['buckets']), 100)
+
+    def test_overflow_percentile(self):
+        record_timings(self.redis, 'archive', {'total': 100})
+        total = get_metrics(self.redis)['archive']['total']
+
+        # Timings above the last bound are reported as the last bound.
+        self.assertEqual(total['p50'], BUCKETS[-1])
+        self.assertEqual(total['mean'], 100)
+
+    def test_bucket_bounds(self):
+        # Bounds are inclusive.
+        record_timings(self.redis, 'archive', {'total': 0.001})
+        buckets = get_metrics(self.redis)['archive']['total']['buckets']
+
+        self.assertEqual(buckets[0], [0.001, 1])
+
+
+class TestPrometheus(unittest.TestCase):
+    ''' Export metrics in the Prometheus text format. '''
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        app.metrics._pending = Counter()
+        app.metrics._gauges.clear()
+
+    def test_counter(self):
+        count('hgprofiler_checks_total', site='GitHub', status='f')
+        count('hgprofiler_checks_total', site='GitHub', status='f')
+        count('hgprofiler_checks_total', 3, site='Say "hi"', status='n')
+
+        # Nothing is written until the updates are flushed.
+        self.assertEqual(prometheus_text(self.redis), '\n')
+        flush(self.redis)
+
+        self.assertEqual(prometheus_text(self.redis).splitlines(), [
+            '# HELP hgprofiler_checks_total Username checks by site and '
+            'result status.',
+            '# TYPE hgprofiler_checks_total counter',
+            'hgprofiler_checks_total{site="GitHub",status="f"} 2',
+            'hgprofiler_checks_total{site="Say \\"hi\\"",status="n"} 3',
+        ])
+
+    def test_histogram(self):
+        observe('hgprofiler_job_phase_seconds', 0.02, job='archive',
+                phase='total')
+        observe('hgprofiler_job_phase_seconds', 100, job='archive',
+                phase='total')
+        flush(self.redis)
+        lines = prometheus_text(self.redis).splitlines()
+        labels = 'job="archive",phase="total"'
+
+        self.assertEqual(lines[1],
+                         '# TYPE hgprofiler_job_phase_seconds histogram')
+        # Buckets are cumulative.
+        self.assertIn('hgprofiler_job_phase_seconds_bucket'
+                      '{{{},le="0.01"}} 0'.format(labels), lines)
+        self.assertIn('hgprofiler_job_phase_seconds_bucket'
+                      '{{{},le="0.025"}} 1'.format(labels), lines)
+        self.assertIn('hgprofiler_job_phase_seconds_bucket'
+                      '{{{},le="60"}} 1'.format(labels), lines)
+        self.assertEqual(lines[-3:], [
+            'hgprofiler_job_phase_seconds_bucket'
+            '{{{},le="+Inf"}} 2'.format(labels),
+            'hgprofiler_job_phase_seconds_sum{{{}}} 100.02'.format(labels),
+            'hgprofiler_job_phase_seconds_count{{{}}} 2'.format(labels),
+        ])
+        self.assertEqual(len(lines), 2 + len(BUCKETS) + 3)
+
+    def test_gauges(self):
+        set_gauge('hgprofiler_workers', 5, state='busy')
+        set_gauge('hgprofiler_workers', 2, state='busy')
+        flush(self.redis)
+        text = prometheus_text(
+            self.redis,
+            gauges=[('hgprofiler_queue_length', 7, {'queue': 'scrape'})]
+        )
+
+        self.assertIn('# TYPE hgprofiler_workers gauge', text)
+        self.assertIn('hgprofiler_workers{{process="{}",state="busy"}} 2'
+                      .format(app.metrics._process), text)
+        self.assertIn('hgprofiler_queue_length{queue="scrape"} 7', text)
+
+    def test_unknown_metric(self):
+        with self.assertRaises(ValueError):
+            count('hgprofiler_unknown_total')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+'''
+Tests for app.rest.
+
+Run with ``python -m unittest discover tests``.
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import flask
+
+from app.rest import _get_byte_range, RangeNotSatisfiable
+
+
+ETAG = 'ab' * 32
+LENGTH = 1000
+
+
+class TestByteRange(unittest.TestCase):
+    ''' Parse the byte range requested for a blob. '''
+
+    def setUp(self):
+        self.app = flask.Flask('app')
+
+    def get_byte_range(self, **headers):
+        ''' Return the byte range for a request with `headers`. '''
+
+        with self.app.test_request_context(headers=headers):
+            return _get_byte_range(ETAG, LENGTH)
+
+    def test_no_range(self):
+        self.assertIsNone(self.get_byte_range())
+
+    def test_range(self):
+        self.assertEqual(self.get_byte_range(Range='bytes=0-99'), (0, 100))
+        self.assertEqual(self.get_byte_range(Range='bytes=900-'),
+                         (900, LENGTH))
+        self.assertEqual(self.get_byte_range(Range='bytes=-100'),
+                         (900, LENGTH))
+        # The end is clamped to the length of the entity.
+        self.assertEqual(self.get_byte_range(Range='bytes=900-1999'),
+                         (900, LENGTH))
+
+    def test_multiple_ranges(self):
+        self.assertIsNone(self.get_byte_range(Range='bytes=0-9,20-29'))
+
+    def test_if_range(self):
+        headers = {'Range': 'bytes=0-99', 'If-Range': '"{}"'.format(ETAG)}
+        self.assertEqual(self.get_byte_range(**headers), (0, 100))
+
+        headers['If-Range'] = '"{}"'.format('cd' * 32)
+        self.assertIsNone(self.get_byte_range(**headers))
+
+    def test_not_satisfiable(self):
+        with self.assertRaises(RangeNotSatisfiable) as context:
+            self.get_byte_range(Range='bytes=1000-1999')
+
+        response = context.exception.get_response()
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers['Content-Range'],
+                         'bytes */{}'.format(LENGTH))
+
+
+if __name__ == '__main__':
+    unittest.main()
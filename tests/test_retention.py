@@ -0,0 +1,73 @@
+'''
+Tests for worker.retention.
+
+Run with ``python -m unittest discover tests``.
+'''
+
+from collections import Counter
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects.postgresql import BYTEA
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import sessionmaker
+
+from model import Archive, Base, Result
+import worker.retention
+
+
+@compiles(BYTEA, 'sqlite')
+def compile_bytea(type_, compiler, **kwargs):
+    ''' Store file hashes as BLOBs in the SQLite test database. '''
+
+    return 'BLOB'
+
+
+class TestDeleteSearches(unittest.TestCase):
+    ''' Delete searches in several batches. '''
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+
+        for i in range(5):
+            self.add_search('old', 'tracker.old{}'.format(i))
+
+        self.add_search('new', 'tracker.new')
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def add_search(self, username, tracker_id):
+        ''' Add an archive with one result. '''
+
+        self.session.add(Archive(tracker_id, username, None, 1, 1, 0, 0))
+        self.session.add(Result(tracker_id, 'Site', 'http://site', 'f'))
+
+    def test_delete_in_batches(self):
+        report = Counter()
+        worker.retention._delete_searches(self.session,
+                                          [Archive.username == 'old'],
+                                          2,
+                                          report)
+
+        self.assertEqual(report['archives_deleted'], 5)
+        self.assertEqual(report['results_deleted'], 5)
+        self.assertEqual(
+            [archive.tracker_id for archive in self.session.query(Archive)],
+            ['tracker.new']
+        )
+        self.assertEqual(
+            [result.tracker_id for result in self.session.query(Result)],
+            ['tracker.new']
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+'''
+Tests for app.tracker.
+
+Run with ``python -m unittest discover tests``.
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import fakeredis
+
+from app.tracker import get_tracker, init_tracker, is_tracker_id, \
+                        update_tracker
+
+
+TRACKER_ID = 'tracker.abcDEF1234'
+
+
+class TestTracker(unittest.TestCase):
+    ''' Record results against a tracker. '''
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        init_tracker(self.redis, TRACKER_ID, 4)
+
+    def test_init(self):
+        tracker = get_tracker(self.redis, TRACKER_ID)
+
+        self.assertEqual(tracker['id'], TRACKER_ID)
+        self.assertEqual(tracker['total'], 4)
+        self.assertEqual(tracker['current'], 0)
+        self.assertEqual(tracker['progress'], 0)
+        self.assertEqual(tracker['started'], tracker['updated'])
+        self.assertGreater(self.redis.ttl(TRACKER_ID), 0)
+
+    def test_init_pipeline(self):
+        pipe = self.redis.pipeline()
+        init_tracker(self.redis, 'tracker.zyxwvu9876', 2, pipeline=pipe)
+
+        self.assertIsNone(get_tracker(self.redis, 'tracker.zyxwvu9876'))
+        pipe.execute()
+        self.assertEqual(
+            get_tracker(self.redis, 'tracker.zyxwvu9876')['total'],
+            2
+        )
+
+    def test_update(self):
+        update_tracker(self.redis, TRACKER_ID, 'f')
+        update_tracker(self.redis, TRACKER_ID, 'n')
+        tracker = update_tracker(self.redis, TRACKER_ID, 'e')
+
+        self.assertEqual(tracker['found'], 1)
+        self.assertEqual(tracker['not_found'], 1)
+        self.assertEqual(tracker['error'], 1)
+        self.assertEqual(tracker['current'], 3)
+        self.assertEqual(tracker['progress'], 0.75)
+        self.assertEqual(tracker, get_tracker(self.redis, TRACKER_ID))
+
+    def test_update_invalid_status(self):
+        with self.assertRaises(ValueError):
+            update_tracker(self.redis, TRACKER_ID, 'x')
+
+        self.assertEqual(get_tracker(self.redis, TRACKER_ID)['current'], 0)
+
+    def test_missing(self):
+        self.assertIsNone(get_tracker(self.redis, 'tracker.0000000000'))
+
+
+class TestIsTrackerId(unittest.TestCase):
+    ''' Validate tracker IDs supplied by clients. '''
+
+    def test_valid(self):
+        self.assertTrue(is_tracker_id(TRACKER_ID))
+        self.assertTrue(is_tracker_id(TRACKER_ID + '-1'))
+        self.assertTrue(is_tracker_id(TRACKER_ID + '-2'))
+
+    def test_invalid(self):
+        for tracker_id in ('tracker.abc', TRACKER_ID + '-3',
+                           TRACKER_ID + 'x', 'batch.abcDEF1234',
+                           'tracker.abcDEF123*', TRACKER_ID + '\n', ''):
+            self.assertFalse(is_tracker_id(tracker_id), tracker_id)
+
+    def test_get_invalid(self):
+        redis = fakeredis.FakeStrictRedis()
+        redis.hset('admission.outstanding.1', 'total', 1)
+
+        self.assertIsNone(get_tracker(redis, 'admission.outstanding.1'))
+
+
+if __name__ == '__main__':
+    unittest.main()